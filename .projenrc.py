@@ -14,6 +14,10 @@ INDEXER_PROJECT_NAME = "indexer"
 INDEXER_MODULE_NAME = INDEXER_PROJECT_NAME.replace("-", "_")
 API_PROJECT_NAME = "api"
 API_MODULE_NAME = API_PROJECT_NAME.replace("-", "_")
+VECTOR_INDEX_PROJECT_NAME = "vector-index"
+VECTOR_INDEX_MODULE_NAME = VECTOR_INDEX_PROJECT_NAME.replace("-", "_")
+# The shared package is copied into the Lambda bundles rather than installed, see `_get_lambda` in iac/stack.py
+VECTOR_INDEX_DEV_DEP = f"{VECTOR_INDEX_PROJECT_NAME}@{{path = '../{VECTOR_INDEX_MODULE_NAME}', develop = true}}"
 PYTHON_VERSION = "3.9"
 PYTHON_DEP = f"python@^{PYTHON_VERSION}"
 AWS_PROFILE_NAME = os.getenv("AWS_PROFILE", "school-ai")
@@ -36,6 +40,7 @@ ROOT_PROJECT = PythonProject(
         f"{IAC_MODULE_NAME}@{{path = './{IAC_PROJECT_NAME}', develop = true}}",
         f"{INDEXER_MODULE_NAME}@{{path = './{INDEXER_MODULE_NAME}', develop = true}}",
         f"{API_MODULE_NAME}@{{path = './{API_PROJECT_NAME}', develop = true}}",
+        f"{VECTOR_INDEX_PROJECT_NAME}@{{path = './{VECTOR_INDEX_MODULE_NAME}', develop = true}}",
     ],
 )
 ROOT_PROJECT.add_git_ignore("**/cdk.out")
@@ -102,12 +107,16 @@ INDEXER_PROJECT = PythonProject(
         "boto3@^1.35.2",
         "pydantic-settings@^2.4.0",
         "pinecone-client@^5.0.1",
+        "numpy@>=1.26.0",
+        # Runtime dependency of the shared vector-index package
+        "hnswlib@^0.8.0",
         # we need to pin this for the pinecone client to work for some reason
         "urllib3@>=1.26.0,<2.0.0",
     ],
     dev_deps=[
         "pytest@^6.2.5",
         "requests@^2.26.0",
+        VECTOR_INDEX_DEV_DEP,
         "boto3-stubs@{version = '^1.34.105', extras = ['s3', 'bedrock-runtime']}",
     ],
 )
@@ -128,15 +137,41 @@ API_PROJECT = PythonProject(
         "fastapi@^0.112.1",
         "pydantic@^2.8.0",
         "mangum@^0.17.0",
+        "uvicorn@^0.30.6",
         "aws-lambda-powertools@^2.43.1",
         "pydantic-settings@^2.4.0",
         "python-multipart@^0.0.9",
         "pinecone@^5.0.1",
         "numpy@^1.26.0",
+        # Runtime dependency of the shared vector-index package
+        "hnswlib@^0.8.0",
     ],
     dev_deps=[
         "pytest@^6.2.5",
         "boto3-stubs@{version = '^1.34.105', extras = ['s3', 'bedrock-runtime', 'dynamodb']}",
+        VECTOR_INDEX_DEV_DEP,
+    ],
+)
+
+
+VECTOR_INDEX_PROJECT = PythonProject(
+    parent=ROOT_PROJECT,
+    author_email=AUTHOR_EMAIL,
+    author_name=AUTHORS[0],
+    module_name=VECTOR_INDEX_MODULE_NAME,
+    name=VECTOR_INDEX_PROJECT_NAME,
+    outdir=VECTOR_INDEX_MODULE_NAME,
+    version="0.0.0",
+    description="Vector stores, BM25 encoding and document registry code shared by the indexer and the API",
+    poetry=True,
+    deps=[
+        PYTHON_DEP,
+        "aws-lambda-powertools@^2.43.1",
+        "numpy@>=1.26.0",
+        "hnswlib@^0.8.0",
+    ],
+    dev_deps=[
+        "pytest@^6.2.5",
     ],
 )
 
@@ -144,5 +179,6 @@ API_PROJECT = PythonProject(
 # Synthesize all projects
 API_PROJECT.synth()
 INDEXER_PROJECT.synth()
+VECTOR_INDEX_PROJECT.synth()
 IAC_PROJECT.synth()
 ROOT_PROJECT.synth()
@@ -1,6 +1,35 @@
+from functools import lru_cache
+
 from boto3 import client, resource
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+
+# Batch retrieval embeds concurrently, the pool has to fit settings.retrieval_batch_concurrency
+bedrock_client_config = Config(max_pool_connections=50)
+
+# Uploads are streamed to S3 in parts, only a few parts are held in memory at a time
+upload_transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+
+# The clients are created on first use so that cold starts only pay for the clients the invoked route needs
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    # Presigned POST uploads with metadata conditions need SigV4
+    return client("s3", config=Config(signature_version="s3v4"))
+
+
+@lru_cache(maxsize=None)
+def get_bedrock_client():
+    return client("bedrock-runtime", config=bedrock_client_config)
 
 
-S3_CLIENT = client("s3")
-BEDROCK_CLIENT = client("bedrock-runtime")
-DYNAMODB_RESOURCE = resource("dynamodb")
\ No newline at end of file
+@lru_cache(maxsize=None)
+def get_dynamodb_resource():
+    return resource("dynamodb")
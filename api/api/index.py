@@ -1,16 +1,20 @@
+import asyncio
 from textwrap import dedent
+from typing import Any, Dict
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from aws_lambda_powertools import Logger
 from fastapi import APIRouter, FastAPI
 from mangum import Mangum
 
-from api.settings import Settings
+from api.settings import get_settings
 from api.routers.documents import ROUTER as DOCUMENTS_ROUTER
 from api.routers.retrieval import ROUTER as RETRIEVAL_ROUTER
 from api.routers.chat import ROUTER as CHAT_ROUTER
+from api.services.embedding_cache import EMBEDDING_CACHE
+from api.services.warmup import WARMUP_EVENT_KEY, warm_up
 
 
-SETTINGS = Settings()
+SETTINGS = get_settings()
 LOGGER = Logger(level=SETTINGS.log_level)
 
 
@@ -19,7 +23,7 @@ ROUTER = APIRouter(prefix="/health-check", tags=["health-check"])
 
 @ROUTER.get("/")
 def health_check():
-    return {"status": "ok"}
+    return {"status": "ok", "embedding_cache": EMBEDDING_CACHE.stats()}
 
 
 ROUTERS = [
@@ -32,8 +36,7 @@ ROUTERS = [
 
 def create_app():
     """Create the FastAPI app."""
-    settings = Settings()  # type: ignore - pulled from the environment
-    LOGGER.debug("Creating FastAPI app", body=settings)
+    LOGGER.debug("Creating FastAPI app", body=SETTINGS)
 
     app = FastAPI(
         title="SchoolAI RAG coding challenge",
@@ -48,15 +51,19 @@ def create_app():
             - Use the `POST /documents` endpoint to upload files from the [SciQ dataset](https://allenai.org/data/sciq).
             - Recommendation: Keep individual resource files to less than 2000 rows to minimize indexing time.
             - Note: Indexing for a 1000 line file takes about 1 minute.
+            - Files larger than a few MB: use `POST /documents/presigned` to get a presigned POST or PUT URL and upload straight to S3.
 
         2. **Check indexing status**
             - Use the `GET /documents/{resource_id}` endpoint to check the indexing status of a document.
+            - Use the `GET /documents` endpoint to page through documents (optionally filtered by status), or `GET /documents/stream` to stream them all as newline delimited JSON.
 
         3. **Query documents**
             - Use the `POST /retrieval/query` endpoint to find relevant documents for a given query.
+            - Use the `POST /retrieval/query/batch` endpoint to run many queries at once (results are streamed as newline delimited JSON).
 
         4. **Chat**
             - Use the `POST /chat/chat` endpoint to ask questions and get AI-generated responses.
+            - Use the `POST /chat/chat/stream` endpoint to receive the response as it is generated (newline delimited JSON).
 
         5. **Delete documents**
             - Use the `DELETE /documents/{resource_id}` endpoint to remove resources you no longer need.
@@ -83,12 +90,31 @@ def create_app():
     return app
 
 
+# Built once per container, warm invocations reuse the app and its routes. The deployed function serves WEB_APP through
+# the Lambda Web Adapter so responses can be streamed, the Mangum handler is kept for buffered invocations.
+WEB_APP = create_app()
+# Mangum runs the app on the thread's event loop, the warm-up shares it rather than closing it like asyncio.run would
+EVENT_LOOP = asyncio.new_event_loop()
+asyncio.set_event_loop(EVENT_LOOP)
+APP = Mangum(WEB_APP, lifespan="off")
+
+
+@WEB_APP.post("/events", include_in_schema=False)
+async def events(event: Dict[str, Any]):
+    """Non HTTP invocations, like the scheduled warm-up, are posted here by the Lambda Web Adapter."""
+    if event.get(WARMUP_EVENT_KEY):
+        return await warm_up()
+    LOGGER.warning("Ignoring unexpected event", body={"event": event})
+    return {}
+
+
 @LOGGER.inject_lambda_context(log_event=True)
 def handler(event, context: LambdaContext):
     try:
-        app = Mangum(create_app())
+        if event.get(WARMUP_EVENT_KEY):
+            return EVENT_LOOP.run_until_complete(warm_up())
         LOGGER.debug("Invoking FastAPI app", body={"event": event})
-        response = app(event, context)  # type: ignore - the context is using a Mangum type instead of power tools type
+        response = APP(event, context)  # type: ignore - the context is using a Mangum type instead of power tools type
     except Exception as e:
         LOGGER.error("An error occurred", body={"error": e, "event": event})
         raise
@@ -1,14 +1,15 @@
-from typing import List
+from typing import AsyncIterator, List
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from aws_lambda_powertools import Logger
 
-from api.settings import Settings
+from api.settings import get_settings
 from api.routers.retrieval import QueryRequest, QueryResult
-from api.services.chat import CHAT_SERVICE
+from api.services.chat import CHAT_SERVICE, ChatStreamEvent
 
 
-SETTINGS = Settings()  # type: ignore - pulled from the environment
+SETTINGS = get_settings()
 LOGGER = Logger(level=SETTINGS.log_level)
 
 module_name = __name__.rsplit(".", maxsplit=1)[-1].replace("_", "-")
@@ -35,7 +36,7 @@ class ChatResponse(BaseModel):
 
 
 @ROUTER.post("/chat", response_model=ChatResponse)
-def chat(request: QueryRequest) -> ChatResponse:
+async def chat(request: QueryRequest) -> ChatResponse:
     """
     Generate a chat response based on the provided query.
 
@@ -43,8 +44,34 @@ def chat(request: QueryRequest) -> ChatResponse:
     a response. It retrieves relevant documents based on the query and uses them
     to inform the generation of the response.
     """
-    response, docs = CHAT_SERVICE.generate_response(request.query, request.top_k_override, request.minimum_threshold_override)
+    response, docs = await CHAT_SERVICE.generate_response(request.query, request.top_k_override, request.minimum_threshold_override)
     converted_docs = []
     for doc in docs:
         converted_docs.append(QueryResult(id=doc.id, score=doc.score, metadata=doc.metadata))
     return ChatResponse(response=response.response, relevancy=response.relevancy, supporting_docs=converted_docs)
+
+
+@ROUTER.post(
+    "/chat/stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+async def chat_stream(request: QueryRequest) -> StreamingResponse:
+    """
+    Stream a chat response based on the provided query as newline delimited JSON.
+
+    The first line contains the supporting documents, followed by one line per generated
+    chunk of text, and the last line contains the relevancy score of the full response.
+    """
+    events = CHAT_SERVICE.stream_response(request.query, request.top_k_override, request.minimum_threshold_override)
+    return StreamingResponse(_to_ndjson(events), media_type="application/x-ndjson")
+
+
+async def _to_ndjson(events: AsyncIterator[ChatStreamEvent]) -> AsyncIterator[str]:
+    try:
+        async for event in events:
+            yield event.model_dump_json(exclude_none=True) + "\n"
+    except Exception as e:
+        # The status code has already been sent, so the failure can only be reported in the stream
+        LOGGER.error(f"Error while streaming chat response: {str(e)}")
+        yield ChatStreamEvent(event="error").model_dump_json(exclude_none=True) + "\n"
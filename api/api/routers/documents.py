@@ -1,56 +1,141 @@
 import uuid
-from typing import Any, Dict, List
-from fastapi import APIRouter, HTTPException, Path, File, UploadFile
+from typing import Any, Dict, Iterator, Literal, Optional
+from pydantic import BaseModel, Field
+from fastapi import APIRouter, HTTPException, Path, Query, File, Response, UploadFile
+from fastapi.responses import StreamingResponse
 from botocore.exceptions import ClientError
 from aws_lambda_powertools import Logger
 
-from api.settings import Settings
-from api.boto3_clients import S3_CLIENT
+from api.settings import get_settings
+from api.boto3_clients import get_s3_client, upload_transfer_config
+from api.services.documents import DOCUMENT_REGISTRY, DocumentPage, DocumentStateError, IndexingStatus
 
 
-SETTINGS = Settings()  # type: ignore - pulled from the environment
+SETTINGS = get_settings()
 LOGGER = Logger(level=SETTINGS.log_level)
 
 module_name = __name__.rsplit(".", maxsplit=1)[-1].replace("_", "-")
 ROUTER = APIRouter(prefix=f"/{module_name}", tags=[module_name])
 
 
+class PresignedUploadRequest(BaseModel):
+
+    filename: str = Field(
+        ...,
+        title="Filename",
+        description="The name of the file that will be uploaded.",
+    )
+    size: int = Field(
+        ...,
+        gt=0,
+        title="Size",
+        description="The size of the file in bytes, the upload must match it exactly.",
+    )
+    method: Literal["POST", "PUT"] = Field(
+        "POST",
+        title="Upload method",
+        description="POST returns a URL and form fields, PUT returns a URL and the headers to send with it.",
+    )
+
+
+class PresignedUploadResponse(BaseModel):
+
+    resource_id: str = Field(
+        ...,
+        title="Resource ID",
+        description="The ID the resource will be indexed under.",
+    )
+    method: Literal["POST", "PUT"] = Field(
+        ...,
+        title="Upload method",
+        description="The HTTP method to upload the file with.",
+    )
+    url: str = Field(
+        ...,
+        title="Upload URL",
+        description="The presigned URL to upload the file to.",
+    )
+    fields: Dict[str, str] = Field(
+        default_factory=dict,
+        title="Form fields",
+        description="For POST, the form fields to send before the file field.",
+    )
+    headers: Dict[str, str] = Field(
+        default_factory=dict,
+        title="Headers",
+        description="For PUT, the headers to send with the request.",
+    )
+    expires_in: int = Field(
+        ...,
+        title="Expiration",
+        description="The number of seconds the URL is valid for.",
+    )
+
+
+@ROUTER.get(
+    "/stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+def stream_resources(
+    status: Optional[str] = Query(None, description="Only list resources with this indexing status"),
+) -> StreamingResponse:
+    """
+    Stream every resource as newline delimited JSON.
+
+    Meant for full dumps, the registry is read page by page while the response is sent.
+    """
+    return StreamingResponse(_to_ndjson(status), media_type="application/x-ndjson")
+
+
+def _to_ndjson(status: Optional[str]) -> Iterator[str]:
+    try:
+        for document in DOCUMENT_REGISTRY.iter_all(indexing_status=status):
+            yield document.model_dump_json() + "\n"
+    except ClientError as e:
+        # The status code is already sent, the truncated stream is all the client can be told
+        LOGGER.error(f"Error streaming resources: {str(e)}")
+
+
 @ROUTER.get("/{resource_id}", response_model=Dict[str, Any])
 def get_resource(resource_id: str = Path(..., title="The ID of the resource to retrieve")) -> Dict[str, Any]:
     """
     Retrieve metadata for a specific resource by its ID.
 
-    This endpoint fetches metadata about a resource stored in S3, including its filename,
-    size, and indexing status.
+    This endpoint fetches the resource from the document registry, including its filename,
+    size, indexing status, row and vector counts.
     """
     try:
-        response = S3_CLIENT.head_object(Bucket=SETTINGS.s3_bucket_name, Key=resource_id)
-        return {
-            resource_id: {
-                "filename": response["Metadata"].get("filename", "Unknown"),
-                "size": response["Metadata"].get("size", "Unknown"),
-                "indexing_status": response["Metadata"].get("indexing_status", "Unknown"),
-            }
-        }
+        document = DOCUMENT_REGISTRY.get(resource_id)
     except ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            raise HTTPException(status_code=404, detail="Resource not found")
-        else:
-            LOGGER.error(f"Error retrieving resource: {str(e)}")
-            raise HTTPException(status_code=500, detail="Failed to retrieve resource")
+        LOGGER.error(f"Error retrieving resource: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to retrieve resource")
+    if document is None:
+        raise HTTPException(status_code=404, detail="Resource not found")
+    return {resource_id: document.model_dump(exclude={"document_id"}, exclude_none=True)}
 
 
-@ROUTER.get("", response_model=List[Dict[str, Any]])
-def list_resources() -> List[Dict[str, Any]]:
+@ROUTER.get("", response_model=DocumentPage)
+def list_resources(
+    limit: int = Query(100, ge=1, le=1000, description="The maximum number of resources to return"),
+    cursor: Optional[str] = Query(None, description="The `next_cursor` of the previous page"),
+    status: Optional[str] = Query(None, description="Only list resources with this indexing status"),
+) -> DocumentPage:
     """
-    List all resources stored in the S3 bucket.
+    List resources with their filename, size and indexing status, one page at a time.
 
-    This endpoint retrieves a list of all objects stored in the configured S3 bucket.
+    Pass the returned `next_cursor` to get the next page, it is missing on the last page. A page
+    can hold fewer than `limit` resources even when more follow. Filtering on a status lists the
+    newest resources first.
     """
     try:
-        response = S3_CLIENT.list_objects_v2(Bucket=SETTINGS.s3_bucket_name)
-        return [key for key in response.get("Contents", [])]
+        return DOCUMENT_REGISTRY.list_page(limit, cursor, status)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except ClientError as e:
+        if e.response["Error"]["Code"] == "ValidationException":
+            # A cursor from a listing with a different status filter
+            raise HTTPException(status_code=400, detail="Invalid cursor")
         LOGGER.error(f"Error listing resources: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to list resources")
 
@@ -61,21 +146,32 @@ def create_resource(file: UploadFile = File(...)) -> Dict[str, str]:
     Upload a new resource to the S3 bucket to index it in the Pinecone index.
 
     This endpoint allows uploading a file to the S3 bucket which triggers the indexing process.
-    It generates a unique resource ID and stores metadata about the file.
+    It generates a unique resource ID and stores metadata about the file. The file is streamed
+    to S3 in parts, large files should be uploaded with `POST /documents/presigned` instead as
+    requests through the API are limited to 6 MB.
     """
     try:
         resource_id = str(uuid.uuid4())
-        contents = file.file.read()
-        LOGGER.debug(f"Uploading file: {file.filename}, size: {len(contents)} bytes, resource_id: {resource_id}")
-        S3_CLIENT.put_object(
-            Bucket=SETTINGS.s3_bucket_name,
-            Key=resource_id,
-            Body=contents,
-            ContentType=file.content_type,
-            Metadata={"filename": file.filename, "size": str(len(contents))},
-        )
+        size = _get_size(file)
+        LOGGER.debug(f"Uploading file: {file.filename}, size: {size} bytes, resource_id: {resource_id}")
+        # Registered first, the indexer can pick up the upload event before this request returns
+        DOCUMENT_REGISTRY.register(resource_id, file.filename or "Unknown", size)
+        try:
+            get_s3_client().upload_fileobj(
+                file.file,
+                SETTINGS.s3_bucket_name,
+                resource_id,
+                ExtraArgs={
+                    "ContentType": file.content_type or "application/octet-stream",
+                    "Metadata": _get_object_metadata(file.filename or "Unknown", size),
+                },
+                Config=upload_transfer_config,
+            )
+        except Exception:
+            DOCUMENT_REGISTRY.remove(resource_id)
+            raise
 
-        LOGGER.info(f"File uploaded: {file.filename}, size: {len(contents)} bytes, resource_id: {resource_id}")
+        LOGGER.info(f"File uploaded: {file.filename}, size: {size} bytes, resource_id: {resource_id}")
 
         return {resource_id: file.filename}
     except Exception as e:
@@ -83,35 +179,118 @@ def create_resource(file: UploadFile = File(...)) -> Dict[str, str]:
         raise HTTPException(status_code=500, detail="Failed to upload file")
 
 
+@ROUTER.post("/presigned", response_model=PresignedUploadResponse)
+def create_presigned_upload(request: PresignedUploadRequest) -> PresignedUploadResponse:
+    """
+    Get a presigned URL to upload a resource straight to the S3 bucket.
+
+    The file doesn't pass through the API, so its size is only limited by S3. The resource is
+    registered right away and is indexed as soon as the upload completes. The upload must match
+    the requested size, and the filename is attached to the object by the signature.
+    """
+    if request.size > SETTINGS.upload_max_size_bytes:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Files can be at most {SETTINGS.upload_max_size_bytes} bytes",
+        )
+    try:
+        resource_id = str(uuid.uuid4())
+        metadata = _get_object_metadata(request.filename, request.size)
+        expires_in = SETTINGS.presigned_upload_expiration_seconds
+        DOCUMENT_REGISTRY.register(resource_id, request.filename, request.size)
+        if request.method == "POST":
+            fields = {f"x-amz-meta-{key}": value for key, value in metadata.items()}
+            presigned = get_s3_client().generate_presigned_post(
+                Bucket=SETTINGS.s3_bucket_name,
+                Key=resource_id,
+                Fields=fields,
+                Conditions=[
+                    *({key: value} for key, value in fields.items()),
+                    ["content-length-range", request.size, request.size],
+                ],
+                ExpiresIn=expires_in,
+            )
+            return PresignedUploadResponse(
+                resource_id=resource_id,
+                method="POST",
+                url=presigned["url"],
+                fields=presigned["fields"],
+                expires_in=expires_in,
+            )
+        url = get_s3_client().generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": SETTINGS.s3_bucket_name,
+                "Key": resource_id,
+                "Metadata": metadata,
+                "ContentLength": request.size,
+            },
+            ExpiresIn=expires_in,
+        )
+        return PresignedUploadResponse(
+            resource_id=resource_id,
+            method="PUT",
+            url=url,
+            headers={f"x-amz-meta-{key}": value for key, value in metadata.items()},
+            expires_in=expires_in,
+        )
+    except Exception as e:
+        LOGGER.error(f"Failed to create presigned upload: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to create presigned upload")
+
+
+def _get_size(file: UploadFile) -> int:
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, 2)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+
+def _get_object_metadata(filename: str, size: int) -> Dict[str, str]:
+    # The same metadata whichever way the file is uploaded
+    return {"filename": filename, "size": str(size)}
+
+
 @ROUTER.delete("/{resource_id}", response_model=Dict[str, str])
-def delete_resource(resource_id: str = Path(..., title="The ID of the resource to delete")) -> Dict[str, str]:
+def delete_resource(
+    response: Response, resource_id: str = Path(..., title="The ID of the resource to delete")
+) -> Dict[str, str]:
     """
     Delete a resource from the S3 bucket.
 
     This endpoint deletes a resource from the S3 bucket. It first checks if the
-    resource's indexing is complete before allowing deletion.
+    resource's indexing has finished before allowing deletion: a resource that is
+    still indexing is a 409, one that is already being deleted is accepted with a 202.
     """
     try:
+        document = DOCUMENT_REGISTRY.get(resource_id)
+        if document is None:
+            raise HTTPException(status_code=404, detail="Resource not found")
         try:
-            response = S3_CLIENT.head_object(Bucket=SETTINGS.s3_bucket_name, Key=resource_id)
-            metadata = response.get("Metadata", {})
-            indexing_status = metadata.get("indexing_status")
-
-            if indexing_status != "COMPLETE":
-                return {"message": "Resource is still being indexed and cannot be deleted at this time"}
-
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "404":
+            # Conditional, so a concurrent indexing run or delete can't slip in between the check and the delete
+            DOCUMENT_REGISTRY.start_delete(resource_id)
+        except DocumentStateError:
+            # The status changed since it was read, the delete is answered by the current one
+            document = DOCUMENT_REGISTRY.get(resource_id)
+            if document is None:
                 raise HTTPException(status_code=404, detail="Resource not found")
-            else:
-                LOGGER.error(f"Error checking resource indexing status: {str(e)}")
-                raise HTTPException(status_code=500, detail="Failed to check resource indexing status")
+            if document.indexing_status == IndexingStatus.DELETING.value:
+                response.status_code = 202
+                return {resource_id: "Deleting"}
+            raise HTTPException(
+                status_code=409,
+                detail=f"Resource is {document.indexing_status} and cannot be deleted until its indexing finishes",
+            )
 
-        S3_CLIENT.delete_object(Bucket=SETTINGS.s3_bucket_name, Key=resource_id)
+        try:
+            get_s3_client().delete_object(Bucket=SETTINGS.s3_bucket_name, Key=resource_id)
+        except ClientError:
+            DOCUMENT_REGISTRY.cancel_delete(resource_id, document.indexing_status)
+            raise
+        # The indexer removes the document from the registry once its vectors are deleted
         return {resource_id: "Deleted"}
     except ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            raise HTTPException(status_code=404, detail="Resource not found")
-        else:
-            LOGGER.error(f"Error deleting resource: {str(e)}")
-            raise HTTPException(status_code=500, detail="Failed to delete resource")
+        LOGGER.error(f"Error deleting resource: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to delete resource")
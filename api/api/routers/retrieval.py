@@ -1,14 +1,15 @@
-from typing import Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 from pydantic import BaseModel, Field
 from fastapi import APIRouter, HTTPException, Body
+from fastapi.responses import StreamingResponse
 from aws_lambda_powertools import Logger
 
-from api.settings import Settings
+from api.settings import get_settings
 from api.services.retrieval import RETRIEVAL
 
 
-SETTINGS = Settings()  # type: ignore - pulled from the environment
+SETTINGS = get_settings()
 LOGGER = Logger(level=SETTINGS.log_level)
 
 module_name = __name__.rsplit(".", maxsplit=1)[-1].replace("_", "-")
@@ -30,7 +31,7 @@ class QueryRequest(BaseModel):
     minimum_threshold_override: Optional[float] = Field(
         None,
         title="Minimum threshold override",
-        description="An optional override for the minimum similarity threshold.",
+        description="An optional override for the minimum hybrid score, between -1 and 1.",
     )
 
 
@@ -46,10 +47,13 @@ class QueryResult(BaseModel):
         title="Relevance score",
         description="The relevance score of the document to the query.",
     )
-    metadata: Dict[str, str] = Field(
+    metadata: Dict[str, Any] = Field(
         ...,
         title="Document metadata",
-        description="Additional metadata associated with the document.",
+        description=(
+            "Additional metadata associated with the document, with the row of the document in `row_index` and every "
+            "document holding the same row in `document_ids`."
+        ),
     )
 
 
@@ -62,8 +66,36 @@ class QueryResponse(BaseModel):
     )
 
 
+class BatchQueryRequest(BaseModel):
+
+    queries: List[QueryRequest] = Field(
+        ...,
+        title="The queries",
+        description="The queries to run, identical queries are only run once.",
+    )
+
+
+class BatchQueryResult(BaseModel):
+
+    index: int = Field(
+        ...,
+        title="Query index",
+        description="The position of the query in the request.",
+    )
+    results: Optional[List[QueryResult]] = Field(
+        None,
+        title="Query results",
+        description="A list of documents that match the search query, missing if the query failed.",
+    )
+    error: Optional[str] = Field(
+        None,
+        title="Error",
+        description="Why the query failed, missing if the query succeeded.",
+    )
+
+
 @ROUTER.post("/query", response_model=QueryResponse)
-def query_documents(request: QueryRequest) -> QueryResponse:
+async def query_documents(request: QueryRequest) -> QueryResponse:
     """
     Query documents based on the provided search query.
 
@@ -72,7 +104,7 @@ def query_documents(request: QueryRequest) -> QueryResponse:
     and the minimum similarity threshold.
     """
     try:
-        results = RETRIEVAL.query(request.query, request.top_k_override, request.minimum_threshold_override)
+        results = await RETRIEVAL.query(request.query, request.top_k_override, request.minimum_threshold_override)
 
         return QueryResponse(
             results=[QueryResult(id=result.id, score=result.score, metadata=result.metadata) for result in results]
@@ -80,3 +112,38 @@ def query_documents(request: QueryRequest) -> QueryResponse:
     except Exception as e:
         LOGGER.error(f"Error during document query: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to query documents")
+
+
+@ROUTER.post(
+    "/query/batch",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+async def query_documents_batch(request: BatchQueryRequest) -> StreamingResponse:
+    """
+    Query documents for many search queries at once.
+
+    The results are streamed back as newline delimited JSON, one line per query in the
+    order of the request. A failed query is reported on its own line without failing
+    the rest of the batch.
+    """
+    if len(request.queries) > SETTINGS.retrieval_batch_max_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch can contain at most {SETTINGS.retrieval_batch_max_size} queries",
+        )
+    requests = [(query.query, query.top_k_override, query.minimum_threshold_override) for query in request.queries]
+    return StreamingResponse(_to_ndjson(RETRIEVAL.query_batch(requests)), media_type="application/x-ndjson")
+
+
+async def _to_ndjson(batch: AsyncIterator) -> AsyncIterator[str]:
+    async for index, results in batch:
+        if isinstance(results, Exception):
+            LOGGER.error(f"Error during batch document query {index}: {str(results)}")
+            line = BatchQueryResult(index=index, error="Failed to query documents")
+        else:
+            line = BatchQueryResult(
+                index=index,
+                results=[QueryResult(id=result.id, score=result.score, metadata=result.metadata) for result in results],
+            )
+        yield line.model_dump_json(exclude_none=True) + "\n"
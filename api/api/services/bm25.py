@@ -0,0 +1,146 @@
+import gzip
+import json
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError
+from vector_index.bm25 import decode_term_frequencies, term_index, tokenize
+
+from api.settings import Settings, get_settings
+from api.boto3_clients import get_s3_client
+
+
+logger = Logger()
+
+# Metadata written by the indexer for BM25 scoring, it is internal and is not returned to callers
+LEXICAL_METADATA_KEYS = ("term_frequencies", "token_count")
+
+
+@dataclass
+class CorpusStatistics:
+
+    num_vectors: int
+    average_length: float
+    document_frequencies: Dict[str, int]
+
+
+@dataclass
+class LexicalScores:
+
+    bm25: np.ndarray
+    term_overlap: np.ndarray
+
+
+class Bm25Scorer:
+    """Scores candidate vectors against a query with BM25 using the corpus statistics built by the indexer."""
+
+    def __init__(self, settings: Settings):
+        self.bucket_name = settings.artifact_bucket_name
+        self.corpus_key = "bm25/corpus.json.gz"
+        self.k1 = settings.bm25_k1
+        self.b = settings.bm25_b
+        self.refresh_seconds = settings.bm25_refresh_seconds
+        self._corpus: Optional[CorpusStatistics] = None
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def score(self, query: str, metadatas: Sequence[Dict[str, Any]]) -> LexicalScores:
+        """Score every candidate in one pass, returns raw BM25 scores and the fraction of query terms matched."""
+        return self.score_batch([query], metadatas, np.zeros(len(metadatas), dtype=np.intp))
+
+    def score_batch(
+        self, queries: Sequence[str], metadatas: Sequence[Dict[str, Any]], query_ids: np.ndarray
+    ) -> LexicalScores:
+        """Score the candidates of many queries in one pass, candidate `i` is scored against `queries[query_ids[i]]`."""
+        query_terms = [list(dict.fromkeys(tokenize(query))) for query in queries]
+        vocabulary = list(dict.fromkeys(term for terms in query_terms for term in terms))
+        if not vocabulary or not metadatas:
+            zeros = np.zeros(len(metadatas), dtype=np.float32)
+            return LexicalScores(bm25=zeros, term_overlap=zeros)
+        columns = {term: column for column, term in enumerate(vocabulary)}
+        query_columns = [[columns[term] for term in terms] for terms in query_terms]
+
+        # Each row only holds the frequencies of its own query's terms, the other columns stay zero
+        term_frequencies = np.zeros((len(metadatas), len(vocabulary)), dtype=np.float32)
+        lengths = np.zeros(len(metadatas), dtype=np.float32)
+        for row, (metadata, query_id) in enumerate(zip(metadatas, query_ids)):
+            frequencies, lengths[row] = self._get_term_frequencies(metadata)
+            term_frequencies[row, query_columns[query_id]] = [frequencies.get(term, 0) for term in query_terms[query_id]]
+
+        corpus = self.get_corpus()
+        if corpus is None or corpus.num_vectors == 0:
+            # Without corpus statistics the candidates are the best estimate of the corpus we have
+            num_vectors = len(metadatas)
+            average_length = float(lengths.mean()) or 1.0
+            document_frequencies = (term_frequencies > 0).sum(axis=0).astype(np.float32)
+        else:
+            num_vectors = corpus.num_vectors
+            average_length = corpus.average_length or 1.0
+            document_frequencies = np.array(
+                [corpus.document_frequencies.get(term, 0) for term in vocabulary], dtype=np.float32
+            )
+
+        # Clamped because a stale corpus can report more matches for a term than it has vectors
+        idf = np.maximum(np.log1p((num_vectors - document_frequencies + 0.5) / (document_frequencies + 0.5)), 0)
+        length_norm = self.k1 * (1 - self.b + self.b * lengths / average_length)
+        saturated = term_frequencies * (self.k1 + 1) / (term_frequencies + length_norm[:, None])
+        terms_per_query = np.array([len(terms) for terms in query_terms], dtype=np.float32)
+        term_overlap = (term_frequencies > 0).sum(axis=1) / np.maximum(terms_per_query[query_ids], 1)
+        return LexicalScores(bm25=saturated @ idf, term_overlap=term_overlap)
+
+    def encode_query(self, query: str) -> Dict[str, List]:
+        """
+        Encode a query as a sparse vector of the IDF of its terms.
+
+        The indexer stores the BM25 document-side weights, so the dot product with this vector is the BM25 score.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        corpus = self.get_corpus()
+        if corpus is None or corpus.num_vectors == 0:
+            # Every term weighs the same until the indexer has published corpus statistics
+            idf = [1.0] * len(terms)
+        else:
+            document_frequencies = np.array(
+                [corpus.document_frequencies.get(term, 0) for term in terms], dtype=np.float32
+            )
+            idf = np.maximum(
+                np.log1p((corpus.num_vectors - document_frequencies + 0.5) / (document_frequencies + 0.5)), 0
+            ).tolist()
+        weights: Dict[int, float] = {}
+        for term, weight in zip(terms, idf):
+            if weight > 0:
+                weights[term_index(term)] = weights.get(term_index(term), 0.0) + weight
+        return {"indices": list(weights), "values": list(weights.values())}
+
+    def _get_term_frequencies(self, metadata: Dict[str, Any]) -> Tuple[Dict[str, int], float]:
+        if encoded := metadata.get("term_frequencies"):
+            return decode_term_frequencies(encoded), float(metadata.get("token_count", 0))
+        # Vectors indexed before the statistics were precomputed only carry the raw text
+        tokens = tokenize(" ".join(str(metadata.get(key, "")) for key in ("question", "correct_answer", "support")))
+        return Counter(tokens), float(len(tokens))
+
+    def get_corpus(self) -> Optional[CorpusStatistics]:
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_seconds:
+                return self._corpus
+            try:
+                response = get_s3_client().get_object(Bucket=self.bucket_name, Key=self.corpus_key)
+                corpus = json.loads(gzip.decompress(response["Body"].read()))
+                self._corpus = CorpusStatistics(
+                    num_vectors=corpus["num_vectors"],
+                    average_length=corpus["average_length"],
+                    document_frequencies=corpus["document_frequencies"],
+                )
+                logger.info(f"Loaded BM25 corpus statistics for {self._corpus.num_vectors} vectors")
+            except ClientError as e:
+                logger.warning(f"BM25 corpus statistics are unavailable, scoring against the candidates: {str(e)}")
+            self._loaded_at = time.monotonic()
+            return self._corpus
+
+
+BM25_SCORER = Bm25Scorer(get_settings())
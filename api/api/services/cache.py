@@ -1,24 +1,44 @@
+import asyncio
 import time
-from typing import Any, Optional, Dict
+from functools import cached_property
+from typing import Any, Iterator, List, Optional, Dict
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
 from aws_lambda_powertools import Logger
-from api.settings import Settings
-import boto3
+from api.settings import Settings, get_settings
+from api.boto3_clients import get_dynamodb_resource
 
 logger = Logger()
 
 
 class CacheService:
 
+    # Partition and sort key of the time index, items are partitioned by the hour they were written in
+    written_hour_column_name = "written_hour"
+    written_at_column_name = "written_at"
+
     def __init__(self, settings: Settings):
         self.table_name = settings.cache_table_name
         self.ttl_column_name = settings.cache_table_ttl_column_name
-        self.dynamodb = boto3.resource("dynamodb")
-        self.table = self.dynamodb.Table(self.table_name)
+        self.time_index_name = settings.cache_table_time_index_name
         self._cache_value_key_name = "value"
         self._partition_key_column_name = settings.partition_key_column_name
 
-    def get(self, key: str) -> Optional[str]:
+    @cached_property
+    def table(self):
+        return get_dynamodb_resource().Table(self.table_name)
+
+    @property
+    def partition_key_column_name(self) -> str:
+        return self._partition_key_column_name
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: int, attributes: Optional[Dict[str, Any]] = None) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl, attributes)
+
+    def _get(self, key: str) -> Optional[str]:
         try:
             response = self.table.get_item(Key={self._partition_key_column_name: key})
 
@@ -40,14 +60,17 @@ class CacheService:
             logger.error(f"Error retrieving item from cache: {str(e)}")
             return None
 
-    def set(self, key: str, value: str, ttl: int) -> None:
+    def _set(self, key: str, value: str, ttl: int, attributes: Optional[Dict[str, Any]] = None) -> None:
         try:
-            expiration_time = int(time.time()) + ttl
+            now = int(time.time())
 
             item = {
+                **(attributes or {}),
                 self._cache_value_key_name: value,
                 self._partition_key_column_name: key,
-                self.ttl_column_name: expiration_time,
+                self.ttl_column_name: now + ttl,
+                self.written_hour_column_name: str(now // 3600),
+                self.written_at_column_name: now,
             }
 
             self.table.put_item(Item=item)
@@ -56,5 +79,43 @@ class CacheService:
         except ClientError as e:
             logger.error(f"Error setting item in cache: {str(e)}")
 
+    def query_written_since(self, since: int, attribute_names: List[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the key, ttl, write time and the requested attributes of every unexpired item written after `since`
+        that has all of the attributes.
+
+        Queries the time index one hour partition at a time, so the cost is proportional to the number of items
+        written since then rather than to the size of the table.
+        """
+        now = int(time.time())
+        columns = [
+            self._partition_key_column_name,
+            self.ttl_column_name,
+            self.written_at_column_name,
+            *attribute_names,
+        ]
+        names = {f"#c{i}": column for i, column in enumerate(columns)}
+        condition = Attr(self.ttl_column_name).gt(now)
+        for attribute_name in attribute_names:
+            condition = condition & Attr(attribute_name).exists()
+        try:
+            for hour in range(since // 3600, now // 3600 + 1):
+                kwargs: Dict[str, Any] = {
+                    "IndexName": self.time_index_name,
+                    "KeyConditionExpression": Key(self.written_hour_column_name).eq(str(hour))
+                    & Key(self.written_at_column_name).gt(since),
+                    "ProjectionExpression": ", ".join(names),
+                    "ExpressionAttributeNames": names,
+                    "FilterExpression": condition,
+                }
+                while True:
+                    response = self.table.query(**kwargs)
+                    yield from response.get("Items", [])
+                    if "LastEvaluatedKey" not in response:
+                        break
+                    kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except ClientError as e:
+            logger.error(f"Error querying cache: {str(e)}")
+
 
-CACHE_SERVICE = CacheService(Settings())  # type: ignore - pulled from the environment
+CACHE_SERVICE = CacheService(get_settings())
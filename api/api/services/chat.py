@@ -1,14 +1,17 @@
+import asyncio
+import hashlib
 import json
-from typing import List, Dict, Any, Optional, Tuple
+from typing import AsyncIterator, Iterator, List, Dict, Any, Literal, Optional, Tuple
 
 import numpy as np
 from aws_lambda_powertools import Logger
 from pydantic import BaseModel
 
-from api.settings import Settings
-from api.boto3_clients import BEDROCK_CLIENT
+from api.settings import Settings, get_settings
+from api.boto3_clients import get_bedrock_client
 from api.services.retrieval import RETRIEVAL, QueryResult
 from api.services.cache import CACHE_SERVICE
+from api.services.semantic_cache import SEMANTIC_CACHE
 
 logger = Logger()
 
@@ -19,36 +22,140 @@ class ChatResponse(BaseModel):
     relevancy: float
 
 
+class CachedChatResponse(ChatResponse):
+
+    supporting_docs: List[QueryResult]
+
+
+class ChatStreamEvent(BaseModel):
+
+    event: Literal["supporting_docs", "token", "relevancy", "error"]
+    supporting_docs: Optional[List[QueryResult]] = None
+    text: Optional[str] = None
+    relevancy: Optional[float] = None
+
+
 class ChatService:
 
     def __init__(self, settings: Settings):
         self.settings = settings
         self.model_id = settings.chat_model_id
-        self._cache_ttl = 15
+        self._cache_ttl = settings.chat_cache_ttl_seconds
 
-    def generate_response(
+    async def generate_response(
         self,
         query: str,
         retrieve_top_k_override: Optional[int] = None,
         minimum_threshold_override: Optional[float] = None,
     ) -> Tuple[ChatResponse, List[QueryResult]]:
-        relevant_docs = RETRIEVAL.query(query, retrieve_top_k_override, minimum_threshold_override)
-        if cache_val := CACHE_SERVICE.get(query):
-            logger.info(f"Cache hit for query: {query}")
-            return ChatResponse.model_validate_json(cache_val), relevant_docs
+        cache_scope = self._get_cache_scope(retrieve_top_k_override, minimum_threshold_override)
+        cache_key = self._get_cache_key(query, cache_scope)
+        cached, query_embedding = await self._lookup_cache(query, cache_scope, cache_key)
+        if cached:
+            return ChatResponse(response=cached.response, relevancy=cached.relevancy), cached.supporting_docs
+        relevant_docs = await RETRIEVAL.query(query, retrieve_top_k_override, minimum_threshold_override)
         context = self._prepare_context(relevant_docs)
         prompt = self._prepare_prompt(query, context)
-        response = self._generate_bedrock_response(prompt)
-        relevancy = self._get_chat_relevancy(response, query)
-        chat_response = ChatResponse(response=response, relevancy=relevancy)
-        CACHE_SERVICE.set(query, chat_response.model_dump_json(), self._cache_ttl)
+        response = await asyncio.to_thread(self._generate_bedrock_response, prompt)
+        relevancy = await self._get_chat_relevancy(response, query)
+        cached = CachedChatResponse(response=response, relevancy=relevancy, supporting_docs=relevant_docs)
+        await self._cache_response(cache_scope, cache_key, query_embedding, cached)
         return ChatResponse(response=response, relevancy=relevancy), relevant_docs
 
-    def _get_chat_relevancy(self, response: str, query: str) -> float:
-        response_embedding = RETRIEVAL.get_embedding(response)
-        query_embedding = RETRIEVAL.get_embedding(query)
+    async def stream_response(
+        self,
+        query: str,
+        retrieve_top_k_override: Optional[int] = None,
+        minimum_threshold_override: Optional[float] = None,
+    ) -> AsyncIterator[ChatStreamEvent]:
+        """Same as `generate_response`, but yields the supporting docs first, then the tokens and the relevancy last."""
+        cache_scope = self._get_cache_scope(retrieve_top_k_override, minimum_threshold_override)
+        cache_key = self._get_cache_key(query, cache_scope)
+        cached, query_embedding = await self._lookup_cache(query, cache_scope, cache_key)
+        if cached:
+            yield ChatStreamEvent(event="supporting_docs", supporting_docs=cached.supporting_docs)
+            yield ChatStreamEvent(event="token", text=cached.response)
+            yield ChatStreamEvent(event="relevancy", relevancy=cached.relevancy)
+            return
+        relevant_docs = await RETRIEVAL.query(query, retrieve_top_k_override, minimum_threshold_override)
+        yield ChatStreamEvent(event="supporting_docs", supporting_docs=relevant_docs)
+        context = self._prepare_context(relevant_docs)
+        prompt = self._prepare_prompt(query, context)
+        response_parts = []
+        chunks = self._stream_bedrock_response(prompt)
+        while (text := await asyncio.to_thread(next, chunks, None)) is not None:
+            response_parts.append(text)
+            yield ChatStreamEvent(event="token", text=text)
+        response = "".join(response_parts)
+        relevancy = await self._get_chat_relevancy(response, query)
+        # Cached as soon as the generation completes rather than after the client consumed the last frame, and shielded
+        # so a client that disconnects meanwhile doesn't cancel the write
+        cached = CachedChatResponse(response=response, relevancy=relevancy, supporting_docs=relevant_docs)
+        await asyncio.shield(self._cache_response(cache_scope, cache_key, query_embedding, cached))
+        yield ChatStreamEvent(event="relevancy", relevancy=relevancy)
+
+    async def _lookup_cache(
+        self, query: str, cache_scope: str, cache_key: str
+    ) -> Tuple[Optional[CachedChatResponse], Optional[np.ndarray]]:
+        """
+        Probe the exact key, then the semantic cache. The query is only embedded once the exact probe missed, a Bedrock
+        call running in a thread can't be cancelled so starting it early would pay for it on every exact hit.
+        """
+        if cached := await self._get_cached_response(cache_key):
+            logger.info(f"Cache hit for query: {query}")
+            return cached, None
+        query_embedding = await RETRIEVAL.get_embedding(query)
+        similar_key = await asyncio.to_thread(SEMANTIC_CACHE.lookup, cache_scope, query_embedding)
+        if similar_key and (cached := await self._get_cached_response(similar_key)):
+            logger.info(f"Semantic cache hit for query: {query}")
+            return cached, query_embedding
+        return None, query_embedding
+
+    async def _cache_response(
+        self, cache_scope: str, cache_key: str, query_embedding: np.ndarray, cached: CachedChatResponse
+    ) -> None:
+        await CACHE_SERVICE.set(
+            cache_key,
+            cached.model_dump_json(),
+            self._cache_ttl,
+            attributes=SEMANTIC_CACHE.get_attributes(cache_scope, query_embedding),
+        )
+        SEMANTIC_CACHE.add(cache_scope, cache_key, query_embedding, self._cache_ttl)
+
+    async def _get_cached_response(self, cache_key: str) -> Optional[CachedChatResponse]:
+        if cache_val := await CACHE_SERVICE.get(cache_key):
+            return CachedChatResponse.model_validate_json(cache_val)
+        return None
+
+    def _get_cache_scope(
+        self,
+        retrieve_top_k_override: Optional[int],
+        minimum_threshold_override: Optional[float],
+    ) -> str:
+        # Every input besides the query that can change the answer has to be part of the scope, otherwise overrides
+        # would be served answers generated with different retrieval parameters
+        canonical = json.dumps(
+            {
+                "retrieve_top_k_override": retrieve_top_k_override,
+                "minimum_threshold_override": minimum_threshold_override,
+                "chat_model_id": self.model_id,
+                "embedding_model_id": self.settings.embedding_model_id,
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _get_cache_key(self, query: str, cache_scope: str) -> str:
+        canonical = json.dumps({"query": " ".join(query.split()), "scope": cache_scope}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def _get_chat_relevancy(self, response: str, query: str) -> float:
+        response_embedding, query_embedding = await asyncio.gather(
+            RETRIEVAL.get_embedding(response), RETRIEVAL.get_embedding(query)
+        )
         similarity = np.dot(response_embedding, query_embedding) / (np.linalg.norm(response_embedding) * np.linalg.norm(query_embedding))
-        return similarity
+        return float(similarity)
 
     def _prepare_context(self, relevant_docs: List[QueryResult]) -> str:
         context_parts = []
@@ -81,15 +188,8 @@ class ChatService:
 
     def _generate_bedrock_response(self, prompt: str) -> str:
         try:
-            body = {
-                "prompt": prompt,
-                "max_gen_len": 500,
-                "temperature": 0.4,
-                "top_p": 0.9,
-            }
-
-            response = BEDROCK_CLIENT.invoke_model(
-                body=json.dumps(body),
+            response = get_bedrock_client().invoke_model(
+                body=json.dumps(self._get_generation_body(prompt)),
                 modelId=self.model_id,
                 accept="application/json",
                 contentType="application/json"
@@ -102,5 +202,34 @@ class ChatService:
             logger.error(f"Error generating response from Bedrock: {str(e)}")
             raise
 
+    def _stream_bedrock_response(self, prompt: str) -> Iterator[str]:
+        try:
+            response = get_bedrock_client().invoke_model_with_response_stream(
+                body=json.dumps(self._get_generation_body(prompt)),
+                modelId=self.model_id,
+                accept="application/json",
+                contentType="application/json",
+            )
+
+            for event in response["body"]:
+                if "chunk" not in event:
+                    # Errors that happen mid-stream are delivered as events instead of being raised by the client
+                    raise RuntimeError(f"Unexpected event in Bedrock response stream: {event}")
+                chunk = json.loads(event["chunk"]["bytes"])
+                if generation := chunk.get("generation"):
+                    yield generation
+
+        except Exception as e:
+            logger.error(f"Error streaming response from Bedrock: {str(e)}")
+            raise
+
+    def _get_generation_body(self, prompt: str) -> Dict[str, Any]:
+        return {
+            "prompt": prompt,
+            "max_gen_len": 500,
+            "temperature": 0.4,
+            "top_p": 0.9,
+        }
+
 # Initialize the ChatService
-CHAT_SERVICE = ChatService(Settings())  # type: ignore - pulled from the environment
+CHAT_SERVICE = ChatService(get_settings())
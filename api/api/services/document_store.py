@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Any, DefaultDict, Dict, List, Optional, Sequence, Tuple
+
+from aws_lambda_powertools import Logger
+from vector_index.document_store import STORED_COLUMNS
+
+from api.boto3_clients import get_s3_client
+from api.settings import Settings, get_settings
+
+
+logger = Logger()
+
+RowKey = Tuple[str, int]
+
+
+class DocumentStore:
+    """
+    Text and BM25 statistics of the indexed rows by document and row, for hydrating the results of a query.
+
+    The indexer writes every loaded chunk of a document as a SQLite file to the artifact bucket. A part is downloaded
+    the first time one of its rows is needed, named by its ETag so a rewritten part is fetched again, and read through
+    a memory map. The parts of a document are listed again after `refresh_seconds`.
+    """
+
+    def __init__(self, settings: Settings):
+        self.bucket_name = settings.artifact_bucket_name
+        self.part_prefix = "document-store/documents/"
+        self.cache_path = Path(settings.document_store_cache_path)
+        self.cache_max_bytes = settings.document_store_cache_max_bytes
+        self.refresh_seconds = settings.document_store_refresh_seconds
+        # First row, key and ETag of the parts of a document, in row order
+        self._parts: Dict[str, Tuple[float, List[Tuple[int, str, str]]]] = {}
+        self._files: "OrderedDict[Path, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Sequence[RowKey]) -> Dict[RowKey, Dict[str, Any]]:
+        """The stored rows of `keys` in one lookup per part, rows that aren't stored are left out."""
+        rows_by_part: DefaultDict[Tuple[str, str, str], List[int]] = defaultdict(list)
+        for document_id, row_index in keys:
+            if (part := self._find_part(document_id, row_index)) is not None:
+                rows_by_part[(document_id, *part)].append(row_index)
+        if not rows_by_part:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(len(rows_by_part), 8)) as executor:
+            results = executor.map(lambda item: self._read(*item[0], item[1]), rows_by_part.items())
+            return {key: row for rows in results for key, row in rows.items()}
+
+    def _find_part(self, document_id: str, row_index: int) -> Optional[Tuple[str, str]]:
+        # The last part starting at or before the row, a row that was collapsed into another vector isn't in it
+        found = None
+        for start_row, key, etag in self._get_parts(document_id):
+            if start_row > row_index:
+                break
+            found = (key, etag)
+        return found
+
+    def _get_parts(self, document_id: str) -> List[Tuple[int, str, str]]:
+        with self._lock:
+            cached = self._parts.get(document_id)
+        if cached is not None and time.monotonic() - cached[0] < self.refresh_seconds:
+            return cached[1]
+        prefix = f"{self.part_prefix}{document_id}/"
+        parts = []
+        paginator = get_s3_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for item in page.get("Contents", []):
+                name = item["Key"][len(prefix) :]
+                # The prefix also matches the parts of documents nested under this document's key
+                if "/" not in name:
+                    parts.append((int(name[: -len(".sqlite")]), item["Key"], item["ETag"].strip('"')))
+        parts.sort()
+        with self._lock:
+            self._parts[document_id] = (time.monotonic(), parts)
+        return parts
+
+    def _read(self, document_id: str, key: str, etag: str, row_indexes: List[int]) -> Dict[RowKey, Dict[str, Any]]:
+        path = self._download(key, etag)
+        uri = f"{path.as_uri()}?mode=ro&immutable=1"
+        with closing(sqlite3.connect(uri, uri=True)) as connection:
+            connection.execute(f"PRAGMA mmap_size = {path.stat().st_size}")
+            placeholders = ", ".join("?" * len(row_indexes))
+            cursor = connection.execute(
+                f"SELECT row_index, {', '.join(STORED_COLUMNS)} FROM rows WHERE row_index IN ({placeholders})",
+                row_indexes,
+            )
+            return {
+                (document_id, row[0]): {
+                    **dict(zip(STORED_COLUMNS, row[1:])),
+                    "document_id": document_id,
+                    "row_index": row[0],
+                }
+                for row in cursor
+            }
+
+    def _download(self, key: str, etag: str) -> Path:
+        path = self.cache_path / f"{etag}.sqlite"
+        with self._lock:
+            if path in self._files and path.exists():
+                self._files.move_to_end(path)
+                return path
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_suffix(f".{threading.get_ident()}.tmp")
+        get_s3_client().download_file(self.bucket_name, key, str(temporary))
+        os.replace(temporary, path)
+        with self._lock:
+            self._files[path] = path.stat().st_size
+            # Least recently read parts are removed first, /tmp is shared with the rest of the container
+            while sum(self._files.values()) > self.cache_max_bytes and len(self._files) > 1:
+                evicted, _ = self._files.popitem(last=False)
+                evicted.unlink(missing_ok=True)
+        return path
+
+
+DOCUMENT_STORE = DocumentStore(get_settings())
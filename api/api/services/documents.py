@@ -0,0 +1,270 @@
+import base64
+import json
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import cached_property
+from typing import Any, Dict, Iterator, List, Optional
+
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from pydantic import BaseModel
+from aws_lambda_powertools import Logger
+from vector_index.documents import DocumentStateError, IndexingStatus, LocalDocumentFile
+
+from api.settings import DocumentRegistryBackend, Settings, get_settings
+from api.boto3_clients import get_dynamodb_resource
+
+
+logger = Logger()
+
+
+# Indexing has finished one way or another, the document can be deleted
+DELETABLE_STATUSES = (IndexingStatus.COMPLETE, IndexingStatus.FAILED)
+
+
+class DocumentRecord(BaseModel):
+
+    document_id: str
+    filename: str
+    size: int
+    indexing_status: str
+    created_at: str
+    updated_at: str
+    indexed_at: Optional[str] = None
+    row_count: Optional[int] = None
+    vector_count: Optional[int] = None
+    error: Optional[str] = None
+
+
+class DocumentPage(BaseModel):
+
+    documents: List[DocumentRecord]
+    next_cursor: Optional[str] = None
+
+
+class DocumentRegistry(ABC):
+    """
+    Per-document indexing state, so listing and status checks don't need a HEAD request per S3 object.
+
+    Every status change is a conditional write, two writers can't both move a document out of the same state.
+    """
+
+    @abstractmethod
+    def register(self, document_id: str, filename: str, size: int) -> DocumentRecord: ...
+
+    @abstractmethod
+    def get(self, document_id: str) -> Optional[DocumentRecord]: ...
+
+    @abstractmethod
+    def remove(self, document_id: str) -> None: ...
+
+    @abstractmethod
+    def start_delete(self, document_id: str) -> None:
+        """Mark a document as being deleted, raises `DocumentStateError` unless indexing has finished."""
+
+    @abstractmethod
+    def cancel_delete(self, document_id: str, indexing_status: str) -> None: ...
+
+    @abstractmethod
+    def list_page(
+        self, limit: int, cursor: Optional[str] = None, indexing_status: Optional[str] = None
+    ) -> DocumentPage: ...
+
+    def iter_all(self, indexing_status: Optional[str] = None, page_size: int = 1000) -> Iterator[DocumentRecord]:
+        cursor = None
+        while True:
+            page = self.list_page(page_size, cursor, indexing_status)
+            yield from page.documents
+            if not (cursor := page.next_cursor):
+                return
+
+    def _new_record(self, document_id: str, filename: str, size: int) -> DocumentRecord:
+        now = datetime.now(timezone.utc).isoformat()
+        return DocumentRecord(
+            document_id=document_id,
+            filename=filename,
+            size=size,
+            indexing_status=IndexingStatus.PENDING.value,
+            created_at=now,
+            updated_at=now,
+        )
+
+    def _encode_cursor(self, last_key: Dict[str, Any]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(last_key, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+    def _decode_cursor(self, cursor: str, fields: Dict[str, type]) -> Dict[str, Any]:
+        """Decode a cursor, raises `ValueError` unless it is an object of exactly `fields` with values of their types."""
+        try:
+            decoded = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        except ValueError as e:
+            raise ValueError("Invalid cursor") from e
+        # Checked on the exact type, a bool is an int too
+        if (
+            not isinstance(decoded, dict)
+            or decoded.keys() != fields.keys()
+            or any(type(decoded[key]) is not type_ for key, type_ in fields.items())
+        ):
+            raise ValueError("Invalid cursor")
+        return decoded
+
+
+class DynamoDbDocumentRegistry(DocumentRegistry):
+    """
+    The registry in a DynamoDB table.
+
+    The status index is partitioned by indexing status and sorted by creation time, a listing filtered on a status is a
+    single query per page.
+    """
+
+    def __init__(self, settings: Settings):
+        self.table_name = settings.documents_table_name
+        self.status_index_name = settings.documents_status_index_name
+
+    @cached_property
+    def table(self):
+        return get_dynamodb_resource().Table(self.table_name)
+
+    def register(self, document_id: str, filename: str, size: int) -> DocumentRecord:
+        record = self._new_record(document_id, filename, size)
+        with self._conditional(document_id):
+            self.table.put_item(
+                Item=record.model_dump(exclude_none=True),
+                ConditionExpression=Attr("document_id").not_exists(),
+            )
+        return record
+
+    def get(self, document_id: str) -> Optional[DocumentRecord]:
+        item = self.table.get_item(Key={"document_id": document_id}, ConsistentRead=True).get("Item")
+        return self._to_record(item) if item else None
+
+    def remove(self, document_id: str) -> None:
+        self.table.delete_item(Key={"document_id": document_id})
+
+    def start_delete(self, document_id: str) -> None:
+        self._set_status(
+            document_id,
+            IndexingStatus.DELETING,
+            Attr("indexing_status").is_in([status.value for status in DELETABLE_STATUSES]),
+        )
+
+    def cancel_delete(self, document_id: str, indexing_status: str) -> None:
+        self._set_status(document_id, indexing_status, Attr("indexing_status").eq(IndexingStatus.DELETING.value))
+
+    def list_page(
+        self, limit: int, cursor: Optional[str] = None, indexing_status: Optional[str] = None
+    ) -> DocumentPage:
+        kwargs: Dict[str, Any] = {"Limit": limit}
+        if cursor:
+            # The last evaluated key of the status index also holds the index keys
+            fields: Dict[str, type] = {"document_id": str}
+            if indexing_status:
+                fields.update(indexing_status=str, created_at=str)
+            kwargs["ExclusiveStartKey"] = self._decode_cursor(cursor, fields)
+            if indexing_status and kwargs["ExclusiveStartKey"]["indexing_status"] != indexing_status:
+                raise ValueError("Invalid cursor")
+        if indexing_status:
+            response = self.table.query(
+                IndexName=self.status_index_name,
+                KeyConditionExpression=Key("indexing_status").eq(indexing_status),
+                ScanIndexForward=False,
+                **kwargs,
+            )
+        else:
+            response = self.table.scan(**kwargs)
+        last_key = response.get("LastEvaluatedKey")
+        return DocumentPage(
+            documents=[self._to_record(item) for item in response.get("Items", [])],
+            next_cursor=self._encode_cursor(last_key) if last_key else None,
+        )
+
+    def _set_status(self, document_id: str, indexing_status: str, condition: Any) -> None:
+        with self._conditional(document_id):
+            self.table.update_item(
+                Key={"document_id": document_id},
+                UpdateExpression="SET indexing_status = :status, updated_at = :updated_at",
+                ConditionExpression=condition,
+                ExpressionAttributeValues={
+                    ":status": IndexingStatus(indexing_status).value,
+                    ":updated_at": datetime.now(timezone.utc).isoformat(),
+                },
+            )
+
+    @contextmanager
+    def _conditional(self, document_id: str) -> Iterator[None]:
+        try:
+            yield
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                raise DocumentStateError(f"Document '{document_id}' can't be changed in its current state") from e
+            raise
+
+    def _to_record(self, item: Dict[str, Any]) -> DocumentRecord:
+        # DynamoDB returns numbers as Decimal
+        counts = {key: int(item[key]) for key in ("size", "row_count", "vector_count") if key in item}
+        return DocumentRecord(**{**item, **counts})
+
+
+class LocalDocumentRegistry(LocalDocumentFile, DocumentRegistry):
+    """The registry in a JSON file shared with the indexer, for running without DynamoDB."""
+
+    def register(self, document_id: str, filename: str, size: int) -> DocumentRecord:
+        record = self._new_record(document_id, filename, size)
+        with self._documents() as documents:
+            if document_id in documents:
+                raise DocumentStateError(f"Document '{document_id}' already exists")
+            documents[document_id] = record.model_dump(exclude_none=True)
+        return record
+
+    def get(self, document_id: str) -> Optional[DocumentRecord]:
+        with self._documents(write=False) as documents:
+            item = documents.get(document_id)
+        return DocumentRecord(**item) if item else None
+
+    def remove(self, document_id: str) -> None:
+        with self._documents() as documents:
+            documents.pop(document_id, None)
+
+    def start_delete(self, document_id: str) -> None:
+        self._set_status(document_id, IndexingStatus.DELETING, DELETABLE_STATUSES)
+
+    def cancel_delete(self, document_id: str, indexing_status: str) -> None:
+        self._set_status(document_id, indexing_status, (IndexingStatus.DELETING,))
+
+    def list_page(
+        self, limit: int, cursor: Optional[str] = None, indexing_status: Optional[str] = None
+    ) -> DocumentPage:
+        with self._documents(write=False) as documents:
+            items = list(documents.values())
+        if indexing_status:
+            items = sorted(
+                (item for item in items if item["indexing_status"] == indexing_status),
+                key=lambda item: (item["created_at"], item["document_id"]),
+                reverse=True,
+            )
+        offset = self._decode_cursor(cursor, {"offset": int})["offset"] if cursor else 0
+        if offset < 0:
+            raise ValueError("Invalid cursor")
+        page = items[offset : offset + limit]
+        has_more = offset + limit < len(items)
+        return DocumentPage(
+            documents=[DocumentRecord(**item) for item in page],
+            next_cursor=self._encode_cursor({"offset": offset + limit}) if has_more else None,
+        )
+
+    def _set_status(self, document_id: str, indexing_status: str, allowed: tuple) -> None:
+        with self._documents() as documents:
+            item = documents.get(document_id)
+            if item is None or item["indexing_status"] not in allowed:
+                raise DocumentStateError(f"Document '{document_id}' can't be changed in its current state")
+            item["indexing_status"] = IndexingStatus(indexing_status).value
+            item["updated_at"] = datetime.now(timezone.utc).isoformat()
+
+
+def get_document_registry(settings: Settings) -> DocumentRegistry:
+    if settings.document_registry_backend == DocumentRegistryBackend.LOCAL:
+        return LocalDocumentRegistry(settings.local_document_registry_path)
+    return DynamoDbDocumentRegistry(settings)
+
+
+DOCUMENT_REGISTRY = get_document_registry(get_settings())
@@ -0,0 +1,75 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from aws_lambda_powertools import Logger
+
+from api.settings import Settings, get_settings
+
+
+logger = Logger()
+
+
+class EmbeddingCache:
+    """Bounded LRU + TTL cache of embeddings that lives for the lifetime of the Lambda container."""
+
+    def __init__(self, settings: Settings):
+        self.max_size = settings.embedding_cache_max_size
+        self.ttl = settings.embedding_cache_ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text: str, model_id: str) -> Optional[np.ndarray]:
+        key = self._key(text, model_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, embedding = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def set(self, text: str, model_id: str, embedding: Union[Sequence[float], np.ndarray]) -> np.ndarray:
+        value = np.asarray(embedding, dtype=np.float32)
+        value.setflags(write=False)
+        key = self._key(text, model_id)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _key(self, text: str, model_id: str) -> Tuple[str, str]:
+        # Whitespace and unicode form don't change the meaning of the text, so they shouldn't change the key either
+        normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+        return model_id, normalized
+
+
+EMBEDDING_CACHE = EmbeddingCache(get_settings())
@@ -1,15 +1,18 @@
-import math
-from typing import Counter, List, Dict, Any, Optional
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Dict, Any, Optional, Sequence, Tuple, Union
 import json
 
 import numpy as np
 from pydantic import BaseModel
-import pinecone
 from aws_lambda_powertools import Logger
-from aws_lambda_powertools.utilities.parameters import get_secret
 
-from api.settings import Settings
-from api.boto3_clients import BEDROCK_CLIENT
+from api.settings import Settings, get_settings
+from api.boto3_clients import get_bedrock_client
+from api.services.embedding_cache import EMBEDDING_CACHE
+from api.services.bm25 import BM25_SCORER, LEXICAL_METADATA_KEYS
+from api.services.document_store import DOCUMENT_STORE
+from api.services.vector_store import get_vector_store
 
 
 logger = Logger()
@@ -25,55 +28,145 @@ class QueryResult(BaseModel):
 class Retrieval:
 
     def __init__(self, settings: Settings):
-        self.index_name = settings.pinecone_host_name
         self._model_id = settings.embedding_model_id
-        api_key = get_secret(settings.pinecone_api_key_secret_name)
-
-        self.index = pinecone.Index(
-            api_key=api_key,
-            host=settings.pinecone_host_name,
-        )
-
         self.top_k = settings.retrieval_top_k  # Assume this is set in your Settings class
         self.min_score = settings.retrieval_min_score  # Minimum similarity score to consider
-
-    def query(
+        self.batch_concurrency = settings.retrieval_batch_concurrency
+        self.batch_window_size = settings.retrieval_batch_window_size
+        self.hybrid_alpha = settings.hybrid_alpha
+        self.vector_store = get_vector_store(settings, connection_pool_maxsize=self.batch_concurrency)
+        # Dedicated to batch queries so they can't starve the default executor used by the other requests
+        self._batch_executor = ThreadPoolExecutor(max_workers=self.batch_concurrency, thread_name_prefix="retrieval-batch")
+
+    async def query(
         self,
         query: str,
         retrieval_top_k_override: Optional[int] = None,
         minimum_threshold_override: Optional[float] = None,
     ) -> List[QueryResult]:
-        query_embedding = self.get_embedding(query)
-        initial_results = self._query(query_embedding, retrieval_top_k_override, minimum_threshold_override)
-        reranked_results = self._rerank(query, initial_results)
-        return reranked_results
+        query_embedding = await self.get_embedding(query)
+        initial_results = await asyncio.to_thread(
+            self._query, query, query_embedding, retrieval_top_k_override, minimum_threshold_override
+        )
+        return self._rerank(query, initial_results)
+
+    async def query_batch(
+        self, requests: Sequence[Tuple[str, Optional[int], Optional[float]]]
+    ) -> AsyncIterator[Tuple[int, Union[List[QueryResult], Exception]]]:
+        """
+        Run many `(query, top_k_override, minimum_threshold_override)` requests, yielding `(index, results)` in input order.
+
+        Identical requests are only run once. The unique requests are processed in windows: each window is embedded and
+        queried concurrently and reranked in one pass, and results are yielded as soon as every earlier request is done.
+        A request that fails yields its exception instead of failing the batch.
+        """
+        unique_requests: Dict[Tuple[str, Optional[int], Optional[float]], int] = {}
+        positions = []
+        for query, top_k_override, threshold_override in requests:
+            key = (" ".join(query.split()), top_k_override, threshold_override)
+            positions.append(unique_requests.setdefault(key, len(unique_requests)))
+        logger.info(f"Running batch of {len(requests)} queries, {len(unique_requests)} unique")
+
+        windows = list(unique_requests)
+        results: Dict[int, Union[List[QueryResult], Exception]] = {}
+        next_index = 0
+        for start in range(0, len(windows), self.batch_window_size):
+            window = windows[start : start + self.batch_window_size]
+            results.update(enumerate(await self._query_window(window), start=start))
+            while next_index < len(positions) and positions[next_index] in results:
+                yield next_index, results[positions[next_index]]
+                next_index += 1
+
+    async def _query_window(
+        self, window: List[Tuple[str, Optional[int], Optional[float]]]
+    ) -> List[Union[List[QueryResult], Exception]]:
+        loop = asyncio.get_running_loop()
+        texts = list(dict.fromkeys(query for query, _, _ in window))
+        embeddings = dict(
+            zip(
+                texts,
+                await asyncio.gather(
+                    *(
+                        loop.run_in_executor(self._batch_executor, self._get_cached_embedding, text)
+                        for text in texts
+                    ),
+                    return_exceptions=True,
+                ),
+            )
+        )
 
-    def get_embedding(self, query: str) -> List[float]:
+        async def query(
+            request: Tuple[str, Optional[int], Optional[float]]
+        ) -> Union[List[QueryResult], Exception]:
+            embedding = embeddings[request[0]]
+            if isinstance(embedding, Exception):
+                return embedding
+            return await loop.run_in_executor(
+                self._batch_executor, self._query, request[0], embedding, request[1], request[2]
+            )
+
+        initial_results = await asyncio.gather(*(query(request) for request in window), return_exceptions=True)
+        succeeded = [i for i, result in enumerate(initial_results) if not isinstance(result, BaseException)]
+        reranked = self._rerank_batch([window[i][0] for i in succeeded], [initial_results[i] for i in succeeded])
+        window_results: List[Union[List[QueryResult], Exception]] = list(initial_results)
+        for i, results in zip(succeeded, reranked):
+            window_results[i] = results
+        return window_results
+
+    async def get_embedding(self, query: str) -> np.ndarray:
+        if (cached := EMBEDDING_CACHE.get(query, self._model_id)) is not None:
+            return cached
+        return await asyncio.to_thread(self._get_embedding, query)
+
+    async def warm_up(self) -> None:
+        """Open the Bedrock connection, the embedding cache is bypassed as a cached embedding wouldn't touch it."""
+        await asyncio.to_thread(self._get_embedding, "warm up")
+
+    def _get_cached_embedding(self, query: str) -> np.ndarray:
+        if (cached := EMBEDDING_CACHE.get(query, self._model_id)) is not None:
+            return cached
+        return self._get_embedding(query)
+
+    def _get_embedding(self, query: str) -> np.ndarray:
         body = {
             "inputText": query,
         }
-        response = BEDROCK_CLIENT.invoke_model(
+        response = get_bedrock_client().invoke_model(
             body=json.dumps(body),
             contentType="application/json",
             accept="*/*",
             modelId=self._model_id,
         )
         response_body = json.loads(response.get("body").read())
-        embedding = response_body["embedding"]
-        return embedding
+        return EMBEDDING_CACHE.set(query, self._model_id, response_body["embedding"])
 
     def _query(
         self,
-        query_vector: List[float],
+        query: str,
+        query_vector: np.ndarray,
         retrieval_top_k_override: Optional[int] = None,
         minimum_threshold_override: Optional[float] = None,
     ) -> List[QueryResult]:
-        logger.info(f"Querying Pinecone index '{self.index_name}'")
-
-        results = self.index.query(vector=query_vector, top_k=retrieval_top_k_override or self.top_k, include_metadata=True)
+        logger.info(f"Querying {type(self.vector_store).__name__}")
+
+        # Convex combination of two scores on the same scale: alpha weighs the dense cosine similarity, the rest the
+        # sparse score. The document side BM25 weights saturate below k1 + 1, so scaling the query IDF weights to sum
+        # to 1 / (k1 + 1) makes the sparse score an IDF weighted average of saturated term frequencies in [0, 1).
+        norm = np.linalg.norm(query_vector)
+        dense_vector = query_vector / norm if norm else query_vector
+        sparse_vector = BM25_SCORER.encode_query(query)
+        sparse_norm = sum(sparse_vector["values"]) * (BM25_SCORER.k1 + 1)
+        matches = self.vector_store.query(
+            dense_vector * self.hybrid_alpha,
+            top_k=retrieval_top_k_override or self.top_k,
+            sparse_vector={
+                "indices": sparse_vector["indices"],
+                "values": [value * (1 - self.hybrid_alpha) / sparse_norm for value in sparse_vector["values"]],
+            },
+        )
         processed_results = [
             QueryResult(id=match.id, score=match.score, metadata=match.metadata)
-            for match in results.matches
+            for match in matches
             if match.score >= (minimum_threshold_override or self.min_score)
         ]
 
@@ -84,47 +177,53 @@ class Retrieval:
             final_results = processed_results[: cut_off_index + 1]
 
         logger.info(f"Retrieved {len(final_results)} results after applying elbow method")
-        return final_results
-
-    def _rerank(self, query: str, results: List[QueryResult]) -> List[QueryResult]:
-        query_terms = self._preprocess(query)
-
-        reranked_results = []
+        return self._hydrate(final_results)
+
+    def _hydrate(self, results: List[QueryResult]) -> List[QueryResult]:
+        """Add the text and BM25 statistics of the results from the document store, the vectors only carry ids."""
+        # Vectors indexed before the document store carry their text
+        keys = [
+            (result.metadata["document_id"], int(result.metadata["row_index"]))
+            for result in results
+            if "support" not in result.metadata and "row_index" in result.metadata
+        ]
+        if not keys:
+            return results
+        rows = DOCUMENT_STORE.get_many(keys)
+        if len(rows) < len(keys):
+            logger.warning(f"Missing {len(keys) - len(rows)} of {len(keys)} results in the document store")
+        hydrated = []
         for result in results:
-            content = result.metadata.get('content', '')
-            doc_terms = self._preprocess(content)
-
-            tfidf_score = self._tfidf_similarity(query_terms, doc_terms)
-            term_overlap = self._term_overlap(query_terms, doc_terms)
-
-            combined_score = 0.4 * result.score + 0.4 * tfidf_score + 0.2 * term_overlap
-            reranked_results.append((combined_score, result))
-
-        reranked_results.sort(reverse=True, key=lambda x: x[0])
-        return [result for _, result in reranked_results]
-
-    def _preprocess(self, text: str) -> List[str]:
-        # Simple preprocessing: lowercase and split
-        return text.lower().split()
-
-    def _tfidf_similarity(self, query_terms: List[str], doc_terms: List[str]) -> float:
-        # Simple TF-IDF implementation
-        doc_freq = Counter(doc_terms)
-        query_freq = Counter(query_terms)
+            row = rows.get((result.metadata.get("document_id"), int(result.metadata.get("row_index", -1))))
+            metadata = {**result.metadata, **row} if row else result.metadata
+            hydrated.append(QueryResult(id=result.id, score=result.score, metadata=metadata))
+        return hydrated
 
-        doc_magnitude = math.sqrt(sum(freq**2 for freq in doc_freq.values()))
-        query_magnitude = math.sqrt(sum(freq**2 for freq in query_freq.values()))
-
-        dot_product = sum(doc_freq[term] * query_freq[term] for term in query_terms)
-
-        if doc_magnitude == 0 or query_magnitude == 0:
-            return 0
-        return dot_product / (doc_magnitude * query_magnitude)
-
-    def _term_overlap(self, query_terms: List[str], doc_terms: List[str]) -> float:
-        query_set = set(query_terms)
-        doc_set = set(doc_terms)
-        return len(query_set.intersection(doc_set)) / len(query_set) if query_set else 0
+    def _rerank(self, query: str, results: List[QueryResult]) -> List[QueryResult]:
+        return self._rerank_batch([query], [results])[0]
+
+    def _rerank_batch(self, queries: List[str], results: List[List[QueryResult]]) -> List[List[QueryResult]]:
+        """Rerank the results of many queries in one vectorized pass."""
+        candidates = [result for query_results in results for result in query_results]
+        if not candidates:
+            return [[] for _ in queries]
+        query_ids = np.repeat(np.arange(len(queries)), [len(query_results) for query_results in results])
+        lexical_scores = BM25_SCORER.score_batch(queries, [result.metadata for result in candidates], query_ids)
+        # BM25 is unbounded, scale it per query so it is comparable to the dense score
+        max_bm25 = np.zeros(len(queries), dtype=np.float32)
+        np.maximum.at(max_bm25, query_ids, lexical_scores.bm25)
+        bm25 = lexical_scores.bm25 / np.where(max_bm25 > 0, max_bm25, 1)[query_ids]
+        dense = np.array([result.score for result in candidates], dtype=np.float32)
+
+        combined_scores = 0.4 * dense + 0.4 * bm25 + 0.2 * lexical_scores.term_overlap
+        reranked: List[List[QueryResult]] = [[] for _ in queries]
+        for i in np.lexsort((-combined_scores, query_ids)):
+            reranked[query_ids[i]].append(self._strip_lexical_metadata(candidates[i]))
+        return reranked
+
+    def _strip_lexical_metadata(self, result: QueryResult) -> QueryResult:
+        metadata = {key: value for key, value in result.metadata.items() if key not in LEXICAL_METADATA_KEYS}
+        return QueryResult(id=result.id, score=result.score, metadata=metadata)
 
     def _elbow_method(self, scores: List[float], threshold: float = 0.05) -> int:
         if not scores:
@@ -150,4 +249,4 @@ class Retrieval:
 
         return elbow_index
 
-RETRIEVAL = Retrieval(Settings())  # type: ignore - pulled from the environment
+RETRIEVAL = Retrieval(get_settings())
@@ -0,0 +1,175 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from aws_lambda_powertools import Logger
+
+from api.settings import Settings, get_settings
+from api.services.cache import CACHE_SERVICE, CacheService
+
+
+logger = Logger()
+
+
+@dataclass
+class _ScopeIndex:
+    """Cached query embeddings that were answered with the same retrieval parameters."""
+
+    keys: List[str] = field(default_factory=list)
+    vectors: List[np.ndarray] = field(default_factory=list)
+    expires_at: List[int] = field(default_factory=list)
+    _positions: Dict[str, int] = field(default_factory=dict)
+    _matrix: Optional[np.ndarray] = None
+    _expires_at: Optional[np.ndarray] = None
+
+    def add(self, key: str, vector: np.ndarray, expires_at: int) -> None:
+        if (position := self._positions.get(key)) is not None:
+            self.vectors[position] = vector
+            self.expires_at[position] = expires_at
+        else:
+            self._positions[key] = len(self.keys)
+            self.keys.append(key)
+            self.vectors.append(vector)
+            self.expires_at.append(expires_at)
+        self._matrix = None
+
+    def nearest(self, vector: np.ndarray, now: int) -> Optional[Tuple[str, float]]:
+        if not self.keys:
+            return None
+        if self._matrix is None:
+            self._matrix = np.vstack(self.vectors)
+            self._expires_at = np.asarray(self.expires_at, dtype=np.int64)
+        similarities = self._matrix @ vector
+        similarities[self._expires_at <= now] = -np.inf
+        best = int(np.argmax(similarities))
+        return self.keys[best], float(similarities[best])
+
+    def prune(self, now: int) -> None:
+        live = [i for i, expires_at in enumerate(self.expires_at) if expires_at > now]
+        if len(live) == len(self.keys):
+            return
+        self.keys = [self.keys[i] for i in live]
+        self.vectors = [self.vectors[i] for i in live]
+        self.expires_at = [self.expires_at[i] for i in live]
+        self._positions = {key: i for i, key in enumerate(self.keys)}
+        self._matrix = None
+
+
+class SemanticCache:
+    """
+    Nearest-neighbour index over the query embeddings stored next to cached chat responses.
+
+    The embeddings are persisted as float32 bytes on the cache items themselves, so any container can rebuild the
+    index from the cache table. Refreshes run in a background thread and only read the items written since the
+    previous refresh, lookups never wait on DynamoDB and see entries from other containers one refresh later.
+    """
+
+    embedding_attribute_name = "embedding"
+    scope_attribute_name = "scope"
+
+    def __init__(self, settings: Settings, cache_service: CacheService):
+        self.cache_service = cache_service
+        self.threshold = settings.semantic_cache_similarity_threshold
+        self.refresh_seconds = settings.semantic_cache_refresh_seconds
+        self.max_entries = settings.semantic_cache_max_entries
+        self.ttl = settings.chat_cache_ttl_seconds
+        self._scopes: Dict[str, _ScopeIndex] = {}
+        self._loaded_at: Optional[float] = None
+        # Write time of the newest entry read from the table, the next refresh continues from there
+        self._written_at: Optional[int] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def lookup(self, scope: str, embedding: np.ndarray) -> Optional[str]:
+        """Return the cache key of the most similar cached query, if it is similar enough to be reused."""
+        self._refresh_in_background()
+        with self._lock:
+            index = self._scopes.get(scope)
+            nearest = index.nearest(self._normalize(embedding), int(time.time())) if index else None
+        if nearest is None:
+            return None
+        key, similarity = nearest
+        if similarity < self.threshold:
+            logger.debug(f"Closest cached query has similarity {similarity:.4f}, below threshold {self.threshold}")
+            return None
+        logger.info(f"Semantic cache hit with similarity {similarity:.4f}")
+        return key
+
+    def add(self, scope: str, key: str, embedding: np.ndarray, ttl: int) -> None:
+        with self._lock:
+            self._scopes.setdefault(scope, _ScopeIndex()).add(key, self._normalize(embedding), int(time.time()) + ttl)
+
+    def get_attributes(self, scope: str, embedding: np.ndarray) -> Dict[str, Any]:
+        """Attributes to persist on the cache item so the entry can be reloaded into the index."""
+        return {
+            self.embedding_attribute_name: np.asarray(embedding, dtype=np.float32).tobytes(),
+            self.scope_attribute_name: scope,
+        }
+
+    def refresh(self) -> None:
+        """Add the entries written since the last refresh and drop the expired ones."""
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh_in_background(self) -> None:
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_seconds:
+            return
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(target=self.refresh, name="semantic-cache-refresh", daemon=True).start()
+
+    def _refresh(self) -> None:
+        started_at = time.monotonic()
+        # Nothing written longer than a ttl ago is still live. Items show up on the index eventually, so every refresh
+        # reads one refresh period back, re-adding an entry is a no-op.
+        since = int(time.time()) - self.ttl if self._written_at is None else self._written_at - self.refresh_seconds
+        items = self.cache_service.query_written_since(
+            since, [self.embedding_attribute_name, self.scope_attribute_name]
+        )
+        entries: List[Tuple[str, str, np.ndarray, int]] = []
+        written_at = self._written_at or since
+        for item in items:
+            vector = np.frombuffer(bytes(item[self.embedding_attribute_name]), dtype=np.float32)
+            entries.append(
+                (
+                    item[self.scope_attribute_name],
+                    item[self.cache_service.partition_key_column_name],
+                    self._normalize(vector),
+                    int(item[self.cache_service.ttl_column_name]),
+                )
+            )
+            written_at = max(written_at, int(item[self.cache_service.written_at_column_name]))
+        now = int(time.time())
+        with self._lock:
+            for scope, key, vector, expires_at in entries:
+                self._scopes.setdefault(scope, _ScopeIndex()).add(key, vector, expires_at)
+            for index in self._scopes.values():
+                index.prune(now)
+            self._scopes = {scope: index for scope, index in self._scopes.items() if index.keys}
+            size = sum(len(index.keys) for index in self._scopes.values())
+            if size > self.max_entries:
+                logger.warning(f"Semantic cache is limited to {self.max_entries} entries, dropping the oldest")
+                self._evict_oldest(size - self.max_entries)
+            self._written_at = written_at
+            self._loaded_at = started_at
+        logger.info(f"Refreshed semantic cache with {len(entries)} new entries in {time.monotonic() - started_at:.3f}s")
+
+    def _evict_oldest(self, count: int) -> None:
+        expiries = sorted(expires_at for index in self._scopes.values() for expires_at in index.expires_at)
+        # Every entry has the same ttl, the ones that expire first are the oldest
+        for index in self._scopes.values():
+            index.prune(expiries[count - 1])
+
+    def _normalize(self, embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+SEMANTIC_CACHE = SemanticCache(get_settings(), CACHE_SERVICE)
@@ -0,0 +1,39 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aws_lambda_powertools import Logger
+
+from api.services.bm25 import BM25_SCORER
+from api.services.cache import CACHE_SERVICE
+from api.services.retrieval import RETRIEVAL
+from api.services.semantic_cache import SEMANTIC_CACHE
+
+
+logger = Logger()
+
+# Scheduled invocations with this key set only prime the container instead of going through the ASGI app
+WARMUP_EVENT_KEY = "warmup"
+
+
+async def warm_up() -> Dict[str, Any]:
+    """Open the connections the chat path needs so the first real request doesn't pay for the TLS handshakes."""
+    targets: Dict[str, Callable[[], Awaitable[Any]]] = {
+        "bedrock": RETRIEVAL.warm_up,
+        "vector_store": lambda: asyncio.to_thread(RETRIEVAL.vector_store.describe),
+        "dynamodb": lambda: CACHE_SERVICE.get("__warmup__"),
+        "s3": lambda: asyncio.to_thread(BM25_SCORER.get_corpus),
+        "semantic_cache": lambda: asyncio.to_thread(SEMANTIC_CACHE.refresh),
+    }
+    timings = await asyncio.gather(*(_timed(name, target) for name, target in targets.items()))
+    return {"warmup": dict(zip(targets, timings))}
+
+
+async def _timed(name: str, target: Callable[[], Awaitable[Any]]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    try:
+        await target()
+        return {"ok": True, "seconds": round(time.perf_counter() - start, 4)}
+    except Exception as e:
+        logger.warning(f"Failed to warm up {name}: {str(e)}")
+        return {"ok": False, "seconds": round(time.perf_counter() - start, 4)}
@@ -1,5 +1,8 @@
 from enum import Enum
+from functools import lru_cache
+from typing import Optional
 from pydantic_settings import SettingsConfigDict, BaseSettings as PydanticBaseSettings
+from vector_index import VectorQuantization
 
 
 class ModelId(str, Enum):
@@ -8,6 +11,18 @@ class ModelId(str, Enum):
     META_LLAMA3_70B_INSTRUCT_V1 = "meta.llama3-70b-instruct-v1:0"
 
 
+class VectorStoreBackend(str, Enum):
+
+    PINECONE = "pinecone"
+    LOCAL = "local"
+
+
+class DocumentRegistryBackend(str, Enum):
+
+    DYNAMODB = "dynamodb"
+    LOCAL = "local"
+
+
 class Settings(PydanticBaseSettings):
 
     model_config = SettingsConfigDict(
@@ -17,13 +32,59 @@ class Settings(PydanticBaseSettings):
     )
     log_level: str = "DEBUG"
     s3_bucket_name: str
+    artifact_bucket_name: str
+    documents_table_name: str
+    documents_status_index_name: str = "status-index"
+    document_registry_backend: DocumentRegistryBackend = DocumentRegistryBackend.DYNAMODB
+    local_document_registry_path: str = "/tmp/document-registry.json"
     embedding_model_id: str = ModelId.AMAZON_TITAN_EMBED_TEXT_V1.value
     pinecone_api_key_secret_name: str
     # Hardcoding because the pinecone construct doesn't expose the index name *yet*
     pinecone_host_name: str = "https://ragstack-index0-d41d8cd98f00b204e980-c6xn8rd.svc.apw5-4e34-81fa.pinecone.io"
+    vector_store_backend: VectorStoreBackend = VectorStoreBackend.PINECONE
+    local_vector_store_path: str = "/tmp/vector-store"
+    # The local store switches from exact search to an HNSW graph once it holds this many vectors
+    local_vector_store_hnsw_threshold: int = 10_000
+    local_vector_store_ef_search: int = 64
+    # Exact queries scan int8 or binary codes of the vectors, then rescore this many times top_k candidates in float32,
+    # by default 8 for int8 and 32 for binary codes
+    local_vector_store_quantization: VectorQuantization = VectorQuantization.INT8
+    local_vector_store_rescore_factor: Optional[int] = None
+    # Weight of the dense score in hybrid queries, the sparse BM25 score gets the rest
+    hybrid_alpha: float = 0.75
     retrieval_top_k: int = 10
-    retrieval_min_score: float = 80.0
+    # Hybrid scores are a convex combination of a cosine similarity and a sparse score in [0, 1), so they fall in
+    # [-1, 1). The default drops results with a weak dense similarity and little term overlap with the query.
+    retrieval_min_score: float = 0.3
+    retrieval_batch_max_size: int = 1000
+    retrieval_batch_concurrency: int = 16
+    retrieval_batch_window_size: int = 64
+    # Query results are hydrated with their text from the indexer's document store, downloaded parts are kept in /tmp
+    document_store_cache_path: str = "/tmp/document-store"
+    document_store_cache_max_bytes: int = 256 * 1024**2
+    document_store_refresh_seconds: int = 60
+    bm25_k1: float = 1.2
+    bm25_b: float = 0.75
+    bm25_refresh_seconds: int = 300
+    embedding_cache_max_size: int = 1024
+    embedding_cache_ttl_seconds: int = 3600
     chat_model_id: str = ModelId.META_LLAMA3_70B_INSTRUCT_V1.value
+    # Cached chat responses written by other containers become visible to the semantic cache within one refresh, so
+    # the ttl has to be several refresh periods long for them to be reused at all
+    chat_cache_ttl_seconds: int = 600
+    semantic_cache_similarity_threshold: float = 0.95
+    semantic_cache_refresh_seconds: int = 60
+    semantic_cache_max_entries: int = 5000
+    presigned_upload_expiration_seconds: int = 900
+    # A single presigned PUT can't be larger than 5 GiB
+    upload_max_size_bytes: int = 5 * 1024**3
     cache_table_name: str
     cache_table_ttl_column_name: str = "ttl"
+    # Index on the hour an item was written and its write time, the semantic cache only queries the recent items
+    cache_table_time_index_name: str = "written-at-index"
     partition_key_column_name: str = "key"
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    return Settings()  # type: ignore - pulled from the environment
@@ -0,0 +1,105 @@
+"""
+Measure the cold start of the API Lambda handler.
+
+Every run starts a fresh interpreter, imports `api.index` and sends a Function URL event through the handler,
+reporting the import time and the time to the first response. The required settings default to dummy values so the
+benchmark runs without AWS credentials for routes that don't call AWS (the default health check).
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--path /health-check/] [--warmup]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+API_ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_ENVIRONMENT = {
+    "S3_BUCKET_NAME": "benchmark-bucket",
+    "ARTIFACT_BUCKET_NAME": "benchmark-artifacts",
+    "DOCUMENTS_TABLE_NAME": "benchmark-documents",
+    "PINECONE_API_KEY_SECRET_NAME": "benchmark-secret",
+    "CACHE_TABLE_NAME": "benchmark-cache",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "LOG_LEVEL": "ERROR",
+    "POWERTOOLS_LOG_LEVEL": "ERROR",
+}
+
+CHILD = """
+import json, sys, time, types
+start = time.perf_counter()
+import api.index
+imported = time.perf_counter()
+context = types.SimpleNamespace(
+    function_name="benchmark",
+    function_version="$LATEST",
+    memory_limit_in_mb=256,
+    invoked_function_arn="arn:aws:lambda:us-east-1:000000000000:function:benchmark",
+    aws_request_id="benchmark",
+)
+result = {"import_seconds": imported - start}
+if sys.argv[2] == "1":
+    warmup_start = time.perf_counter()
+    api.index.handler({"warmup": True}, context)
+    result["warmup_seconds"] = time.perf_counter() - warmup_start
+event = {
+    "version": "2.0",
+    "routeKey": "$default",
+    "rawPath": sys.argv[1],
+    "rawQueryString": "",
+    "headers": {"host": "benchmark.lambda-url.us-east-1.on.aws"},
+    "requestContext": {
+        "http": {"method": "GET", "path": sys.argv[1], "protocol": "HTTP/1.1", "sourceIp": "127.0.0.1", "userAgent": "benchmark"},
+    },
+    "isBase64Encoded": False,
+}
+request_start = time.perf_counter()
+response = api.index.handler(event, context)
+finished = time.perf_counter()
+result.update(
+    first_response_seconds=finished - request_start,
+    total_seconds=finished - start,
+    status_code=response["statusCode"],
+)
+print(json.dumps(result))
+"""
+
+
+def run_once(path: str, warmup: bool) -> dict:
+    environment = {**DEFAULT_ENVIRONMENT, **os.environ}
+    completed = subprocess.run(
+        [sys.executable, "-c", CHILD, path, "1" if warmup else "0"],
+        cwd=API_ROOT,
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/health-check/")
+    parser.add_argument("--warmup", action="store_true", help="send a warmup event first (needs AWS access)")
+    args = parser.parse_args()
+
+    runs = [run_once(args.path, args.warmup) for _ in range(args.runs)]
+    summary = {"runs": args.runs, "path": args.path}
+    for metric in ("import_seconds", "warmup_seconds", "first_response_seconds", "total_seconds"):
+        values = [run[metric] for run in runs if metric in run]
+        if values:
+            summary[metric] = {"median": round(statistics.median(values), 4), "max": round(max(values), 4)}
+    summary["status_codes"] = sorted({run["status_code"] for run in runs})
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+#!/bin/bash
+# Entry point behind the Lambda Web Adapter, which proxies function URL requests to this server and streams the
+# responses back. PORT is set by the stack.
+exec python -m uvicorn --host 127.0.0.1 --port "${PORT:-8080}" api.index:WEB_APP
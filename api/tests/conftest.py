@@ -0,0 +1,73 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+
+# The services are module level singletons configured from the environment, the settings have to be in place before
+# the first api module is imported. Every backend that has a local implementation uses it.
+LOCAL_ROOT = tempfile.mkdtemp(prefix="api-tests-")
+os.environ.update(
+    S3_BUCKET_NAME="documents",
+    ARTIFACT_BUCKET_NAME="artifacts",
+    DOCUMENTS_TABLE_NAME="documents-table",
+    PINECONE_API_KEY_SECRET_NAME="pinecone-secret",
+    CACHE_TABLE_NAME="cache-table",
+    AWS_DEFAULT_REGION="us-east-1",
+    AWS_ACCESS_KEY_ID="testing",
+    AWS_SECRET_ACCESS_KEY="testing",
+    LOG_LEVEL="WARNING",
+    POWERTOOLS_LOG_LEVEL="WARNING",
+    DOCUMENT_REGISTRY_BACKEND="local",
+    LOCAL_DOCUMENT_REGISTRY_PATH=f"{LOCAL_ROOT}/registry.json",
+    VECTOR_STORE_BACKEND="local",
+    LOCAL_VECTOR_STORE_PATH=f"{LOCAL_ROOT}/vectors",
+    DOCUMENT_STORE_CACHE_PATH=f"{LOCAL_ROOT}/document-store",
+)
+
+
+@pytest.fixture
+def indexed(tmp_path, monkeypatch):
+    """A store holding one vector with the metadata the indexer writes, and a query embedding that matches it."""
+    # Imported here so the environment above is in place first
+    import api.services.retrieval as retrieval
+    from api.services.retrieval import RETRIEVAL
+    from api.services.vector_store import LocalVectorStore
+
+    store = LocalVectorStore(str(tmp_path / "vectors"))
+    vector = np.zeros(8, dtype=np.float32)
+    vector[0] = 1.0
+    store.upsert(
+        [
+            {
+                "id": "doc_0",
+                "values": vector,
+                "sparse_values": {"indices": [1], "values": [1.0]},
+                "metadata": {"document_id": "doc", "row_index": 0, "document_ids": ["doc", "copy"]},
+            }
+        ]
+    )
+    monkeypatch.setattr(RETRIEVAL, "vector_store", store)
+    monkeypatch.setattr(retrieval.BM25_SCORER, "get_corpus", lambda: None)
+    monkeypatch.setattr(
+        retrieval.DOCUMENT_STORE,
+        "get_many",
+        lambda keys: {
+            key: {
+                "question": "At what temperature does water boil?",
+                "correct_answer": "100 degrees",
+                "support": "Water boils at 100 degrees at sea level.",
+                "term_frequencies": None,
+                "token_count": 8,
+            }
+            for key in keys
+        },
+    )
+
+    async def get_embedding(query):
+        return vector
+
+    monkeypatch.setattr(RETRIEVAL, "get_embedding", get_embedding)
+    monkeypatch.setattr(RETRIEVAL, "_get_cached_embedding", lambda query: vector)
+    return store
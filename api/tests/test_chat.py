@@ -0,0 +1,78 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import api.services.chat as chat
+from api.index import WEB_APP
+from api.services.chat import CHAT_SERVICE
+
+
+class FakeCacheService:
+    def __init__(self):
+        self.items = {}
+
+    async def get(self, key):
+        return self.items.get(key)
+
+    async def set(self, key, value, ttl, attributes=None):
+        self.items[key] = value
+
+
+class FakeRetrieval:
+    def __init__(self):
+        self.embedded = []
+
+    async def get_embedding(self, text):
+        self.embedded.append(text)
+        return np.ones(4, dtype=np.float32)
+
+    async def query(self, query, top_k_override=None, minimum_threshold_override=None):
+        return []
+
+
+@pytest.fixture
+def cache_service(monkeypatch):
+    cache_service = FakeCacheService()
+    monkeypatch.setattr(chat, "CACHE_SERVICE", cache_service)
+    monkeypatch.setattr(chat, "RETRIEVAL", FakeRetrieval())
+    monkeypatch.setattr(chat.SEMANTIC_CACHE, "lookup", lambda scope, embedding: None)
+    monkeypatch.setattr(chat.SEMANTIC_CACHE, "add", lambda *args: None)
+    monkeypatch.setattr(CHAT_SERVICE, "_stream_bedrock_response", lambda prompt: iter(["Seventy ", "percent"]))
+    monkeypatch.setattr(CHAT_SERVICE, "_generate_bedrock_response", lambda prompt: "Seventy percent")
+    return cache_service
+
+
+def test_stream_caches_the_response_before_the_last_frame(cache_service):
+    async def consume_until_relevancy():
+        events = CHAT_SERVICE.stream_response("How much of earth is water?")
+        async for event in events:
+            if event.event == "relevancy":
+                # The client goes away as soon as it has the relevancy
+                await events.aclose()
+                return
+
+    asyncio.run(consume_until_relevancy())
+    assert len(cache_service.items) == 1
+    cached = chat.CachedChatResponse.model_validate_json(next(iter(cache_service.items.values())))
+    assert cached.response == "Seventy percent"
+
+
+def test_exact_cache_hits_do_not_embed_the_query(cache_service):
+    asyncio.run(CHAT_SERVICE.generate_response("How much of earth is water?"))
+    chat.RETRIEVAL.embedded.clear()
+    asyncio.run(CHAT_SERVICE.generate_response("How much of earth is water?"))
+    assert chat.RETRIEVAL.embedded == []
+
+
+def test_chat_route_returns_the_metadata_of_real_matches(indexed, monkeypatch):
+    monkeypatch.setattr(chat, "CACHE_SERVICE", FakeCacheService())
+    monkeypatch.setattr(chat.SEMANTIC_CACHE, "lookup", lambda scope, embedding: None)
+    monkeypatch.setattr(chat.SEMANTIC_CACHE, "add", lambda *args: None)
+    monkeypatch.setattr(CHAT_SERVICE, "_generate_bedrock_response", lambda prompt: "At 100 degrees")
+    response = TestClient(WEB_APP).post("/chat/chat", json={"query": "At what temperature does water boil?"})
+    assert response.status_code == 200
+    [document] = response.json()["supporting_docs"]
+    assert document["metadata"]["row_index"] == 0
+    assert document["metadata"]["document_ids"] == ["doc", "copy"]
@@ -0,0 +1,77 @@
+import base64
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api.routers.documents as documents_router
+from api.index import WEB_APP
+from api.services.documents import DynamoDbDocumentRegistry, LocalDocumentRegistry
+from api.settings import get_settings
+
+
+def encode(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).decode("ascii")
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    registry = LocalDocumentRegistry(str(tmp_path / "registry.json"))
+    for i in range(5):
+        registry.register(f"doc-{i}", f"file-{i}.parquet", 10)
+    monkeypatch.setattr(documents_router, "DOCUMENT_REGISTRY", registry)
+    return registry
+
+
+def test_pages_through_every_document(registry):
+    pages = [registry.list_page(2)]
+    while pages[-1].next_cursor:
+        pages.append(registry.list_page(2, pages[-1].next_cursor))
+    assert [len(page.documents) for page in pages] == [2, 2, 1]
+    assert len({document.document_id for page in pages for document in page.documents}) == 5
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not base64!",
+        encode([1, 2]),
+        encode("x"),
+        encode({}),
+        encode({"offset": "2"}),
+        encode({"offset": True}),
+        encode({"offset": -1}),
+        encode({"offset": 1, "extra": 1}),
+    ],
+)
+def test_invalid_cursors_are_rejected(registry, cursor):
+    with pytest.raises(ValueError):
+        registry.list_page(2, cursor)
+    response = TestClient(WEB_APP).get("/documents", params={"cursor": cursor})
+    assert response.status_code == 400
+
+
+def test_dynamodb_cursors_must_match_the_listing():
+    registry = DynamoDbDocumentRegistry(get_settings())
+    key = {"document_id": "doc", "indexing_status": "COMPLETE", "created_at": "2024-01-01"}
+    assert registry._decode_cursor(encode({"document_id": "doc"}), {"document_id": str}) == {"document_id": "doc"}
+    with pytest.raises(ValueError):
+        registry._decode_cursor(encode(key), {"document_id": str})
+    with pytest.raises(ValueError):
+        # A cursor of another status is rejected before it reaches DynamoDB
+        registry.list_page(10, encode(key), indexing_status="FAILED")
+
+
+@pytest.mark.parametrize(
+    "indexing_status, status_code",
+    [("PENDING", 409), ("INDEXING", 409), ("DELETING", 202)],
+)
+def test_deletes_are_answered_by_the_current_status(registry, indexing_status, status_code):
+    with registry._documents() as documents:
+        documents["doc-0"]["indexing_status"] = indexing_status
+    response = TestClient(WEB_APP).delete("/documents/doc-0")
+    assert response.status_code == status_code
+    if status_code == 409:
+        assert indexing_status in response.json()["detail"]
+    assert registry.get("doc-0").indexing_status == indexing_status
+    assert TestClient(WEB_APP).delete("/documents/missing").status_code == 404
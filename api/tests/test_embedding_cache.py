@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from api.services.embedding_cache import EmbeddingCache
+from api.settings import get_settings
+
+
+@pytest.fixture
+def cache() -> EmbeddingCache:
+    settings = get_settings().model_copy(update={"embedding_cache_max_size": 2, "embedding_cache_ttl_seconds": 60})
+    return EmbeddingCache(settings)
+
+
+def test_returns_the_cached_embedding_for_the_same_text(cache):
+    cache.set("What is water?", "model", [1.0, 2.0])
+    assert cache.get("What  is\twater?", "model").tolist() == [1.0, 2.0]
+    assert cache.get("What is water?", "other-model") is None
+    assert cache.stats() == {"size": 1, "max_size": 2, "hits": 1, "misses": 1}
+
+
+def test_evicts_the_least_recently_used_entry(cache):
+    cache.set("a", "model", [1.0])
+    cache.set("b", "model", [2.0])
+    cache.get("a", "model")
+    cache.set("c", "model", [3.0])
+    assert cache.get("b", "model") is None
+    assert cache.get("a", "model") is not None and cache.get("c", "model") is not None
+
+
+def test_expires_entries_after_the_ttl(cache, monkeypatch):
+    cache.set("a", "model", [1.0])
+    now = __import__("time").monotonic()
+    monkeypatch.setattr("api.services.embedding_cache.time.monotonic", lambda: now + 61)
+    assert cache.get("a", "model") is None
+
+
+def test_cached_embeddings_are_read_only(cache):
+    embedding = cache.set("a", "model", np.ones(2))
+    with pytest.raises(ValueError):
+        embedding[0] = 0
@@ -0,0 +1,59 @@
+import json
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import api.services.retrieval as retrieval
+from api.index import WEB_APP
+from api.services.retrieval import RETRIEVAL
+
+
+class RecordingVectorStore:
+    def __init__(self):
+        self.queries = []
+
+    def query(self, vector, top_k, sparse_vector=None):
+        self.queries.append((vector, sparse_vector))
+        return []
+
+
+@pytest.fixture
+def vector_store(monkeypatch):
+    vector_store = RecordingVectorStore()
+    monkeypatch.setattr(RETRIEVAL, "vector_store", vector_store)
+    monkeypatch.setattr(RETRIEVAL, "hybrid_alpha", 0.75)
+    monkeypatch.setattr(retrieval.BM25_SCORER, "k1", 1.2)
+    monkeypatch.setattr(
+        retrieval.BM25_SCORER, "encode_query", lambda query: {"indices": [1, 2, 3], "values": [4.0, 2.5, 0.5]}
+    )
+    return vector_store
+
+
+def test_hybrid_query_weighs_scores_on_the_same_scale(vector_store):
+    RETRIEVAL._query("water", np.array([3.0, 4.0]))
+    dense, sparse = vector_store.queries[0]
+    assert np.linalg.norm(dense) == pytest.approx(0.75)
+    # A document saturating every query term scores the full sparse weight and no more
+    assert sum(value * 2.2 for value in sparse["values"]) == pytest.approx(0.25)
+    assert sparse["values"][0] / sparse["values"][1] == pytest.approx(4.0 / 2.5)
+
+
+def test_query_route_returns_the_metadata_of_real_matches(indexed):
+    response = TestClient(WEB_APP).post("/retrieval/query", json={"query": "water"})
+    assert response.status_code == 200
+    [result] = response.json()["results"]
+    assert result["id"] == "doc_0"
+    assert result["metadata"]["row_index"] == 0
+    assert result["metadata"]["document_ids"] == ["doc", "copy"]
+
+
+def test_batch_query_route_streams_the_metadata_of_real_matches(indexed):
+    response = TestClient(WEB_APP).post("/retrieval/query/batch", json={"queries": [{"query": "water"}] * 2})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines] == [0, 1]
+    for line in lines:
+        assert "error" not in line
+        [result] = line["results"]
+        assert result["metadata"]["document_ids"] == ["doc", "copy"]
@@ -0,0 +1,76 @@
+import time
+
+import numpy as np
+
+from api.services.semantic_cache import SemanticCache
+from api.settings import get_settings
+
+
+class FakeCacheService:
+    partition_key_column_name = "key"
+    ttl_column_name = "ttl"
+    written_at_column_name = "written_at"
+
+    def __init__(self):
+        self.items = []
+        self.queries = []
+
+    def query_written_since(self, since, attribute_names):
+        self.queries.append(since)
+        return [item for item in self.items if item["written_at"] > since]
+
+    def put(self, key, scope, embedding, written_at):
+        self.items.append(
+            {
+                "key": key,
+                "scope": scope,
+                "embedding": np.asarray(embedding, dtype=np.float32).tobytes(),
+                "ttl": written_at + 600,
+                "written_at": written_at,
+            }
+        )
+
+
+def make_cache(cache_service, **settings):
+    return SemanticCache(get_settings().model_copy(update=settings), cache_service)
+
+
+def test_refresh_only_reads_the_items_written_since_the_last_refresh():
+    cache_service = FakeCacheService()
+    cache = make_cache(cache_service, chat_cache_ttl_seconds=600, semantic_cache_refresh_seconds=60)
+    now = int(time.time())
+    cache_service.put("a", "scope", [1.0, 0.0], now - 10)
+    cache.refresh()
+    assert abs(cache_service.queries[0] - (now - 600)) <= 1
+    cache_service.put("b", "scope", [0.0, 1.0], now - 5)
+    cache.refresh()
+    # Reads one refresh period back from the newest entry it has seen
+    assert cache_service.queries[1] == now - 10 - 60
+    assert cache.lookup("scope", np.array([1.0, 0.0])) == "a"
+    assert cache.lookup("scope", np.array([0.0, 2.0])) == "b"
+    assert cache.lookup("other", np.array([1.0, 0.0])) is None
+
+
+def test_lookup_refreshes_in_the_background():
+    cache_service = FakeCacheService()
+    cache = make_cache(cache_service)
+    cache_service.put("a", "scope", [1.0, 0.0], int(time.time()))
+    cache._refresh_lock.acquire()
+    # A refresh is already running, the lookup answers from what is loaded instead of waiting for it
+    assert cache.lookup("scope", np.array([1.0, 0.0])) is None
+    cache._refresh_lock.release()
+    cache.lookup("scope", np.array([1.0, 0.0]))
+    deadline = time.monotonic() + 5
+    while cache._loaded_at is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.lookup("scope", np.array([1.0, 0.0])) == "a"
+
+
+def test_refresh_drops_the_oldest_entries_over_the_limit():
+    cache_service = FakeCacheService()
+    cache = make_cache(cache_service, semantic_cache_max_entries=2)
+    now = int(time.time())
+    for i, key in enumerate("abc"):
+        cache_service.put(key, "scope", [1.0, float(i)], now - 30 + i)
+    cache.refresh()
+    assert sorted(cache._scopes["scope"].keys) == ["b", "c"]
@@ -0,0 +1,39 @@
+import pytest
+
+import api.services.warmup as warmup
+from api.index import EVENT_LOOP, handler
+
+
+class Context:
+    function_name = "api"
+    memory_limit_in_mb = 1024
+    invoked_function_arn = "arn:aws:lambda:us-east-1:000000000000:function:api"
+    aws_request_id = "request"
+
+
+class FakeCacheService:
+    async def get(self, key):
+        return None
+
+
+@pytest.fixture
+def targets(monkeypatch):
+    warmed = []
+
+    async def warm_up():
+        warmed.append("bedrock")
+
+    monkeypatch.setattr(warmup.RETRIEVAL, "warm_up", warm_up)
+    monkeypatch.setattr(warmup, "CACHE_SERVICE", FakeCacheService())
+    monkeypatch.setattr(warmup.BM25_SCORER, "get_corpus", lambda: None)
+    monkeypatch.setattr(warmup.SEMANTIC_CACHE, "refresh", lambda: None)
+    return warmed
+
+
+def test_warm_up_invocations_keep_the_event_loop_of_the_app(targets):
+    for _ in range(2):
+        response = handler({"warmup": True}, Context())
+        assert all(timing["ok"] for timing in response["warmup"].values())
+    assert targets == ["bedrock", "bedrock"]
+    # Mangum serves the next request on the same loop
+    assert not EVENT_LOOP.is_closed()
@@ -1,5 +1,6 @@
 import json
 from pathlib import Path
+import jsii
 from typing import Dict, Set, Tuple, Union, Optional, List
 from constructs import Construct
 from dataclasses import dataclass
@@ -14,13 +15,16 @@ import aws_cdk.aws_lambda_event_sources as lambda_events
 import aws_cdk.aws_secretsmanager as secretsmanager
 import aws_cdk.aws_lambda_python_alpha as lambda_alpha
 import aws_cdk.aws_dynamodb as dynamodb
-from aws_cdk import RemovalPolicy, Stack, Duration, Size, CfnOutput, SecretValue
+import aws_cdk.aws_events as events
+import aws_cdk.aws_events_targets as events_targets
+from aws_cdk import AssetHashType, DockerVolume, RemovalPolicy, Stack, Duration, Size, CfnOutput, SecretValue
 from pydantic_settings import BaseSettings
 from pinecone_db_construct import (
     PineconeIndex,
     CloudProvider,
     Region,
     PineconeIndexSettings,
+    DistanceMetric,
     ServerlessSpec,
     DeploymentSettings,
 )
@@ -30,6 +34,23 @@ from indexer.settings import Settings as IndexerSettings
 from api.settings import Settings as ApiSettings
 
 
+# Shared by the indexer and the API. It isn't published, so it is copied into both bundles instead of installed.
+SHARED_PACKAGE_DIRECTORY = Path(__file__).resolve().parents[2] / "vector_index"
+
+
+@jsii.implements(lambda_alpha.ICommandHooks)
+class CopySharedPackage:
+    """Copy the shared package, mounted in the bundling container, next to the function's own package."""
+
+    container_path = "/shared"
+
+    def before_bundling(self, input_dir: str, output_dir: str) -> List[str]:
+        return []
+
+    def after_bundling(self, input_dir: str, output_dir: str) -> List[str]:
+        return [f"cp -r {self.container_path}/vector_index {output_dir}/vector_index"]
+
+
 @dataclass
 class FunctionUrlConfig:
     """Function URL configuration."""
@@ -54,6 +75,8 @@ class LambdaConfig:
     xray_tracing: _lambda.Tracing = _lambda.Tracing.DISABLED
     secret_names_to_read: Optional[List[str]] = None
     function_url_config: Optional[FunctionUrlConfig] = None
+    # Run this script from the bundle behind the Lambda Web Adapter instead of calling the Python handler
+    web_adapter_startup_script: Optional[str] = None
 
 
 def model_dump_runtime_settings(
@@ -94,11 +117,53 @@ class RAGStack(Stack):
             self,
             "RAGBucket",
             versioned=True,
+            # Clients upload straight to the bucket with presigned URLs
+            cors=[
+                s3.CorsRule(
+                    allowed_methods=[s3.HttpMethods.POST, s3.HttpMethods.PUT],
+                    allowed_origins=["*"],
+                    allowed_headers=["*"],
+                )
+            ],
             encryption=s3.BucketEncryption.S3_MANAGED,
             removal_policy=RemovalPolicy.DESTROY,
             auto_delete_objects=True,
         )
 
+        # Derived artifacts written by the indexer, kept out of the document bucket so they don't emit indexing events
+        artifact_bucket = s3.Bucket(
+            self,
+            "RAGArtifactBucket",
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            removal_policy=RemovalPolicy.DESTROY,
+            auto_delete_objects=True,
+        )
+
+        # Per-document indexing state, listed by status through the index instead of a HEAD request per object
+        documents_status_index_name = "status-index"
+        documents_table = dynamodb.TableV2(
+            self,
+            "DocumentsTable",
+            partition_key=dynamodb.Attribute(name="document_id", type=dynamodb.AttributeType.STRING),
+            global_secondary_indexes=[
+                dynamodb.GlobalSecondaryIndexPropsV2(
+                    index_name=documents_status_index_name,
+                    partition_key=dynamodb.Attribute(name="indexing_status", type=dynamodb.AttributeType.STRING),
+                    sort_key=dynamodb.Attribute(name="created_at", type=dynamodb.AttributeType.STRING),
+                ),
+            ],
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        # Embeddings by a hash of the model and input text, re-indexed rows aren't sent to Bedrock again
+        embedding_cache_table = dynamodb.TableV2(
+            self,
+            "EmbeddingCacheTable",
+            partition_key=dynamodb.Attribute(name="key", type=dynamodb.AttributeType.STRING),
+            time_to_live_attribute="ttl",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
         queue = sqs.Queue(
             self,
             "RAGQueue",
@@ -123,6 +188,9 @@ class RAGStack(Stack):
             memory_size_mb=2048,
             environment=IndexerSettings(
                 s3_bucket_name=bucket.bucket_name,
+                artifact_bucket_name=artifact_bucket.bucket_name,
+                documents_table_name=documents_table.table_name,
+                embedding_cache_table_name=embedding_cache_table.table_name,
                 pinecone_api_key_secret_name=pinecone_api_secret.secret_name,
             ),
             secret_names_to_read=[pinecone_api_secret.secret_name],
@@ -141,16 +209,32 @@ class RAGStack(Stack):
                 batch_size=3,
                 max_batching_window=Duration.seconds(5),
                 max_concurrency=2,
+                # The handler returns the messages of the documents that failed, the others aren't redelivered
+                report_batch_item_failures=True,
             )
         )
         bucket.grant_read_write(indexer_lambda)
+        artifact_bucket.grant_read_write(indexer_lambda)
+        documents_table.grant_read_write_data(indexer_lambda)
+        embedding_cache_table.grant_read_write_data(indexer_lambda)
         ttl_column_name = "ttl"
         partition_key_column_name = "key"
+        cache_time_index_name = "written-at-index"
         cache_table = dynamodb.TableV2(
             self,
             "CacheTable",
             partition_key=dynamodb.Attribute(name=partition_key_column_name, type=dynamodb.AttributeType.STRING),
             time_to_live_attribute=ttl_column_name,
+            # The semantic cache reads the items written since its last refresh instead of scanning the table
+            global_secondary_indexes=[
+                dynamodb.GlobalSecondaryIndexPropsV2(
+                    index_name=cache_time_index_name,
+                    partition_key=dynamodb.Attribute(name="written_hour", type=dynamodb.AttributeType.STRING),
+                    sort_key=dynamodb.Attribute(name="written_at", type=dynamodb.AttributeType.NUMBER),
+                    projection_type=dynamodb.ProjectionType.INCLUDE,
+                    non_key_attributes=[ttl_column_name, "embedding", "scope"],
+                )
+            ],
         )
 
         api_lambda_config = LambdaConfig(
@@ -160,29 +244,50 @@ class RAGStack(Stack):
             index_module_path="api/index.py",
             timeout=Duration.seconds(30),
             memory_size_mb=256,
+            # Served by uvicorn behind the Lambda Web Adapter, Mangum can only return buffered responses
+            web_adapter_startup_script="run.sh",
             function_url_config=FunctionUrlConfig(
                 auth_type=_lambda.FunctionUrlAuthType.NONE,
-                invoke_mode=_lambda.InvokeMode.BUFFERED,
+                invoke_mode=_lambda.InvokeMode.RESPONSE_STREAM,
             ),
             environment=ApiSettings(
                 s3_bucket_name=bucket.bucket_name,
+                artifact_bucket_name=artifact_bucket.bucket_name,
+                documents_table_name=documents_table.table_name,
+                documents_status_index_name=documents_status_index_name,
                 pinecone_api_key_secret_name=pinecone_api_secret.secret_name,
                 cache_table_name=cache_table.table_name,
                 cache_table_ttl_column_name=ttl_column_name,
+                cache_table_time_index_name=cache_time_index_name,
                 partition_key_column_name=partition_key_column_name,
             ),
             secret_names_to_read=[pinecone_api_secret.secret_name],
         )
         api_lambda, function_url = self._get_lambda(api_lambda_config)
         bucket.grant_read_write(api_lambda)
+        artifact_bucket.grant_read(api_lambda)
+        documents_table.grant_read_write_data(api_lambda)
         cache_table.grant_read_write_data(api_lambda)
         api_lambda.add_to_role_policy(
             statement=iam.PolicyStatement(
-                actions=["bedrock:InvokeModel"],
+                actions=["bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream"],
                 resources=["*"],
             )
         )
 
+        # Keeps a container warm with primed connections, see api/services/warmup.py
+        events.Rule(
+            self,
+            "RAGApiWarmupRule",
+            schedule=events.Schedule.rate(Duration.minutes(5)),
+            targets=[
+                events_targets.LambdaFunction(
+                    api_lambda,  # type: ignore
+                    event=events.RuleTargetInput.from_object({"warmup": True}),
+                )
+            ],
+        )
+
         CfnOutput(self, "ApiUrl", value=function_url.url)
 
         PineconeIndex(
@@ -192,6 +297,8 @@ class RAGStack(Stack):
                 PineconeIndexSettings(
                     api_key_secret_name=pinecone_api_secret.secret_name,  # store as a string in secrets manager, NOT a key/value secret
                     dimension=1536,
+                    # Sparse-dense vectors are only supported by dotproduct indexes
+                    metric=DistanceMetric.DOT_PRODUCT,
                     removal_policy=RemovalPolicy.DESTROY,
                     pod_spec=ServerlessSpec(
                         cloud_provider=CloudProvider.AWS,
@@ -218,9 +325,19 @@ class RAGStack(Stack):
                 "**/__pycache__",
                 "**/*.egg-info/",
                 "**/tests",
+                "**/benchmarks",
                 "README.md",
                 "poetry.toml",
             ],
+            volumes=[
+                DockerVolume(
+                    host_path=SHARED_PACKAGE_DIRECTORY.as_posix(),
+                    container_path=CopySharedPackage.container_path,
+                )
+            ],
+            command_hooks=CopySharedPackage(),
+            # The entry directory alone doesn't cover the shared package
+            asset_hash_type=AssetHashType.OUTPUT,
         )
         index_directory = Path(config.index_directory)
         func = lambda_alpha.PythonFunction(
@@ -244,6 +361,21 @@ class RAGStack(Stack):
             secret = secretsmanager.Secret.from_secret_name_v2(self, f"{config.construct_id}{secret_name}", secret_name)
             secret.grant_read(func)
 
+        if config.web_adapter_startup_script:
+            func.add_layers(
+                _lambda.LayerVersion.from_layer_version_arn(
+                    self,
+                    f"{config.construct_id}WebAdapterLayer",
+                    f"arn:aws:lambda:{self.region}:753240598075:layer:LambdaAdapterLayerX86:24",
+                )
+            )
+            func.add_environment("AWS_LAMBDA_EXEC_WRAPPER", "/opt/bootstrap")
+            func.add_environment("PORT", "8080")
+            func.add_environment("AWS_LWA_READINESS_CHECK_PATH", "/health-check/")
+            # The adapter's wrapper executes the handler as the startup script, PythonFunction always sets `module.handler`
+            cfn_function = func.node.default_child
+            assert isinstance(cfn_function, _lambda.CfnFunction)
+            cfn_function.handler = config.web_adapter_startup_script
         if config.function_url_config:
             if config.function_url_config.invoke_mode == _lambda.InvokeMode.RESPONSE_STREAM:
                 func.add_environment("AWS_LWA_INVOKE_MODE", "RESPONSE_STREAM")
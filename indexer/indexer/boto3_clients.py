@@ -1,13 +1,16 @@
-from boto3 import client
+from boto3 import client, resource
 from botocore.config import Config
 
-client_config = Config(
-    max_pool_connections=300,
+# The embedding engine retries every request itself and adapts its concurrency to throttling, retries in the client
+# would hide the throttling from it
+bedrock_client_config = Config(
+    max_pool_connections=128,
     retries={
-        "mode": "adaptive",
-        "max_attempts": 10,
+        "mode": "standard",
+        "max_attempts": 1,
     }
 )
 
 S3_CLIENT = client("s3")
-BEDROCK_CLIENT = client("bedrock-runtime", config=client_config)
+BEDROCK_CLIENT = client("bedrock-runtime", config=bedrock_client_config)
+DYNAMODB_RESOURCE = resource("dynamodb")
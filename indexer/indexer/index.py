@@ -1,13 +1,24 @@
 import json
-from typing import Dict, List, Any
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Any, DefaultDict, Dict, List, Optional, Set
+from urllib.parse import unquote_plus
 
+import pyarrow as pa
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from aws_lambda_powertools.utilities.data_classes import SQSEvent, event_source
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+from botocore.exceptions import ClientError
 
+from indexer.boto3_clients import S3_CLIENT
 from indexer.services.extract import EXTRACT
 from indexer.services.transform import TRANSFORM
 from indexer.services.load import LOAD
+from indexer.services.bm25 import CORPUS_STATISTICS, DocumentStatistics
+from indexer.services.dedup import DEDUP_INDEX
+from indexer.services.document_store import DOCUMENT_STORE
+from indexer.services.documents import DOCUMENT_REGISTRY, Checkpoint, DocumentStateError
 from indexer.settings import Settings
 
 
@@ -16,51 +27,300 @@ SETTINGS = Settings()  # type: ignore - pulled from the environment
 LOGGER = Logger(level=SETTINGS.log_level)
 
 
+@dataclass
+class ObjectEvent:
+    """An S3 notification about one object."""
+
+    message_id: str
+    event_name: str
+    s3_object: Dict[str, Any]
+
+    @property
+    def key(self) -> str:
+        # Keys are URL encoded in notifications
+        return unquote_plus(self.s3_object["key"])
+
+    @property
+    def sequencer(self) -> int:
+        # Orders the events of the same object, hexadecimal strings of varying length
+        return int(self.s3_object.get("sequencer") or "0", 16)
+
+
 @LOGGER.inject_lambda_context(log_event=True)
 @event_source(data_class=SQSEvent)
-def handler(event: SQSEvent, _: LambdaContext) -> Dict[str, Any]:
+def handler(event: SQSEvent, context: LambdaContext) -> Dict[str, Any]:
+    """
+    Process a batch of S3 notifications, every object once whatever the number of messages about it.
+
+    Only the latest event of an object is run, the created objects in a single indexing run. The messages about the
+    objects that failed are returned as `batchItemFailures`, SQS redelivers them and deletes the others.
+    """
     LOGGER.debug(f"Processing SQS event: {event}")
 
+    failed_messages: Set[str] = set()
+    latest: Dict[str, ObjectEvent] = {}
+    messages: DefaultDict[str, Set[str]] = defaultdict(set)
     for record in event.records:
-        # event_name = json.loads(record.body)["Records"][0]["eventName"]
-        # body *ma* be a dict and not a list if only one record is sent need to handle both cases, in the case where it's not a list, the Records key is not present
-        body = json.loads(record.body)
-        if "Records" in body:
-            event_name = json.loads(record.body)["Records"][0]["eventName"]
-        else:
-            event_name = json.loads(record.body)["Event"]
-        LOGGER.info(f"Processing event: {event_name}")
-        if event_name == "ObjectCreated:Put":
-            put_vectors(event, _)
-        elif event_name == "ObjectRemoved:DeleteMarkerCreated":
-            delete_vectors(event, _)
-        else:
-            LOGGER.warning(f"Unsupported event: {event_name}")
-
-    return {"statusCode": 200, "body": json.dumps({"message": "SQS event processed", "records": len(list(event.records))})}
-
-
-def delete_vectors(event: SQSEvent, _: LambdaContext) -> None:
-    for record in event.records:
-        document_id = json.loads(record.body)["Records"][0]["s3"]["object"]["key"]
+        try:
+            object_events = parse_message(record)
+        except (ValueError, KeyError, TypeError) as e:
+            LOGGER.error(f"Failed to parse message '{record.message_id}': {str(e)}")
+            failed_messages.add(record.message_id)
+            continue
+        for object_event in object_events:
+            messages[object_event.key].add(record.message_id)
+            previous = latest.get(object_event.key)
+            if previous is None or object_event.sequencer >= previous.sequencer:
+                latest[object_event.key] = object_event
+
+    # Every kind of create (put, post, copy, multipart upload) and remove (delete, delete marker) is handled the same
+    removed = [key for key, object_event in latest.items() if object_event.event_name.startswith("ObjectRemoved:")]
+    created = {
+        key: object_event
+        for key, object_event in latest.items()
+        if object_event.event_name.startswith("ObjectCreated:")
+    }
+    for key in latest.keys() - set(removed) - created.keys():
+        LOGGER.warning(f"Unsupported event: {latest[key].event_name}")
+    LOGGER.info(f"Processing {len(removed)} removed and {len(created)} created objects")
+
+    failed_keys = delete_documents(removed, context) if removed else set()
+    if created:
+        failed_keys.update(put_documents(created, context))
+
+    failed_messages.update(message_id for key in failed_keys for message_id in messages[key])
+    if failed_messages:
+        LOGGER.warning(f"Reporting {len(failed_messages)} failed messages for redelivery")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in sorted(failed_messages)]}
+
+
+def parse_message(record: SQSRecord) -> List[ObjectEvent]:
+    body = json.loads(record.body)
+    if "Records" not in body:
+        # The test event S3 sends when the notification is configured
+        LOGGER.info(f"Ignoring event: {body.get('Event')}")
+        return []
+    return [
+        ObjectEvent(record.message_id, event_name=s3_record["eventName"], s3_object=s3_record["s3"]["object"])
+        for s3_record in body["Records"]
+    ]
+
+
+def delete_documents(document_ids: List[str], context: LambdaContext) -> Set[str]:
+    """Delete the documents, returns the ones that failed."""
+    failed = set()
+    dependents = set()
+    for document_id in document_ids:
         LOGGER.info(f"Deleting vectors for document '{document_id}'")
-        LOAD.delete_vectors(document_id)
+        try:
+            LOAD.delete_vectors(document_id, DOCUMENT_REGISTRY.get_vector_rows(document_id))
+            released, document_dependents = DEDUP_INDEX.remove_document(document_id)
+            LOAD.update_document_ids(released)
+            dependents.update(document_dependents)
+            DOCUMENT_STORE.remove_document(document_id)
+            DOCUMENT_REGISTRY.remove(document_id)
+        except Exception:
+            LOGGER.exception(f"Failed to delete document '{document_id}'")
+            failed.add(document_id)
+            continue
         LOGGER.info(f"Deleted vectors for document '{document_id}'")
+    try:
+        CORPUS_STATISTICS.remove_documents([document_id for document_id in document_ids if document_id not in failed])
+    except Exception:
+        # The shards are only removed once the corpus is updated, the redelivered deletes remove them again
+        LOGGER.exception("Failed to remove the BM25 statistics of the deleted documents")
+        return set(document_ids)
 
+    # Their duplicate rows were indexed through the deleted documents' vectors
+    dependents.difference_update(document_ids)
+    if dependents:
+        LOGGER.info(f"Re-indexing documents with rows collapsed into deleted documents: {sorted(dependents)}")
+        try:
+            reindexing = {document_id: None for document_id in sorted(dependents)}
+            if failed_dependents := index_documents(reindexing, context, reindex=True):
+                LOGGER.error(f"Failed to re-index the documents that depended on them: {sorted(failed_dependents)}")
+        except Exception:
+            # The deletes are done, redelivering them wouldn't find the dependents again. The documents are failed in
+            # the registry and are indexed again when they are uploaded.
+            LOGGER.exception("Failed to re-index the documents that depended on the deleted documents")
+    return failed
 
-def put_vectors(event: SQSEvent, _: LambdaContext) -> None:
-    s3_keys = []
-    for record in event.records:
-        s3_keys.append(json.loads(record.body)["Records"][0]["s3"]["object"]["key"])
 
-    LOGGER.info(f"Processing keys: {s3_keys}")
-    extracted_records = EXTRACT.extract(s3_keys)
-    LOGGER.info(f"Extracted {len(extracted_records)} records")
-    LOGGER.debug(f"First 3 records: {extracted_records[:3]}")
+def put_documents(object_events: Dict[str, ObjectEvent], context: LambdaContext) -> Set[str]:
+    """Index the created objects, returns the ones that failed."""
+    documents = {}
+    failed = set()
+    for key, object_event in object_events.items():
+        try:
+            documents[key] = get_source_version(key, object_event.s3_object)
+        except ClientError as e:
+            LOGGER.error(f"Failed to get the version of document '{key}': {str(e)}")
+            failed.add(key)
+    try:
+        failed.update(index_documents(documents, context))
+    except Exception:
+        # The whole run stopped, the checkpoints keep what each of the documents got through
+        LOGGER.exception(f"Failed to index documents: {list(documents)}")
+        failed.update(documents)
+    return failed
+
+
+def get_source_version(key: str, s3_object: Dict[str, Any]) -> str:
+    """The version id of the object in a versioned bucket, its ETag otherwise."""
+    if s3_object.get("versionId"):
+        return s3_object["versionId"]
+    if s3_object.get("eTag"):
+        return s3_object["eTag"]
+    return S3_CLIENT.head_object(Bucket=SETTINGS.s3_bucket_name, Key=key)["ETag"].strip('"')
+
+
+class IndexingDeadlineError(Exception):
+    """The Lambda is about to time out, the indexing stopped at a checkpoint."""
+
+
+def index_documents(documents: Dict[str, Optional[str]], context: LambdaContext, reindex: bool = False) -> Set[str]:
+    """
+    Index the documents, by S3 key and source version, returns the ones that failed.
+
+    A document that fails is failed on its own, the others are still indexed. Errors that concern the whole run, like
+    reaching the deadline, are raised.
+
+    Progress is checkpointed every `checkpoint_interval_rows` rows of a document: the registry records the rows done
+    and the BM25 and dedup shards hold their statistics. A redelivered event skips the versions that are indexed and
+    resumes the others from their checkpoint, so rows are embedded and loaded once.
+    """
+    checkpoints: Dict[str, Checkpoint] = {}
+    for s3_key, source_version in documents.items():
+        try:
+            checkpoint = DOCUMENT_REGISTRY.start_indexing(s3_key, source_version, reindex=reindex)
+        except DocumentStateError:
+            LOGGER.warning(f"Skipping document '{s3_key}', it is being deleted")
+            continue
+        if checkpoint is not None:
+            checkpoints[s3_key] = checkpoint
+    if not checkpoints:
+        return set()
+    indexing_keys = list(checkpoints)
+    start_rows = {s3_key: checkpoint.rows for s3_key, checkpoint in checkpoints.items() if checkpoint.rows}
+    # Rows indexed before the checkpoints, the dedup run counts the rows of this run
+    indexed_before = {s3_key: checkpoint.indexed for s3_key, checkpoint in checkpoints.items()}
+
+    LOGGER.info(f"Processing keys: {indexing_keys}")
+    row_counts: Counter = Counter(start_rows)
+    statistics: DefaultDict[str, DocumentStatistics] = defaultdict(DocumentStatistics)
+    # The vector manifests before this run, and as they are advanced ahead of the upserts
+    manifests = {s3_key: DOCUMENT_REGISTRY.get_vector_rows(s3_key) for s3_key in indexing_keys}
+    vector_rows = {s3_key: rows or 0 for s3_key, rows in manifests.items()}
+    # First rows of the document store parts written in this run
+    parts: DefaultDict[str, Set[int]] = defaultdict(set)
+    for s3_key in start_rows:
+        statistics[s3_key] = CORPUS_STATISTICS.get_checkpoint(s3_key) or DocumentStatistics()
+    # The document weights are normalized against the corpus as it was before this run, close enough for BM25
+    average_length = CORPUS_STATISTICS.get_average_length()
+
+    def save_checkpoint(s3_key: str) -> None:
+        # The shards go first, a crash before the registry update only indexes their last rows again
+        dedup.save([s3_key])
+        CORPUS_STATISTICS.checkpoint_document(s3_key, statistics[s3_key])
+        checkpoint = checkpoints[s3_key]
+        checkpoint.rows = row_counts[s3_key]
+        checkpoint.indexed = indexed_before[s3_key] + dedup.count_indexed()[s3_key]
+        DOCUMENT_REGISTRY.save_checkpoint(s3_key, checkpoint)
+        LOGGER.info(f"Checkpointed document '{s3_key}' after {checkpoint.rows} rows")
+
+    def index_chunk(s3_key: str, extracted_records: pa.RecordBatch) -> None:
+        LOGGER.info(f"Extracted {extracted_records.num_rows} records")
+        LOGGER.debug(f"First 3 records: {extracted_records.slice(0, 3).to_pylist()}")
+
+        unique_records = dedup.collapse(extracted_records)
+        LOGGER.info(f"Kept {unique_records.num_rows} records after collapsing duplicates")
+        if not unique_records.num_rows:
+            return
+        transformed_records = TRANSFORM.transform_data(unique_records)
+        LOGGER.info(f"Transformed {transformed_records.num_rows} records")
+        LOGGER.debug(f"First 3 records: {transformed_records.slice(0, 3).to_pylist()}")
+        dropped_rows = sorted(
+            set(unique_records.column("row_index").to_pylist())
+            - set(transformed_records.column("row_index").to_pylist())
+        )
+        if dropped_rows:
+            dedup.drop(s3_key, dropped_rows)
+            # A previous version's vectors of the rows that couldn't be embedded would point at text that the new part
+            # of the document store doesn't have
+            LOAD.delete_rows(s3_key, dropped_rows)
+        if not transformed_records.num_rows:
+            return
+        end_row = transformed_records.column("row_index")[-1].as_py() + 1
+        if end_row > vector_rows[s3_key]:
+            DOCUMENT_REGISTRY.record_vector_rows(s3_key, end_row)
+            vector_rows[s3_key] = end_row
+        # The text is stored before the vectors that reference it
+        parts[s3_key].add(DOCUMENT_STORE.put(transformed_records))
+        LOAD.load(transformed_records, average_length)
+        dedup.mark_loaded(transformed_records)
+        for term_frequencies, token_count in zip(
+            transformed_records.column("term_frequencies").to_pylist(),
+            transformed_records.column("token_count").to_pylist(),
+        ):
+            statistics[s3_key].add(term_frequencies, token_count)
+
+    failed: Set[str] = set()
+    try:
+        dedup = DEDUP_INDEX.start_run(indexing_keys, start_rows)
+        # Chunks are embedded and loaded as they are extracted, only one chunk of rows is held at a time
+        for s3_key, chunks in EXTRACT.iter_documents(indexing_keys, start_rows):
+            try:
+                for extracted_records in chunks:
+                    if context.get_remaining_time_in_millis() < SETTINGS.indexing_deadline_margin_seconds * 1000:
+                        remaining_ms = context.get_remaining_time_in_millis()
+                        raise IndexingDeadlineError(f"Stopped indexing with {remaining_ms} ms left")
+                    index_chunk(s3_key, extracted_records)
+                    row_counts[s3_key] += extracted_records.num_rows
+                    if row_counts[s3_key] - checkpoints[s3_key].rows >= SETTINGS.checkpoint_interval_rows:
+                        save_checkpoint(s3_key)
+            except IndexingDeadlineError:
+                raise
+            except Exception as e:
+                # Only this document is failed and redelivered, the chunks done since its last checkpoint are kept
+                LOGGER.exception(f"Failed to index document '{s3_key}'")
+                if row_counts[s3_key] > checkpoints[s3_key].rows:
+                    save_checkpoint(s3_key)
+                DOCUMENT_REGISTRY.fail_indexing(s3_key, str(e))
+                failed.add(s3_key)
+        indexed = dedup.count_indexed()
+        LOGGER.info(f"Indexed {sum(indexed.values())} records")
+
+        LOAD.update_document_ids(dedup.get_document_ids())
+        indexed_keys = [s3_key for s3_key in indexing_keys if s3_key not in failed]
+        dedup.save(indexed_keys)
+        # Every document gets a shard, even one whose rows were all collapsed into other documents' vectors
+        CORPUS_STATISTICS.add_documents({s3_key: statistics[s3_key] for s3_key in indexed_keys})
+        for s3_key in indexed_keys:
+            # Parts of a previous version of the document whose rows weren't written again
+            DOCUMENT_STORE.remove_document(s3_key, from_row=start_rows.get(s3_key, 0), keep=parts[s3_key])
+        for s3_key in indexed_keys:
+            # Only once the new version is complete, a failed run keeps the vectors it didn't replace
+            if indexed_before[s3_key] + indexed[s3_key] == row_counts[s3_key] > 0:
+                remove_stale_vectors(s3_key, row_counts[s3_key], manifests[s3_key], vector_rows[s3_key])
+    except Exception as e:
+        # The chunks done since the last checkpoint are kept, the redelivered event resumes after them
+        for s3_key in indexing_keys:
+            if s3_key not in failed and row_counts[s3_key] > checkpoints[s3_key].rows:
+                save_checkpoint(s3_key)
+        if not isinstance(e, IndexingDeadlineError):
+            for s3_key in indexing_keys:
+                if s3_key not in failed:
+                    DOCUMENT_REGISTRY.fail_indexing(s3_key, str(e))
+        raise
+
+    for s3_key in indexed_keys:
+        DOCUMENT_REGISTRY.finish_indexing(s3_key, row_counts[s3_key], indexed_before[s3_key] + indexed[s3_key])
+    return failed
 
-    transformed_records = TRANSFORM.transform_data(extracted_records)
-    LOGGER.info(f"Transformed {len(transformed_records)} records")
-    LOGGER.debug(f"First 3 records: {transformed_records[:3]}")
 
-    LOAD.load(transformed_records)
-    LOGGER.info(f"Loaded {len(transformed_records)} records into Pinecone")
+def remove_stale_vectors(s3_key: str, row_count: int, manifest: Optional[int], vector_rows: int) -> None:
+    """Delete the vectors of the rows a previous version of the document had past its end, and shrink the manifest."""
+    if manifest is None or vector_rows > row_count:
+        LOAD.delete_vectors(s3_key, None if manifest is None else vector_rows, from_row=row_count)
+    if vector_rows != row_count:
+        DOCUMENT_REGISTRY.record_vector_rows(s3_key, row_count)
@@ -1,29 +1,37 @@
-from typing import List
-from pydantic import BaseModel
+import numpy as np
+import pyarrow as pa
 
 
-class RawData(BaseModel):
+# Rows move through the pipeline as Arrow record batches, one row per vector
 
-    question: str
-    distractor3: str
-    distractor1: str
-    distractor2: str
-    correct_answer: str
-    support: str
-    document_id: str
+RAW_SCHEMA = pa.schema(
+    [
+        pa.field("question", pa.string(), nullable=False),
+        pa.field("correct_answer", pa.string(), nullable=False),
+        pa.field("support", pa.string(), nullable=False),
+        pa.field("document_id", pa.string(), nullable=False),
+        # Position of the row in its document, vector ids are derived from it
+        pa.field("row_index", pa.int64(), nullable=False),
+    ]
+)
 
+TRANSFORMED_SCHEMA = RAW_SCHEMA.append(
+    # BM25 statistics of the vector, see services/bm25.py
+    pa.field("term_frequencies", pa.string(), nullable=False)
+).append(pa.field("token_count", pa.int64(), nullable=False))
 
-class TransformedData(BaseModel):
+EMBEDDING_COLUMN = "embedding"
 
-    question: str
-    correct_answer: str
-    support: str
-    document_id: str
 
+def with_embeddings(batch: pa.RecordBatch, embeddings: np.ndarray) -> pa.RecordBatch:
+    """Append a float32 matrix as a fixed size list column, the column shares the matrix buffer."""
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    # A batch without rows has no known dimension, Arrow needs a positive list size
+    column = pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), max(matrix.shape[1], 1))
+    return batch.append_column(pa.field(EMBEDDING_COLUMN, column.type, nullable=False), column)
 
-class TransformedDataWithEmbedding(TransformedData):
 
-    question: str
-    correct_answer: str
-    support: str
-    embedding: List[float]
+def get_embeddings(batch: pa.RecordBatch) -> np.ndarray:
+    """The embedding column as an `(rows, dimension)` float32 matrix, without copying."""
+    column = batch.column(EMBEDDING_COLUMN)
+    return column.flatten().to_numpy(zero_copy_only=True).reshape(len(column), column.type.list_size)
@@ -0,0 +1,216 @@
+import gzip
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError
+from vector_index.bm25 import decode_term_frequencies, term_index
+
+from indexer.boto3_clients import S3_CLIENT
+from indexer.settings import Settings
+
+
+logger = Logger()
+
+def encode_sparse_vector(
+    term_frequencies: Dict[str, int], token_count: int, average_length: float, k1: float, b: float
+) -> Dict[str, List]:
+    """
+    BM25 document-side term weights as a sparse vector.
+
+    Queries are encoded with the IDF of their terms, so the dot product of the two vectors is the BM25 score.
+    """
+    length_norm = k1 * (1 - b + b * token_count / (average_length or 1.0))
+    weights: Dict[int, float] = {}
+    for term, count in term_frequencies.items():
+        index = term_index(term)
+        weights[index] = weights.get(index, 0.0) + count * (k1 + 1) / (count + length_norm)
+    return {"indices": list(weights), "values": list(weights.values())}
+
+
+@dataclass
+class DocumentStatistics:
+    """BM25 statistics of a single document, accumulated as its chunks are transformed."""
+
+    num_vectors: int = 0
+    total_length: int = 0
+    document_frequencies: Counter = field(default_factory=Counter)
+
+    def add(self, term_frequencies: str, token_count: int) -> None:
+        self.document_frequencies.update(decode_term_frequencies(term_frequencies).keys())
+        self.total_length += token_count
+        self.num_vectors += 1
+
+
+class CorpusStatistics:
+    """
+    Document frequency and length statistics for BM25, persisted in the artifact bucket.
+
+    Every indexed document has its own shard with the statistics it contributes to the corpus artifact that the API
+    reads. Adding or removing documents merges the difference with their shards into the corpus totals with a
+    conditional write, so concurrent runs don't overwrite each other and no run reads every shard. `rebuild` merges
+    every shard from scratch, to repair the totals after a run stopped between the two writes.
+
+    A document being indexed checkpoints its statistics to a separate shard, it is only added to the corpus once done.
+    """
+
+    def __init__(self, settings: Settings):
+        self.bucket_name = settings.artifact_bucket_name
+        self.shard_prefix = "bm25/documents/"
+        self.checkpoint_prefix = "bm25/checkpoints/"
+        self.corpus_key = "bm25/corpus.json.gz"
+        self.update_max_attempts = 5
+
+    def checkpoint_document(self, document_id: str, statistics: DocumentStatistics) -> None:
+        self._put(f"{self.checkpoint_prefix}{document_id}.json.gz", self._encode(statistics))
+        logger.info(f"Checkpointed BM25 statistics for document '{document_id}' with {statistics.num_vectors} vectors")
+
+    def get_checkpoint(self, document_id: str) -> Optional[DocumentStatistics]:
+        shard = self._get(f"{self.checkpoint_prefix}{document_id}.json.gz")
+        return self._decode(shard) if shard is not None else None
+
+    def add_documents(self, statistics: Dict[str, DocumentStatistics]) -> None:
+        """Replace the documents' contributions to the corpus with `statistics`."""
+        self._update(statistics)
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(self._put_shard, statistics, statistics.values()))
+            list(executor.map(self._delete_checkpoint, statistics))
+        logger.info(f"Stored BM25 statistics for {len(statistics)} documents")
+
+    def remove_documents(self, document_ids: List[str]) -> None:
+        self._update({document_id: None for document_id in document_ids})
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(lambda document_id: self._delete(self._shard_key(document_id)), document_ids))
+            list(executor.map(self._delete_checkpoint, document_ids))
+        logger.info(f"Removed BM25 statistics for {len(document_ids)} documents")
+
+    def get_average_length(self) -> Optional[float]:
+        corpus = self._get(self.corpus_key)
+        return corpus["average_length"] if corpus else None
+
+    def rebuild(self) -> None:
+        """Merge all document shards into the corpus artifact."""
+        keys = []
+        paginator = S3_CLIENT.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.shard_prefix):
+            keys.extend(item["Key"] for item in page.get("Contents", []))
+
+        totals = DocumentStatistics()
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            for shard in executor.map(self._get, keys):
+                if shard is not None:
+                    self._merge(totals, self._decode(shard), 1)
+        self._put(self.corpus_key, self._encode_corpus(totals))
+        logger.info(f"Rebuilt BM25 corpus statistics from {len(keys)} documents and {totals.num_vectors} vectors")
+
+    def _update(self, statistics: Dict[str, Optional[DocumentStatistics]]) -> None:
+        # Only the shards of the documents that change are read, their difference is merged into the totals
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            previous = list(executor.map(lambda document_id: self._get(self._shard_key(document_id)), statistics))
+        delta = DocumentStatistics()
+        for shard, document_statistics in zip(previous, statistics.values()):
+            if shard is not None:
+                self._merge(delta, self._decode(shard), -1)
+            if document_statistics is not None:
+                self._merge(delta, document_statistics, 1)
+
+        for attempt in range(1, self.update_max_attempts + 1):
+            corpus, etag = self._get_corpus()
+            self._merge(corpus, delta, 1)
+            # Creating the corpus must not overwrite one a concurrent run created in the meantime
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+            try:
+                self._put(self.corpus_key, self._encode_corpus(corpus), **condition)
+                return
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                if attempt == self.update_max_attempts:
+                    raise
+                logger.info(f"BM25 corpus statistics changed concurrently, merging again (attempt {attempt})")
+
+    def _get_corpus(self) -> Tuple[DocumentStatistics, Optional[str]]:
+        try:
+            response = S3_CLIENT.get_object(Bucket=self.bucket_name, Key=self.corpus_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return DocumentStatistics(), None
+            raise
+        corpus = json.loads(gzip.decompress(response["Body"].read()))
+        # Corpora merged before the total length was stored only have the average
+        total_length = corpus.get("total_length", round(corpus["average_length"] * corpus["num_vectors"]))
+        return (
+            DocumentStatistics(
+                num_vectors=corpus["num_vectors"],
+                total_length=total_length,
+                document_frequencies=Counter(corpus["document_frequencies"]),
+            ),
+            response["ETag"],
+        )
+
+    def _merge(self, totals: DocumentStatistics, statistics: DocumentStatistics, sign: int) -> None:
+        totals.num_vectors += sign * statistics.num_vectors
+        totals.total_length += sign * statistics.total_length
+        for term, count in statistics.document_frequencies.items():
+            totals.document_frequencies[term] += sign * count
+            if not totals.document_frequencies[term]:
+                del totals.document_frequencies[term]
+
+    def _encode(self, statistics: DocumentStatistics) -> Dict:
+        return {
+            "num_vectors": statistics.num_vectors,
+            "total_length": statistics.total_length,
+            "document_frequencies": dict(statistics.document_frequencies),
+        }
+
+    def _decode(self, shard: Dict) -> DocumentStatistics:
+        return DocumentStatistics(
+            num_vectors=shard["num_vectors"],
+            total_length=shard["total_length"],
+            document_frequencies=Counter(shard["document_frequencies"]),
+        )
+
+    def _encode_corpus(self, totals: DocumentStatistics) -> Dict:
+        return {
+            **self._encode(totals),
+            "average_length": totals.total_length / totals.num_vectors if totals.num_vectors > 0 else 0.0,
+        }
+
+    def _put_shard(self, document_id: str, statistics: DocumentStatistics) -> None:
+        self._put(self._shard_key(document_id), self._encode(statistics))
+
+    def _delete_checkpoint(self, document_id: str) -> None:
+        self._delete(f"{self.checkpoint_prefix}{document_id}.json.gz")
+
+    def _delete(self, key: str) -> None:
+        S3_CLIENT.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def _shard_key(self, document_id: str) -> str:
+        return f"{self.shard_prefix}{document_id}.json.gz"
+
+    def _get(self, key: str) -> Optional[Dict]:
+        try:
+            response = S3_CLIENT.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            # The corpus doesn't exist before the first rebuild, and a shard can be removed by a concurrent delete
+            # between listing and reading it
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return json.loads(gzip.decompress(response["Body"].read()))
+
+    def _put(self, key: str, value: Dict, **kwargs) -> None:
+        body = gzip.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        S3_CLIENT.put_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            Body=body,
+            ContentType="application/gzip",
+            **kwargs,
+        )
+
+
+CORPUS_STATISTICS = CorpusStatistics(Settings())  # type: ignore - pulled from the environment
@@ -0,0 +1,437 @@
+import hashlib
+import io
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import DefaultDict, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pyarrow as pa
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError
+from vector_index.bm25 import tokenize
+
+from indexer.boto3_clients import S3_CLIENT
+from indexer.settings import Settings
+from indexer.services.transform import EMBEDDING_INPUT_FIELDS
+
+
+logger = Logger()
+
+NUM_PERMUTATIONS = 64
+# 16 bands of 4 rows, pairs above ~0.5 Jaccard similarity are likely to share a band and are then compared exactly
+NUM_BANDS = 16
+SHINGLE_SIZE = 3
+# A prime above 2**32, so the permutations of 32 bit shingle hashes don't collide
+PRIME = 4294967311
+
+# A row is identified by its document and its position in it, the vector id is derived from the pair
+RowKey = Tuple[str, int]
+
+
+@dataclass
+class DocumentShard:
+    """The rows of a document that are canonical vectors, and the rows collapsed into another row's vector."""
+
+    canonical_rows: np.ndarray
+    signatures: np.ndarray
+    exact_hashes: np.ndarray
+    reference_rows: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int64))
+    reference_documents: List[str] = field(default_factory=list)
+    reference_canonical_rows: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int64))
+
+
+class CanonicalIndex:
+    """Canonical rows by exact hash and by MinHash band, the rows of removed documents are skipped until compacted."""
+
+    def __init__(self):
+        self._keys: List[RowKey] = []
+        self._signatures: List[np.ndarray] = []
+        self._exact: DefaultDict[int, List[int]] = defaultdict(list)
+        self._bands: DefaultDict[Tuple[int, bytes], List[int]] = defaultdict(list)
+        self._positions: DefaultDict[str, List[int]] = defaultdict(list)
+        self._removed: Set[int] = set()
+
+    def add(self, key: RowKey, signature: np.ndarray, exact_hash: int) -> None:
+        position = len(self._keys)
+        self._keys.append(key)
+        self._signatures.append(signature)
+        self._exact[exact_hash].append(position)
+        self._positions[key[0]].append(position)
+        for band in band_keys(signature):
+            self._bands[band].append(position)
+
+    def add_shard(self, document_id: str, shard: DocumentShard) -> None:
+        for row, signature, exact_hash in zip(shard.canonical_rows.tolist(), shard.signatures, shard.exact_hashes):
+            self.add((document_id, row), signature, int(exact_hash))
+
+    def remove_rows(self, document_id: str, rows: Set[int]) -> None:
+        positions = self._positions.get(document_id, [])
+        removed = {position for position in positions if self._keys[position][1] in rows}
+        self._removed.update(removed)
+        self._positions[document_id] = [position for position in positions if position not in removed]
+
+    def remove_document(self, document_id: str) -> None:
+        self._removed.update(self._positions.pop(document_id, []))
+        if len(self._removed) > len(self._keys) // 2:
+            self._compact()
+
+    def find(self, signature: np.ndarray, exact_hash: int, exclude: Set[str]) -> Tuple[Optional[RowKey], float]:
+        """The most similar canonical row outside the `exclude` documents, and its similarity."""
+        for position in self._exact.get(exact_hash, ()):
+            if self._is_candidate(position, exclude):
+                return self._keys[position], 1.0
+        candidates = {position for band in band_keys(signature) for position in self._bands.get(band, ())}
+        best, best_similarity = None, 0.0
+        for position in sorted(candidates):
+            if not self._is_candidate(position, exclude):
+                continue
+            similarity = float(np.mean(self._signatures[position] == signature))
+            if similarity > best_similarity:
+                best, best_similarity = self._keys[position], similarity
+        return best, best_similarity
+
+    def _is_candidate(self, position: int, exclude: Set[str]) -> bool:
+        return position not in self._removed and self._keys[position][0] not in exclude
+
+    def _compact(self) -> None:
+        exact_hashes = {position: exact_hash for exact_hash, positions in self._exact.items() for position in positions}
+        live = [
+            (self._keys[position], self._signatures[position], exact_hashes[position])
+            for position in range(len(self._keys))
+            if position not in self._removed
+        ]
+        self._keys, self._signatures, self._removed = [], [], set()
+        self._exact, self._bands, self._positions = defaultdict(list), defaultdict(list), defaultdict(list)
+        for key, signature, exact_hash in live:
+            self.add(key, signature, exact_hash)
+
+
+def band_keys(signature: np.ndarray) -> List[Tuple[int, bytes]]:
+    rows = NUM_PERMUTATIONS // NUM_BANDS
+    return [(band, signature[band * rows : (band + 1) * rows].tobytes()) for band in range(NUM_BANDS)]
+
+
+class DedupRun:
+    """
+    Collapses the duplicate rows of the documents indexed in one run.
+
+    A row whose content, the question, answer and support that are embedded, has the same tokens as, or a MinHash
+    Jaccard similarity above the threshold with, a canonical row is not indexed, it is counted as indexed through the
+    canonical row's vector. Canonical rows are the first occurrences, either in the documents indexed before or earlier
+    in this run.
+
+    A resumed document is seeded with the rows its shard recorded before the checkpoint, they are already loaded and
+    counted by the checkpoint.
+    """
+
+    def __init__(
+        self,
+        dedup_index: "DedupIndex",
+        document_ids: List[str],
+        resumed: Optional[Dict[str, DocumentShard]] = None,
+    ):
+        self.dedup_index = dedup_index
+        # The indexed documents' canonical rows are shared by the runs, the previous versions of this run's are skipped
+        self._document_ids = set(document_ids)
+        self._canonicals = CanonicalIndex()
+        self._existing: Set[RowKey] = set()
+        # Documents of this run referencing a canonical row, on top of the other documents' references
+        self._references: DefaultDict[RowKey, Set[str]] = defaultdict(set)
+        self._touched: Set[RowKey] = set()
+        self._run_references: DefaultDict[str, List[Tuple[int, RowKey]]] = defaultdict(list)
+        self._run_canonicals: DefaultDict[str, List[Tuple[int, np.ndarray, int]]] = defaultdict(list)
+        self._loaded: Set[RowKey] = set()
+        self._seeded: Set[RowKey] = set()
+        for document_id, shard in (resumed or {}).items():
+            for row, signature, exact_hash in zip(shard.canonical_rows.tolist(), shard.signatures, shard.exact_hashes):
+                self._canonicals.add((document_id, row), signature, int(exact_hash))
+                self._run_canonicals[document_id].append((row, signature, int(exact_hash)))
+                self._existing.add((document_id, row))
+            for row, canonical_document, canonical_row in zip(
+                shard.reference_rows.tolist(), shard.reference_documents, shard.reference_canonical_rows.tolist()
+            ):
+                self._record_reference((document_id, row), (canonical_document, canonical_row))
+            self._seeded.update((document_id, row) for row in shard.reference_rows.tolist())
+
+    def collapse(self, records: pa.RecordBatch) -> pa.RecordBatch:
+        """The canonical rows of `records`, the duplicates are recorded against the row they collapse into."""
+        if not self.dedup_index.enabled:
+            return records
+        keep = np.ones(records.num_rows, dtype=bool)
+        rows = zip(
+            records.column("document_id").to_pylist(),
+            records.column("row_index").to_pylist(),
+            *(records.column(name).to_pylist() for name in EMBEDDING_INPUT_FIELDS),
+        )
+        for i, (document_id, row, *content) in enumerate(rows):
+            tokens = tokenize(" ".join(content))
+            if len(tokens) < self.dedup_index.min_tokens:
+                # Too short to tell a duplicate passage from a coincidence
+                continue
+            normalized = " ".join(tokens).encode("utf-8")
+            exact_hash = int.from_bytes(hashlib.blake2b(normalized, digest_size=8).digest(), "big")
+            signature = self.dedup_index.signature(tokens)
+            canonical = self._find(signature, exact_hash)
+            if canonical is None:
+                self._canonicals.add((document_id, row), signature, exact_hash)
+                self._run_canonicals[document_id].append((row, signature, exact_hash))
+                continue
+            keep[i] = False
+            self._record_reference((document_id, row), canonical)
+        if keep.all():
+            return records
+        return records.filter(pa.array(keep))
+
+    def drop(self, document_id: str, rows: List[int]) -> None:
+        """
+        Forget the canonical rows of a document that couldn't be embedded, they have no vector. The duplicates
+        collapsed into them have the same embedded content, they are left unindexed too.
+        """
+        dropped = set(rows)
+        self._canonicals.remove_rows(document_id, dropped)
+        if document_id in self._run_canonicals:
+            self._run_canonicals[document_id] = [
+                canonical for canonical in self._run_canonicals[document_id] if canonical[0] not in dropped
+            ]
+        for other_document_id, references in self._run_references.items():
+            self._run_references[other_document_id] = [
+                (row, key) for row, key in references if key[0] != document_id or key[1] not in dropped
+            ]
+        for row in dropped:
+            self._references.pop((document_id, row), None)
+            self._touched.discard((document_id, row))
+
+    def mark_loaded(self, records: pa.RecordBatch) -> None:
+        self._loaded.update(zip(records.column("document_id").to_pylist(), records.column("row_index").to_pylist()))
+
+    def count_indexed(self) -> Counter:
+        """Rows per document that have a vector, their own or the canonical row's they were collapsed into."""
+        indexed = Counter(document_id for document_id, _ in self._loaded)
+        for document_id, references in self._run_references.items():
+            indexed[document_id] += sum(
+                1
+                for row, key in references
+                if (document_id, row) not in self._seeded
+                and (key in self._loaded or key in self._existing or key[0] not in self._document_ids)
+            )
+        return indexed
+
+    def get_document_ids(self) -> Dict[RowKey, List[str]]:
+        """The source documents of the canonical rows whose sources changed in this run."""
+        touched = set(self._touched)
+        for document_id, canonicals in self._run_canonicals.items():
+            touched.update((document_id, row) for row, _, _ in canonicals if self._sources(document_id, row))
+        return {key: sorted({key[0], *self._sources(*key)}) for key in touched}
+
+    def save(self, document_ids: List[str]) -> None:
+        for document_id in document_ids:
+            canonicals = self._run_canonicals.get(document_id, [])
+            references = self._run_references.get(document_id, [])
+            shard = DocumentShard(
+                canonical_rows=np.array([row for row, _, _ in canonicals], dtype=np.int64),
+                signatures=np.array([signature for _, signature, _ in canonicals], dtype=np.uint32).reshape(
+                    -1, NUM_PERMUTATIONS
+                ),
+                exact_hashes=np.array([exact_hash for _, _, exact_hash in canonicals], dtype=np.uint64),
+                reference_rows=np.array([row for row, _ in references], dtype=np.int64),
+                reference_documents=[key[0] for _, key in references],
+                reference_canonical_rows=np.array([key[1] for _, key in references], dtype=np.int64),
+            )
+            self.dedup_index.put_shard(document_id, shard)
+        collapsed = sum(len(self._run_references.get(document_id, [])) for document_id in document_ids)
+        logger.info(f"Collapsed {collapsed} duplicate rows of {len(document_ids)} documents")
+
+    def _record_reference(self, key: RowKey, canonical_key: RowKey) -> None:
+        self._run_references[key[0]].append((key[1], canonical_key))
+        if canonical_key[0] != key[0]:
+            self._references[canonical_key].add(key[0])
+            self._touched.add(canonical_key)
+
+    def _sources(self, document_id: str, row: int) -> Set[str]:
+        # The other documents' references to the previous versions of this run's documents are stale
+        indexed = self.dedup_index.get_references((document_id, row)) - self._document_ids
+        return indexed | self._references.get((document_id, row), set())
+
+    def _find(self, signature: np.ndarray, exact_hash: int) -> Optional[RowKey]:
+        # The indexed documents' rows come first, like canonical rows found earlier in the run
+        best, best_similarity = max(
+            (
+                self.dedup_index.canonicals.find(signature, exact_hash, self._document_ids),
+                self._canonicals.find(signature, exact_hash, set()),
+            ),
+            key=lambda found: found[1],
+        )
+        return best if best_similarity >= self.dedup_index.similarity_threshold else None
+
+
+class DedupIndex:
+    """
+    MinHash signatures of the canonical rows of every indexed document, persisted in the artifact bucket.
+
+    Like the BM25 statistics every document has its own shard, so documents are added and removed independently. A
+    shard also records which of the document's rows were collapsed into another document's row: the canonical vector
+    lists the documents it stands for, and deleting its document re-indexes the documents that depend on it.
+
+    The shards are held in the container with a single band index of their canonical rows. A run lists the shards and
+    only reads the ones whose ETag changed since the container last saw them.
+    """
+
+    def __init__(self, settings: Settings):
+        self.bucket_name = settings.artifact_bucket_name
+        self.shard_prefix = "dedup/documents/"
+        self.enabled = settings.dedup_enabled
+        self.similarity_threshold = settings.dedup_similarity_threshold
+        self.min_tokens = settings.dedup_min_tokens
+        rng = np.random.default_rng(0)
+        self._a = rng.integers(1, 2**32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+        self._b = rng.integers(0, 2**32, size=NUM_PERMUTATIONS, dtype=np.uint64)
+        self.canonicals = CanonicalIndex()
+        # The shards by document with the ETag they were read at, and the documents referencing every canonical row
+        self._shards: Dict[str, Tuple[str, DocumentShard]] = {}
+        self._references: DefaultDict[RowKey, Set[str]] = defaultdict(set)
+
+    def start_run(self, document_ids: List[str], start_rows: Optional[Dict[str, int]] = None) -> DedupRun:
+        """
+        A run deduplicating against every indexed document but `document_ids`, which are being indexed. The documents
+        in `start_rows` resume from a checkpoint, with the rows their shards recorded before it.
+        """
+        if not self.enabled:
+            return DedupRun(self, document_ids)
+        self._sync()
+        resumed = {}
+        for document_id, start_row in (start_rows or {}).items():
+            if start_row and document_id in self._shards:
+                resumed[document_id] = self._before(self._shards[document_id][1], start_row)
+        return DedupRun(self, document_ids, resumed)
+
+    def get_references(self, key: RowKey) -> Set[str]:
+        """The indexed documents with rows collapsed into the canonical row."""
+        return self._references.get(key, set())
+
+    def remove_document(self, document_id: str) -> Tuple[Dict[RowKey, List[str]], Set[str]]:
+        """
+        Remove a document's shard.
+
+        Returns the new source documents of the other documents' canonical rows it was collapsed into, and the
+        documents that had rows collapsed into its canonical rows and must be re-indexed.
+        """
+        self._sync()
+        S3_CLIENT.delete_object(Bucket=self.bucket_name, Key=self._shard_key(document_id))
+        if document_id not in self._shards:
+            return {}, set()
+        shard = self._shards[document_id][1]
+        self._forget(document_id)
+        dependents = {
+            other_document_id
+            for (canonical_document, _), documents in self._references.items()
+            if canonical_document == document_id
+            for other_document_id in documents
+        }
+        released = {
+            (canonical_document, int(canonical_row))
+            for canonical_document, canonical_row in zip(shard.reference_documents, shard.reference_canonical_rows)
+            if canonical_document != document_id
+        }
+        document_ids = {key: sorted({key[0], *self.get_references(key)}) for key in released}
+        logger.info(f"Removed the dedup shard of document '{document_id}', {len(dependents)} documents depend on it")
+        return document_ids, dependents
+
+    def signature(self, tokens: List[str]) -> np.ndarray:
+        shingles = [" ".join(tokens[i : i + SHINGLE_SIZE]) for i in range(max(len(tokens) - SHINGLE_SIZE + 1, 1))]
+        hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64)
+        return ((hashes[:, None] * self._a + self._b) % PRIME).min(axis=0).astype(np.uint32)
+
+    def put_shard(self, document_id: str, shard: DocumentShard) -> None:
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            canonical_rows=shard.canonical_rows,
+            signatures=shard.signatures,
+            exact_hashes=shard.exact_hashes,
+            reference_rows=shard.reference_rows,
+            reference_documents=np.array(shard.reference_documents, dtype=np.str_),
+            reference_canonical_rows=shard.reference_canonical_rows,
+        )
+        response = S3_CLIENT.put_object(
+            Bucket=self.bucket_name, Key=self._shard_key(document_id), Body=buffer.getvalue()
+        )
+        self._remember(document_id, response["ETag"], shard)
+
+    def _sync(self) -> None:
+        """Bring the shards held in the container up to date with the bucket."""
+        etags = {}
+        paginator = S3_CLIENT.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.shard_prefix):
+            for item in page.get("Contents", []):
+                etags[item["Key"][len(self.shard_prefix) : -len(".npz")]] = item["ETag"]
+        for document_id in self._shards.keys() - etags.keys():
+            self._forget(document_id)
+        changed = [
+            document_id
+            for document_id, etag in etags.items()
+            if document_id not in self._shards or self._shards[document_id][0] != etag
+        ]
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            for document_id, read in zip(changed, executor.map(self._get_shard, changed)):
+                if read is None:
+                    self._forget(document_id)
+                else:
+                    self._remember(document_id, *read)
+        logger.info(f"Read {len(changed)} changed dedup shards of {len(etags)}")
+
+    def _remember(self, document_id: str, etag: str, shard: DocumentShard) -> None:
+        self._forget(document_id)
+        self._shards[document_id] = (etag, shard)
+        self.canonicals.add_shard(document_id, shard)
+        for canonical_document, canonical_row in zip(shard.reference_documents, shard.reference_canonical_rows):
+            self._references[(canonical_document, int(canonical_row))].add(document_id)
+
+    def _forget(self, document_id: str) -> None:
+        if document_id not in self._shards:
+            return
+        _, shard = self._shards.pop(document_id)
+        self.canonicals.remove_document(document_id)
+        for canonical_document, canonical_row in zip(shard.reference_documents, shard.reference_canonical_rows):
+            key = (canonical_document, int(canonical_row))
+            self._references[key].discard(document_id)
+            if not self._references[key]:
+                del self._references[key]
+
+    def _get_shard(self, document_id: str) -> Optional[Tuple[str, DocumentShard]]:
+        try:
+            response = S3_CLIENT.get_object(Bucket=self.bucket_name, Key=self._shard_key(document_id))
+        except ClientError as e:
+            # A shard can be removed by a concurrent delete between listing and reading it
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        with np.load(io.BytesIO(response["Body"].read())) as arrays:
+            return response["ETag"], DocumentShard(
+                canonical_rows=arrays["canonical_rows"],
+                signatures=arrays["signatures"],
+                exact_hashes=arrays["exact_hashes"],
+                reference_rows=arrays["reference_rows"],
+                reference_documents=arrays["reference_documents"].tolist(),
+                reference_canonical_rows=arrays["reference_canonical_rows"],
+            )
+
+    def _before(self, shard: DocumentShard, start_row: int) -> DocumentShard:
+        # The shard can be saved ahead of the checkpoint, its later rows are indexed again
+        canonical = shard.canonical_rows < start_row
+        reference = shard.reference_rows < start_row
+        return DocumentShard(
+            canonical_rows=shard.canonical_rows[canonical],
+            signatures=shard.signatures[canonical],
+            exact_hashes=shard.exact_hashes[canonical],
+            reference_rows=shard.reference_rows[reference],
+            reference_documents=[document for document, keep in zip(shard.reference_documents, reference) if keep],
+            reference_canonical_rows=shard.reference_canonical_rows[reference],
+        )
+
+    def _shard_key(self, document_id: str) -> str:
+        return f"{self.shard_prefix}{document_id}.npz"
+
+
+DEDUP_INDEX = DedupIndex(Settings())  # type: ignore - pulled from the environment
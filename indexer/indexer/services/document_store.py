@@ -0,0 +1,76 @@
+import sqlite3
+import tempfile
+from contextlib import closing
+from pathlib import Path
+from typing import Collection
+
+import pyarrow as pa
+from aws_lambda_powertools import Logger
+from vector_index.document_store import STORED_COLUMNS
+
+from indexer.boto3_clients import S3_CLIENT
+from indexer.settings import Settings
+
+
+logger = Logger()
+
+
+class DocumentStore:
+    """
+    Text and BM25 statistics of the indexed rows, read by the API to hydrate query results.
+
+    Every loaded chunk of a document is a SQLite file in the artifact bucket, keyed by the chunk's first row, so a
+    chunk is written once whether or not the indexing resumes from a checkpoint. The API reads the files through a
+    memory map, only for the results it returns.
+    """
+
+    def __init__(self, settings: Settings):
+        self.bucket_name = settings.artifact_bucket_name
+        self.part_prefix = "document-store/documents/"
+
+    def put(self, records: pa.RecordBatch) -> int:
+        """Store the rows of one document, returns the first row that keys the part."""
+        document_id = records.column("document_id")[0].as_py()
+        start_row = records.column("row_index")[0].as_py()
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "part.sqlite"
+            with closing(sqlite3.connect(path)) as connection:
+                connection.execute(
+                    "CREATE TABLE rows (row_index INTEGER PRIMARY KEY, question TEXT, correct_answer TEXT, "
+                    "support TEXT, term_frequencies TEXT, token_count INTEGER)"
+                )
+                connection.executemany(
+                    "INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?)",
+                    zip(*(records.column(name).to_pylist() for name in ("row_index", *STORED_COLUMNS))),
+                )
+                connection.commit()
+            S3_CLIENT.upload_file(str(path), self.bucket_name, self._part_key(document_id, start_row))
+        return start_row
+
+    def remove_document(self, document_id: str, from_row: int = 0, keep: Collection[int] = ()) -> None:
+        """Remove the parts of a document from `from_row` on, except the parts starting at a row in `keep`."""
+        prefix = f"{self.part_prefix}{document_id}/"
+        keys = []
+        paginator = S3_CLIENT.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for item in page.get("Contents", []):
+                name = item["Key"][len(prefix) :]
+                # The prefix also matches the parts of documents nested under this document's key
+                if "/" in name:
+                    continue
+                start_row = int(name[: -len(".sqlite")])
+                if start_row >= from_row and start_row not in keep:
+                    keys.append(item["Key"])
+        for start in range(0, len(keys), 1000):
+            S3_CLIENT.delete_objects(
+                Bucket=self.bucket_name, Delete={"Objects": [{"Key": key} for key in keys[start : start + 1000]]}
+            )
+        if keys:
+            logger.info(f"Removed {len(keys)} document store parts of document '{document_id}'")
+
+    def _part_key(self, document_id: str, start_row: int) -> str:
+        # Zero padded so the parts list in row order
+        return f"{self.part_prefix}{document_id}/{start_row:010d}.sqlite"
+
+
+DOCUMENT_STORE = DocumentStore(Settings())  # type: ignore - pulled from the environment
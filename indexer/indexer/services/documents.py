@@ -0,0 +1,232 @@
+import operator
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import reduce
+from typing import Any, Dict, Optional, Sequence
+
+from aws_lambda_powertools import Logger
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from vector_index.documents import DocumentStateError, IndexingStatus, LocalDocumentFile
+
+from indexer.boto3_clients import DYNAMODB_RESOURCE
+from indexer.settings import DocumentRegistryBackend, Settings
+
+
+logger = Logger()
+
+
+@dataclass
+class Checkpoint:
+    """Progress of indexing a version of a document: the rows before `rows` are done, `indexed` of them have vectors."""
+
+    source_version: Optional[str]
+    rows: int = 0
+    indexed: int = 0
+
+
+class DocumentRegistry(ABC):
+    """
+    Indexing state of the documents, the API lists and checks documents from the registry.
+
+    Every status change is a conditional write: a document being deleted is never indexed, and only an indexing run
+    can complete or fail a document.
+    """
+
+    def start_indexing(
+        self, document_id: str, source_version: Optional[str], reindex: bool = False
+    ) -> Optional[Checkpoint]:
+        """
+        Returns where to resume indexing from, or `None` if this version of the document is already indexed. A
+        `reindex` starts over whatever the version. Raises `DocumentStateError` if the document is being deleted.
+
+        `source_version` is the S3 version id or ETag of the object, redelivered events for a version that was indexed
+        are skipped and a version that was partly indexed resumes after its checkpoint.
+        """
+        previous = self._get(document_id) or {}
+        same_version = source_version is None or previous.get("source_version") == source_version
+        if same_version and previous.get("indexing_status") == IndexingStatus.COMPLETE.value and not reindex:
+            logger.info(f"Skipping document '{document_id}', version {source_version} is already indexed")
+            return None
+        changes: Dict[str, Any] = {"indexing_status": IndexingStatus.INDEXING.value, "error": None}
+        if source_version is not None:
+            changes["source_version"] = source_version
+        self._update(document_id, changes, disallowed=(IndexingStatus.DELETING,))
+        checkpoint = Checkpoint(source_version=source_version or previous.get("source_version"))
+        if same_version and not reindex and "checkpoint_rows" in previous:
+            checkpoint.rows = int(previous["checkpoint_rows"])
+            checkpoint.indexed = int(previous.get("checkpoint_indexed", 0))
+            logger.info(f"Resuming indexing document '{document_id}' after {checkpoint.rows} rows")
+        else:
+            self.save_checkpoint(document_id, checkpoint)
+            logger.info(f"Started indexing document '{document_id}'")
+        return checkpoint
+
+    def save_checkpoint(self, document_id: str, checkpoint: Checkpoint) -> None:
+        self._update(
+            document_id,
+            {"checkpoint_rows": checkpoint.rows, "checkpoint_indexed": checkpoint.indexed},
+            allowed=(IndexingStatus.INDEXING,),
+        )
+
+    def get_vector_rows(self, document_id: str) -> Optional[int]:
+        """
+        The document's vector manifest: its vector ids are `{document_id}_{row}` for the rows below it. `None` for
+        documents indexed before the manifest was recorded.
+        """
+        rows = (self._get(document_id) or {}).get("vector_rows")
+        return None if rows is None else int(rows)
+
+    def record_vector_rows(self, document_id: str, rows: int) -> None:
+        # Recorded before the vectors are upserted, so a run that stops halfway never leaves vectors outside it
+        self._update(document_id, {"vector_rows": rows}, allowed=(IndexingStatus.INDEXING,))
+
+    def finish_indexing(self, document_id: str, row_count: int, vector_count: int) -> None:
+        """Complete the document if every row was indexed, fail it otherwise."""
+        complete = row_count > 0 and vector_count == row_count
+        changes: Dict[str, Any] = {
+            "indexing_status": (IndexingStatus.COMPLETE if complete else IndexingStatus.FAILED).value,
+            "row_count": row_count,
+            "vector_count": vector_count,
+            "indexed_at": self._now(),
+            "error": None if complete else f"Indexed {vector_count} of {row_count} rows",
+            "checkpoint_rows": None,
+            "checkpoint_indexed": None,
+        }
+        self._update(document_id, changes, allowed=(IndexingStatus.INDEXING,))
+        logger.info(f"Finished indexing document '{document_id}' with status {changes['indexing_status']}")
+
+    def fail_indexing(self, document_id: str, error: str) -> None:
+        self._update(
+            document_id,
+            {"indexing_status": IndexingStatus.FAILED.value, "error": error},
+            allowed=(IndexingStatus.INDEXING,),
+        )
+        logger.info(f"Failed indexing document '{document_id}': {error}")
+
+    @abstractmethod
+    def remove(self, document_id: str) -> None: ...
+
+    @abstractmethod
+    def _get(self, document_id: str) -> Optional[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def _update(
+        self,
+        document_id: str,
+        changes: Dict[str, Any],
+        allowed: Optional[Sequence[IndexingStatus]] = None,
+        disallowed: Sequence[IndexingStatus] = (),
+    ) -> None:
+        """
+        Apply `changes` if the status is one of `allowed` (any status, or a missing document, when not set) and not one
+        of `disallowed`. A document uploaded straight to the bucket is registered on its first update.
+        """
+
+    def _now(self) -> str:
+        return datetime.now(timezone.utc).isoformat()
+
+
+class DynamoDbDocumentRegistry(DocumentRegistry):
+
+    def __init__(self, settings: Settings):
+        self.table = DYNAMODB_RESOURCE.Table(settings.documents_table_name)
+
+    def remove(self, document_id: str) -> None:
+        self.table.delete_item(Key={"document_id": document_id})
+        logger.info(f"Removed document '{document_id}' from the registry")
+
+    def _get(self, document_id: str) -> Optional[Dict[str, Any]]:
+        return self.table.get_item(Key={"document_id": document_id}, ConsistentRead=True).get("Item")
+
+    def _update(
+        self,
+        document_id: str,
+        changes: Dict[str, Any],
+        allowed: Optional[Sequence[IndexingStatus]] = None,
+        disallowed: Sequence[IndexingStatus] = (),
+    ) -> None:
+        now = self._now()
+        # Attribute names are aliased, SIZE and others are reserved words in DynamoDB
+        names = {"#updated_at": "updated_at", "#created_at": "created_at", "#filename": "filename", "#size": "size"}
+        values: Dict[str, Any] = {":now": now, ":unknown": "Unknown", ":zero": 0}
+        set_expressions = [
+            "#updated_at = :now",
+            "#created_at = if_not_exists(#created_at, :now)",
+            "#filename = if_not_exists(#filename, :unknown)",
+            "#size = if_not_exists(#size, :zero)",
+        ]
+        remove_expressions = []
+        for i, (name, value) in enumerate(changes.items()):
+            names[f"#c{i}"] = name
+            if value is None:
+                remove_expressions.append(f"#c{i}")
+            else:
+                values[f":c{i}"] = value
+                set_expressions.append(f"#c{i} = :c{i}")
+        update_expression = "SET " + ", ".join(set_expressions)
+        if remove_expressions:
+            update_expression += " REMOVE " + ", ".join(remove_expressions)
+
+        kwargs: Dict[str, Any] = {}
+        conditions = [Attr("indexing_status").ne(status.value) for status in disallowed]
+        if allowed is not None:
+            conditions.append(Attr("indexing_status").is_in([status.value for status in allowed]))
+        if conditions:
+            condition = reduce(operator.and_, conditions)
+            if allowed is None:
+                condition = Attr("document_id").not_exists() | condition
+            kwargs["ConditionExpression"] = condition
+        try:
+            self.table.update_item(
+                Key={"document_id": document_id},
+                UpdateExpression=update_expression,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                **kwargs,
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                raise DocumentStateError(f"Document '{document_id}' can't be changed in its current state") from e
+            raise
+
+
+class LocalDocumentRegistry(LocalDocumentFile, DocumentRegistry):
+    """The registry in a JSON file shared with the API's local registry, for running without DynamoDB."""
+
+    def remove(self, document_id: str) -> None:
+        with self._documents() as documents:
+            documents.pop(document_id, None)
+
+    def _get(self, document_id: str) -> Optional[Dict[str, Any]]:
+        with self._documents(write=False) as documents:
+            return documents.get(document_id)
+
+    def _update(
+        self,
+        document_id: str,
+        changes: Dict[str, Any],
+        allowed: Optional[Sequence[IndexingStatus]] = None,
+        disallowed: Sequence[IndexingStatus] = (),
+    ) -> None:
+        now = self._now()
+        with self._documents() as documents:
+            item = documents.get(document_id)
+            status = item["indexing_status"] if item else None
+            if (allowed is not None and status not in allowed) or status in disallowed:
+                raise DocumentStateError(f"Document '{document_id}' can't be changed in its current state")
+            item = item or {"document_id": document_id, "created_at": now, "filename": "Unknown", "size": 0}
+            item.update(changes)
+            item["updated_at"] = now
+            documents[document_id] = {key: value for key, value in item.items() if value is not None}
+
+
+
+def get_document_registry(settings: Settings) -> DocumentRegistry:
+    if settings.document_registry_backend == DocumentRegistryBackend.LOCAL:
+        return LocalDocumentRegistry(settings.local_document_registry_path)
+    return DynamoDbDocumentRegistry(settings)
+
+
+DOCUMENT_REGISTRY = get_document_registry(Settings())  # type: ignore - pulled from the environment
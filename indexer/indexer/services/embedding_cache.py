@@ -0,0 +1,122 @@
+import hashlib
+import os
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+from aws_lambda_powertools import Logger
+
+from indexer.boto3_clients import DYNAMODB_RESOURCE
+from indexer.settings import EmbeddingCacheBackend, Settings
+
+
+logger = Logger()
+
+
+def get_cache_key(model_id: str, text: str) -> str:
+    """Content address of an embedding, the exact input text is hashed so any change to it is a different key."""
+    return hashlib.sha256(f"{model_id}\n{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache(ABC):
+    """Embeddings by content address, looked up and stored a batch at a time."""
+
+    @abstractmethod
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """The cached embeddings of `keys` as float32 vectors, missing keys are left out."""
+
+    @abstractmethod
+    def put_many(self, embeddings: Dict[str, np.ndarray]) -> None: ...
+
+
+class DynamoDbEmbeddingCache(EmbeddingCache):
+    """
+    The cache in a DynamoDB table, shared by every indexer container.
+
+    Embeddings are stored as float32 bytes, a 1536 dimension vector is a 6 KB item. Items expire after
+    `ttl_seconds` so embeddings of documents that are gone don't accumulate.
+    """
+
+    max_get_batch_size = 100
+
+    def __init__(self, table_name: str, ttl_seconds: int):
+        self.table = DYNAMODB_RESOURCE.Table(table_name)
+        self.ttl_seconds = ttl_seconds
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        embeddings: Dict[str, np.ndarray] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), self.max_get_batch_size):
+            request: Optional[Dict] = {
+                self.table.name: {
+                    "Keys": [{"key": key} for key in unique_keys[start : start + self.max_get_batch_size]],
+                    "ProjectionExpression": "#key, embedding",
+                    "ExpressionAttributeNames": {"#key": "key"},
+                }
+            }
+            # Keys DynamoDB couldn't serve within its response limits are returned to be requested again
+            for attempt in range(5):
+                if not request:
+                    break
+                if attempt:
+                    time.sleep(0.05 * 2**attempt)
+                response = DYNAMODB_RESOURCE.batch_get_item(RequestItems=request)
+                for item in response["Responses"].get(self.table.name, []):
+                    embeddings[item["key"]] = np.frombuffer(item["embedding"].value, dtype=np.float32)
+                request = response.get("UnprocessedKeys")
+        return embeddings
+
+    def put_many(self, embeddings: Dict[str, np.ndarray]) -> None:
+        expires_at = int(time.time()) + self.ttl_seconds
+        with self.table.batch_writer(overwrite_by_pkeys=["key"]) as batch:
+            for key, embedding in embeddings.items():
+                batch.put_item(
+                    Item={
+                        "key": key,
+                        "embedding": np.asarray(embedding, dtype=np.float32).tobytes(),
+                        "ttl": expires_at,
+                    }
+                )
+
+
+class LocalEmbeddingCache(EmbeddingCache):
+    """The cache as one float32 file per embedding in a directory, for running without DynamoDB."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        embeddings: Dict[str, np.ndarray] = {}
+        for key in keys:
+            try:
+                embeddings[key] = np.fromfile(self._path(key), dtype=np.float32)
+            except FileNotFoundError:
+                continue
+        return embeddings
+
+    def put_many(self, embeddings: Dict[str, np.ndarray]) -> None:
+        for key, embedding in embeddings.items():
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = path.with_suffix(f".{os.getpid()}.tmp")
+            np.asarray(embedding, dtype=np.float32).tofile(temporary)
+            os.replace(temporary, path)
+
+    def _path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.f32"
+
+
+def get_embedding_cache(settings: Settings) -> Optional[EmbeddingCache]:
+    if settings.embedding_cache_backend == EmbeddingCacheBackend.NONE:
+        return None
+    if settings.embedding_cache_backend == EmbeddingCacheBackend.LOCAL:
+        return LocalEmbeddingCache(settings.local_embedding_cache_path)
+    if settings.embedding_cache_table_name is None:
+        logger.warning("No embedding cache table is configured, every row is embedded")
+        return None
+    return DynamoDbEmbeddingCache(settings.embedding_cache_table_name, settings.embedding_cache_ttl_seconds)
+
+
+EMBEDDING_CACHE = get_embedding_cache(Settings())  # type: ignore - pulled from the environment
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+from aws_lambda_powertools import Logger
+from botocore.exceptions import BotoCoreError, ClientError
+
+from indexer.boto3_clients import BEDROCK_CLIENT
+from indexer.settings import Settings
+from indexer.services.embedding_cache import EMBEDDING_CACHE, EmbeddingCache, get_cache_key
+
+
+logger = Logger()
+
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+TRANSIENT_ERROR_CODES = {"ModelTimeoutException", "ModelNotReadyException", "ServiceUnavailableException"}
+
+
+class AimdController:
+    """
+    Additive increase, multiplicative decrease of the number of requests in flight.
+
+    The limit grows by one for every `limit` requests that complete within the latency target, and is cut by
+    `decrease_factor` when a request is throttled or too slow. Requests sent before a cut report the same congestion,
+    so the limit is cut at most once per round trip.
+    """
+
+    def __init__(
+        self, initial: int, minimum: int, maximum: int, latency_target: float, decrease_factor: float = 0.5
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._latency = latency_target
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def on_success(self, latency: float) -> None:
+        self._latency = 0.8 * self._latency + 0.2 * latency
+        if latency > self.latency_target:
+            self._decrease()
+        else:
+            self._limit = min(self.maximum, self._limit + 1 / self._limit)
+
+    def on_throttle(self) -> None:
+        self._decrease()
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self._latency:
+            return
+        self._limit = max(self.minimum, self._limit * self.decrease_factor)
+        self._last_decrease = now
+        logger.info(f"Reduced the embedding concurrency to {self.limit}")
+
+
+class EmbeddingEngine:
+    """
+    Embeds texts with Bedrock from a fixed pool of workers.
+
+    The workers share an `AimdController`, so the rate climbs to what the account's quota sustains and backs off when
+    Bedrock throttles. Every text is retried on its own with jittered exponential backoff, a text that still fails is
+    reported as missing instead of failing the others.
+    """
+
+    def __init__(self, settings: Settings, cache: Optional[EmbeddingCache] = None):
+        self._model_id = settings.embedding_model_id.value
+        self.cache = cache
+        self.max_attempts = settings.embedding_max_attempts
+        self.backoff_base = settings.embedding_backoff_base_seconds
+        self.backoff_max = settings.embedding_backoff_max_seconds
+        self.controller = AimdController(
+            initial=settings.embedding_initial_concurrency,
+            minimum=settings.embedding_min_concurrency,
+            maximum=settings.embedding_max_concurrency,
+            latency_target=settings.embedding_latency_target_seconds,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=settings.embedding_max_concurrency)
+
+    def embed(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Embed the texts as float32 vectors, in order, with `None` for the texts that couldn't be embedded."""
+        keys = [get_cache_key(self._model_id, text) for text in texts]
+        cached = self._get_cached(keys)
+        # Repeated texts are embedded once
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        logger.info(f"Found {len(texts) - len(missing)} of {len(texts)} embeddings in the cache")
+        if missing:
+            embedded = dict(zip(missing, asyncio.run(self._embed(list(missing.values())))))
+            new = {key: embedding for key, embedding in embedded.items() if embedding is not None}
+            self._put_cached(new)
+            cached.update(new)
+        return [cached.get(key) for key in keys]
+
+    def _get_cached(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        if self.cache is None:
+            return {}
+        try:
+            return self.cache.get_many(keys)
+        except Exception as e:
+            # The cache only saves work, indexing goes on without it
+            logger.warning(f"Embedding cache lookup failed: {str(e)}")
+            return {}
+
+    def _put_cached(self, embeddings: Dict[str, np.ndarray]) -> None:
+        if self.cache is None or not embeddings:
+            return
+        try:
+            self.cache.put_many(embeddings)
+        except Exception as e:
+            logger.warning(f"Failed to store {len(embeddings)} embeddings in the cache: {str(e)}")
+
+    async def _embed(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        started = time.monotonic()
+        embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
+        errors: List[str] = []
+        queue: asyncio.Queue = asyncio.Queue()
+        for position in range(len(texts)):
+            queue.put_nowait(position)
+        in_flight = 0
+        slots = asyncio.Condition()
+        throttled = 0
+
+        async def invoke(text: str) -> np.ndarray:
+            nonlocal in_flight
+            async with slots:
+                await slots.wait_for(lambda: in_flight < self.controller.limit)
+                in_flight += 1
+            try:
+                request_started = time.monotonic()
+                embedding = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._get_embedding, text
+                )
+                self.controller.on_success(time.monotonic() - request_started)
+                return embedding
+            finally:
+                async with slots:
+                    in_flight -= 1
+                    slots.notify_all()
+
+        async def worker() -> None:
+            nonlocal throttled
+            while not queue.empty():
+                position = queue.get_nowait()
+                for attempt in range(1, self.max_attempts + 1):
+                    try:
+                        embeddings[position] = await invoke(texts[position])
+                        break
+                    except Exception as e:
+                        if self._is_throttling(e):
+                            throttled += 1
+                            self.controller.on_throttle()
+                        if attempt == self.max_attempts or not self._is_retryable(e):
+                            errors.append(str(e))
+                            break
+                        await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt)))
+
+        await asyncio.gather(*(worker() for _ in range(min(self.controller.maximum, len(texts)))))
+
+        elapsed = time.monotonic() - started
+        embedded = len(texts) - len(errors)
+        logger.info(
+            f"Embedded {embedded} of {len(texts)} texts in {elapsed:.2f}s ({embedded / max(elapsed, 1e-9):.1f} texts/s), "
+            f"{throttled} throttled requests, concurrency limit {self.controller.limit}"
+        )
+        if errors:
+            logger.warning(f"Failed to embed {len(errors)} texts, first error: {errors[0]}")
+        return embeddings
+
+    def _get_embedding(self, text: str) -> np.ndarray:
+        body = {
+            "inputText": text,
+        }
+        response = BEDROCK_CLIENT.invoke_model(
+            body=json.dumps(body),
+            contentType="application/json",
+            accept="*/*",
+            modelId=self._model_id,
+        )
+        response_body = json.loads(response.get("body").read())
+        return np.asarray(response_body["embedding"], dtype=np.float32)
+
+    def _is_throttling(self, error: Exception) -> bool:
+        return isinstance(error, ClientError) and error.response["Error"]["Code"] in THROTTLING_ERROR_CODES
+
+    def _is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, ClientError):
+            code = error.response["Error"]["Code"]
+            status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+            return code in THROTTLING_ERROR_CODES or code in TRANSIENT_ERROR_CODES or status >= 500
+        # Connection errors and timeouts
+        return isinstance(error, BotoCoreError)
+
+
+EMBEDDING_ENGINE = EmbeddingEngine(Settings(), EMBEDDING_CACHE)  # type: ignore - pulled from the environment
@@ -1,51 +1,192 @@
+import io
+import tempfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-from indexer.schemas import RawData
 from aws_lambda_powertools import Logger
-from pyarrow import parquet as pq
+from botocore.exceptions import ClientError
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from indexer.boto3_clients import S3_CLIENT
-from indexer.settings import Settings
+from indexer.schemas import RAW_SCHEMA
+from indexer.services.readers import (
+    EXTRACTED_COLUMNS,
+    Chunker,
+    DocumentFormat,
+    detect_format,
+    iter_csv,
+    iter_jsonl,
+    iter_parquet,
+    iter_text,
+    truncate_tokens,
+)
+from indexer.settings import ExtractMode, Settings
 
 
 logger = Logger()
 
+# Enough of the start of a document to tell its format
+FORMAT_HEAD_BYTES = 4096
+
 
 class Extract:
 
     def __init__(self, settings: Settings):
         self.s3_bucket_name = settings.s3_bucket_name
+        self.chunk_size = settings.extract_chunk_size
+        self.mode = settings.extract_mode
+        self.memory_budget_bytes = settings.extract_memory_budget_bytes
+        self.concurrency = settings.extract_concurrency
+        self.chunker = Chunker(settings.chunk_max_tokens, settings.chunk_overlap_tokens)
+        self.record_max_tokens = settings.record_max_tokens
+
+    def iter_documents(
+        self, s3_keys: List[str], start_rows: Optional[Dict[str, int]] = None
+    ) -> Iterator[Tuple[str, Iterator[pa.RecordBatch]]]:
+        """
+        Yield every document with its rows in chunks of at most `chunk_size` rows, from its `start_rows` on.
+
+        The documents are parsed in the order their downloads complete. In memory mode they are fetched concurrently
+        while the objects held fit in `memory_budget_bytes`, in disk mode they are all fetched concurrently. Parquet,
+        CSV and JSONL documents are read a record batch at a time with a row per record, plain text is split into
+        overlapping passages with a row per passage. A document's chunks are yielded in order and have to be consumed
+        before the next document. When a document can't be read or has invalid rows its chunks raise, even after some
+        of them were yielded, and the other documents are still yielded.
+        """
+        start_rows = start_rows or {}
+        for s3_key, download in self._download_all(s3_keys):
+            yield s3_key, self._iter_chunks(s3_key, download, start_rows.get(s3_key, 0))
+
+    def _iter_chunks(self, s3_key: str, download: Future, row_index: int) -> Iterator[pa.RecordBatch]:
+        try:
+            for chunk in self._iter_records(download.result(), s3_key, row_index):
+                records = self._to_raw(chunk, s3_key, row_index)
+                row_index += records.num_rows
+                yield records
+        except Exception:
+            # The chunks yielded so far are only a prefix of the document, it must not be finished with them
+            logger.exception(f"Failed to extract document '{s3_key}' at row {row_index}")
+            raise
+
+    def _download_all(self, s3_keys: List[str]) -> Iterator[Tuple[str, Future]]:
+        """Yield the downloads as they complete, so the first document is parsed while the others are fetched."""
+        remaining = deque(s3_keys)
+        pending: Dict[Future, str] = {}
+        held = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            def start_downloads() -> None:
+                # At least one document is downloaded, however large
+                nonlocal held
+                while remaining and (not held or held + sizes[remaining[0]] <= budget):
+                    s3_key = remaining.popleft()
+                    held += sizes[s3_key]
+                    pending[executor.submit(download, s3_key)] = s3_key
 
-    def extract(self, s3_keys: List[str]) -> List[RawData]:
-        failed_records = []
-        extracted_records = []
-        for s3_key in s3_keys:
             try:
-                local_path = self._download_from_s3(s3_key)
-                records = self._from_parquet(local_path)
-                for record in records:
-                    raw_data = RawData(
-                        document_id=s3_key,
-                        **record
-                    )
-                    extracted_records.append(raw_data)
-            except Exception as e:
-                failed_records.append({"s3_key": s3_key, "error": str(e)})
-        if failed_records and not extracted_records:
-            logger.error(f"Failed to extract records: {failed_records}")
-        elif failed_records:
-            logger.warning(f"Failed to extract some records: {failed_records}")
-        return extracted_records
-
-    def _download_from_s3(self, s3_path: str) -> Path:
-        local_path = Path(f"/tmp/{Path(s3_path).name}")
-        S3_CLIENT.download_file(self.s3_bucket_name, s3_path, str(local_path))
+                if self.mode == ExtractMode.MEMORY:
+                    # A downloaded object is held in memory until it's parsed, the budget bounds the bytes held
+                    download, budget = self._download_to_memory, self.memory_budget_bytes
+                    sizes = dict(zip(s3_keys, executor.map(self._get_size, s3_keys)))
+                else:
+                    download, budget = self._download_to_disk, 0
+                    sizes = dict.fromkeys(s3_keys, 0)
+                start_downloads()
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    s3_key = pending.pop(future)
+                    yield s3_key, future
+                    # The document was parsed, its object is released
+                    held -= sizes[s3_key]
+                    start_downloads()
+            finally:
+                # Downloads left behind when the run stops early, their staged files would fill /tmp across invocations
+                for future in pending:
+                    if not future.cancel() and future.exception() is None and isinstance(future.result(), Path):
+                        future.result().unlink(missing_ok=True)
+
+    def _get_size(self, s3_key: str) -> int:
+        try:
+            return S3_CLIENT.head_object(Bucket=self.s3_bucket_name, Key=s3_key)["ContentLength"]
+        except ClientError:
+            # The download fails the document on its own
+            return 0
+
+    def _download_to_memory(self, s3_key: str) -> pa.BufferReader:
+        # Large objects are fetched as concurrent ranged GETs by the transfer manager
+        buffer = io.BytesIO()
+        S3_CLIENT.download_fileobj(self.s3_bucket_name, s3_key, buffer)
+        return pa.BufferReader(pa.py_buffer(buffer.getbuffer()))
+
+    def _download_to_disk(self, s3_key: str) -> Path:
+        # A unique name per download, keys with the same file name in one batch don't clobber each other
+        with tempfile.NamedTemporaryFile(suffix=Path(s3_key).suffix, delete=False) as file:
+            local_path = Path(file.name)
+        try:
+            S3_CLIENT.download_file(self.s3_bucket_name, s3_key, str(local_path))
+        except Exception:
+            local_path.unlink(missing_ok=True)
+            raise
         return local_path
 
-    def _from_parquet(self, record: Path) -> List[Dict[str, Any]]:
-        table = pq.read_table(record)
-        return table.to_pylist()
+    def _iter_records(
+        self, source: Union[pa.BufferReader, Path], s3_key: str, start_row: int = 0
+    ) -> Iterator[pa.RecordBatch]:
+        file = pa.OSFile(str(source)) if isinstance(source, Path) else source
+        try:
+            document_format = detect_format(s3_key, file.read_at(min(FORMAT_HEAD_BYTES, file.size()), 0))
+            # A file read at an offset has to be positioned again before it's streamed
+            file.seek(0)
+            logger.debug(f"Reading document '{s3_key}' as {document_format.value}")
+            if document_format == DocumentFormat.TEXT:
+                yield from iter_text(file, self.chunk_size, self.chunker, start_row)
+            else:
+                read = {
+                    DocumentFormat.PARQUET: iter_parquet,
+                    DocumentFormat.CSV: iter_csv,
+                    DocumentFormat.JSONL: iter_jsonl,
+                }[document_format]
+                yield from map(self._bound, read(file, self.chunk_size, start_row))
+        finally:
+            file.close()
+            if isinstance(source, Path):
+                source.unlink(missing_ok=True)
+
+    def _bound(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        # A record is one row whatever its length, an over-long support is cut to what the model embeds
+        support = batch.column("support")
+        # A token is at least a character, only supports longer than the bound in characters can be over it
+        long_rows = pc.fill_null(pc.greater(pc.utf8_length(support), self.record_max_tokens), False)
+        if not pc.any(long_rows).as_py():
+            return batch
+        supports = support.to_pylist()
+        truncated = 0
+        for i in np.flatnonzero(long_rows.to_numpy(zero_copy_only=False)):
+            bounded = truncate_tokens(supports[i], self.record_max_tokens)
+            truncated += bounded != supports[i].rstrip()
+            supports[i] = bounded
+        if truncated:
+            logger.warning(f"Truncated {truncated} supports to {self.record_max_tokens} tokens")
+        columns = [
+            pa.array(supports, pa.string()) if name == "support" else batch.column(name) for name in batch.schema.names
+        ]
+        return pa.RecordBatch.from_arrays(columns, schema=batch.schema)
+
+    def _to_raw(self, batch: pa.RecordBatch, s3_key: str, row_index: int) -> pa.RecordBatch:
+        columns = []
+        for name in EXTRACTED_COLUMNS:
+            column = batch.column(name)
+            if column.null_count:
+                raise ValueError(f"Column '{name}' has {column.null_count} missing values")
+            columns.append(column.cast(pa.string()))
+        columns.append(pa.array([s3_key] * batch.num_rows, pa.string()))
+        columns.append(pa.array(np.arange(row_index, row_index + batch.num_rows, dtype=np.int64)))
+        return pa.RecordBatch.from_arrays(columns, schema=RAW_SCHEMA)
 
 
 EXTRACT = Extract(Settings())  # type: ignore - pulled from env
@@ -1,82 +1,168 @@
+import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
-import pinecone
+import numpy as np
+import pyarrow as pa
 from aws_lambda_powertools import Logger
+from vector_index.bm25 import decode_term_frequencies
 
-# import get_secret from lambda_powertools:
-from aws_lambda_powertools.utilities.parameters import get_secret
-
-from indexer.schemas import TransformedDataWithEmbedding
+from indexer.schemas import get_embeddings
 from indexer.settings import Settings
-from indexer.boto3_clients import S3_CLIENT
+from indexer.services.bm25 import encode_sparse_vector
+from indexer.services.vector_store import get_vector_store
 
 
 logger = Logger()
 
+METADATA_COLUMNS = ("document_id", "row_index")
+SPARSE_COLUMNS = ("term_frequencies", "token_count")
 
-class Load:
 
-    def __init__(self, settings: Settings):
-        self.index_name = settings.pinecone_host_name
-        self.bucket_name = settings.s3_bucket_name
+class LoadError(Exception):
+    """Some of the records couldn't be upserted."""
 
-        api_key = get_secret(settings.pinecone_api_key_secret_name)
-
-        self.index = pinecone.Index(
-            api_key=api_key,
-            host=settings.pinecone_host_name,
-        )
 
-    def load(self, records: List[TransformedDataWithEmbedding]) -> None:
-        logger.info(f"Loading {len(records)} records into Pinecone index '{self.index_name}'")
+class Load:
 
-        upsert_data: List[tuple] = []
-        for i, record in enumerate(records):
-            metadata = record.model_dump(mode="json", exclude={"embedding"})
-            vector = (self._get_vector_id(record.document_id, i), record.embedding, metadata)
+    def __init__(self, settings: Settings):
+        self.bm25_k1 = settings.bm25_k1
+        self.bm25_b = settings.bm25_b
+        self.delete_concurrency = settings.delete_concurrency
+        self.delete_max_attempts = 3
+
+        self.vector_store = get_vector_store(settings)
+
+    def load(self, records: pa.RecordBatch, average_length: Optional[float] = None) -> None:
+        """
+        Upsert the records, raises `LoadError` if a batch couldn't be upserted. The BM25 weights are normalized by the
+        corpus' `average_length`, or the records' before the corpus has statistics.
+        """
+        logger.info(f"Loading {records.num_rows} records into {type(self.vector_store).__name__}")
+
+        average_length = average_length or self._get_average_length(records)
+        embeddings = self._normalize(get_embeddings(records))
+        upsert_data: List[Dict[str, Any]] = []
+        rows = zip(*(records.column(name).to_pylist() for name in METADATA_COLUMNS + SPARSE_COLUMNS))
+        for (document_id, row_index, term_frequencies, token_count), values in zip(rows, embeddings):
+            vector = {
+                "id": self._get_vector_id(document_id, row_index),
+                "values": values,
+                "sparse_values": encode_sparse_vector(
+                    decode_term_frequencies(term_frequencies),
+                    token_count,
+                    average_length,
+                    k1=self.bm25_k1,
+                    b=self.bm25_b,
+                ),
+                # The text is hydrated from the document store, see services/document_store.py. Duplicate rows of
+                # other documents are added to `document_ids` by `update_document_ids` after they are indexed.
+                "metadata": {"document_id": document_id, "row_index": row_index, "document_ids": [document_id]},
+            }
+            # Pinecone rejects empty sparse vectors
+            if not vector["sparse_values"]["indices"]:
+                del vector["sparse_values"]
             upsert_data.append(vector)
 
-        batch_size = 100
+        batch_size = self.vector_store.max_upsert_batch_size
         batches = [upsert_data[i : i + batch_size] for i in range(0, len(upsert_data), batch_size)]
+        errors = []
         with ThreadPoolExecutor(max_workers=100) as executor:
-            futures = [executor.submit(self.index.upsert, vectors=batch) for batch in batches]
-            for i, future in enumerate(futures):
+            futures = [executor.submit(self.vector_store.upsert, batch) for batch in batches]
+            for i, (batch, future) in enumerate(zip(batches, futures)):
                 try:
                     future.result()
                     logger.info(f"Upserted batch {i + 1} of {len(batches)}")
                 except Exception as e:
                     logger.error(f"Error upserting batch {i + 1}: {str(e)}")
-        logger.info("Finished loading data into Pinecone index")
-        self._update_object_metadata(records)
-        logger.info("Updated S3 object metadata")
-
-    def _update_object_metadata(self, records: List[TransformedDataWithEmbedding]) -> None:
-        keys = set(record.document_id for record in records)
-        for key in keys:
-            try:
-                response = S3_CLIENT.head_object(Bucket=self.bucket_name, Key=key)
-                metadata = response.get('Metadata', {})
-                metadata['indexing_status'] = 'COMPLETE'
-                S3_CLIENT.copy_object(
-                    Bucket=self.bucket_name,
-                    Key=key,
-                    CopySource={'Bucket': self.bucket_name, 'Key': key},
-                    Metadata=metadata,
-                    MetadataDirective='REPLACE',
-                )
-                logger.info(f"Updated S3 object {key} with indexing status: COMPLETE")
-            except Exception as e:
-                logger.error(f"Failed to update S3 object metadata: {str(e)}")
-
-    def delete_vectors(self, document_id: str) -> None:
-        logger.info(f"Deleting vectors for document '{document_id}' from Pinecone index '{self.index_name}'")
-        id_generator = self.index.list(prefix=document_id, limit=100)
-        for ids in id_generator:
-            self.index.delete(ids)
+                    errors.append(str(e))
+        if errors:
+            # Upserts are idempotent, the records are loaded again when the indexing resumes from its checkpoint
+            raise LoadError(f"Failed to upsert {len(errors)} of {len(batches)} batches: {errors[0]}")
+        logger.info("Finished loading data into the vector store")
+
+    def update_document_ids(self, document_ids: Dict[Tuple[str, int], List[str]]) -> None:
+        """Set the documents a row's vector stands for, the row's own and those of the duplicates collapsed into it."""
+        if not document_ids:
+            return
+        self.vector_store.update_metadata(
+            {
+                self._get_vector_id(document_id, row_index): {"document_ids": sources}
+                for (document_id, row_index), sources in document_ids.items()
+            }
+        )
+        logger.info(f"Updated the source documents of {len(document_ids)} vectors")
+
+    def delete_rows(self, document_id: str, rows: List[int]) -> None:
+        """Delete the vectors of some of a document's rows, whether or not they exist."""
+        ids = [self._get_vector_id(document_id, row) for row in rows]
+        batch_size = self.vector_store.max_delete_batch_size
+        for i in range(0, len(ids), batch_size):
+            self.vector_store.delete(ids[i : i + batch_size])
+        logger.info(f"Deleted the vectors of {len(ids)} rows of document '{document_id}'")
+
+    def delete_vectors(self, document_id: str, vector_rows: Optional[int] = None, from_row: int = 0) -> None:
+        """
+        Delete the vectors of a document's rows from `from_row` on, raises `LoadError` if some remain.
+
+        `vector_rows` is the document's vector manifest: its vector ids are `{document_id}_{row}` for the rows below it,
+        so they are deleted, and fetched to check they are gone, in parallel batches without listing the index. Without
+        a manifest, for documents indexed before it was recorded, the ids are listed by prefix first.
+        """
+        logger.info(f"Deleting vectors for document '{document_id}' from {type(self.vector_store).__name__}")
+        if vector_rows is None:
+            ids = [id_ for id_ in self._list_vector_ids(document_id) if self._get_row(document_id, id_) >= from_row]
+        else:
+            ids = [self._get_vector_id(document_id, row) for row in range(from_row, vector_rows)]
+        batch_size = self.vector_store.max_delete_batch_size
+        for attempt in range(1, self.delete_max_attempts + 1):
+            batches = [ids[i : i + batch_size] for i in range(0, len(ids), batch_size)]
+            with ThreadPoolExecutor(max_workers=self.delete_concurrency) as executor:
+                futures = [executor.submit(self.vector_store.delete, batch) for batch in batches]
+                for i, future in enumerate(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Error deleting batch {i + 1}: {str(e)}")
+                    if (i + 1) % 10 == 0 or i + 1 == len(batches):
+                        logger.info(f"Deleted {i + 1} of {len(batches)} batches for document '{document_id}'")
+            # Deletes are eventually consistent, whatever can still be fetched is deleted again
+            ids = self._fetch_existing(ids)
+            if not ids:
+                logger.info(f"Deleted the vectors for document '{document_id}'")
+                return
+            logger.warning(f"{len(ids)} vectors remain for document '{document_id}' after attempt {attempt}")
+            if attempt < self.delete_max_attempts:
+                time.sleep(2**attempt)
+        raise LoadError(f"{len(ids)} vectors remain for document '{document_id}'")
+
+    def _fetch_existing(self, ids: List[str]) -> List[str]:
+        batch_size = self.vector_store.max_fetch_batch_size
+        batches = [ids[i : i + batch_size] for i in range(0, len(ids), batch_size)]
+        with ThreadPoolExecutor(max_workers=self.delete_concurrency) as executor:
+            existing = {id_ for fetched in executor.map(self.vector_store.fetch_metadata, batches) for id_ in fetched}
+        return [id_ for id_ in ids if id_ in existing]
+
+    def _list_vector_ids(self, document_id: str) -> List[str]:
+        # The prefix also matches the ids of documents whose key starts with this document's key and an underscore
+        prefix = f"{document_id}_"
+        return [
+            id_ for ids in self.vector_store.list_ids(prefix) for id_ in ids if id_[len(prefix) :].isdigit()
+        ]
+
+    def _get_row(self, document_id: str, vector_id: str) -> int:
+        return int(vector_id[len(document_id) + 1 :])
 
     def _get_vector_id(self, document_id: str, index: int) -> str:
         return f"{document_id}_{index}"
 
+    def _normalize(self, embeddings: np.ndarray) -> np.ndarray:
+        # Hybrid search needs a dotproduct index, unit vectors keep the dense part of the score a cosine similarity
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms > 0, norms, 1)
+
+    def _get_average_length(self, records: pa.RecordBatch) -> float:
+        return float(records.column("token_count").to_numpy().mean()) if records.num_rows else 0.0
+
 
 LOAD = Load(Settings())  # type: ignore - pulled from the environment
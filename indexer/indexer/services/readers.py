@@ -0,0 +1,227 @@
+import csv
+import io
+import json
+import re
+from enum import Enum
+from itertools import chain
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from pyarrow import parquet as pq
+
+
+# Only the fields that are embedded or stored are read, the SciQ distractors are skipped
+EXTRACTED_COLUMNS = ["question", "correct_answer", "support"]
+
+# A token is a run of non-whitespace and the whitespace after it, joining tokens gives back the text
+TOKEN_PATTERN = re.compile(r"\S+\s*")
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*\s+$")
+
+# The delimiters a CSV document is sniffed for, in its first bytes
+CSV_DELIMITERS = ",;\t|"
+CSV_SNIFF_BYTES = 64 * 1024
+
+
+class DocumentFormat(str, Enum):
+
+    PARQUET = "parquet"
+    CSV = "csv"
+    JSONL = "jsonl"
+    TEXT = "text"
+
+
+EXTENSIONS = {
+    ".parquet": DocumentFormat.PARQUET,
+    ".csv": DocumentFormat.CSV,
+    ".jsonl": DocumentFormat.JSONL,
+    ".ndjson": DocumentFormat.JSONL,
+    ".txt": DocumentFormat.TEXT,
+    ".md": DocumentFormat.TEXT,
+}
+
+
+def detect_format(s3_key: str, head: bytes) -> DocumentFormat:
+    """The format of a document from the extension of its key, or from its first bytes for keys without one."""
+    if (extension := Path(s3_key).suffix.lower()) in EXTENSIONS:
+        return EXTENSIONS[extension]
+    # Documents uploaded through the API are keyed by id
+    if head.startswith(b"PAR1"):
+        return DocumentFormat.PARQUET
+    text = head.decode("utf-8", errors="ignore").lstrip("﻿ \t\r\n")
+    if text.startswith("{"):
+        return DocumentFormat.JSONL
+    header = {field.strip().strip('"') for field in text.split("\n", 1)[0].split(",")}
+    if set(EXTRACTED_COLUMNS) <= header or sniff_csv(text) is not None:
+        return DocumentFormat.CSV
+    return DocumentFormat.TEXT
+
+
+def sniff_csv(head: str) -> Optional[str]:
+    """
+    The delimiter of `head` if it's the start of a CSV document: at least two lines that split into the same number of
+    fields, two or more. Prose has commas too, but not the same number on every line.
+    """
+    lines = [line for line in head.splitlines() if line.strip()]
+    # The last line can be cut off by the end of the head
+    if len(lines) > 2 and not head.endswith("\n"):
+        lines.pop()
+    if len(lines) < 2:
+        return None
+    sample = "\n".join(lines)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=CSV_DELIMITERS)
+    except csv.Error:
+        return None
+    widths = {len(row) for row in csv.reader(io.StringIO(sample), dialect)}
+    return dialect.delimiter if len(widths) == 1 and widths.pop() > 1 else None
+
+
+def count_tokens(text: str) -> int:
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    return "".join(TOKEN_PATTERN.findall(text)[:max_tokens]).rstrip()
+
+
+class Chunker:
+    """
+    Splits text into passages of at most `max_tokens` tokens, every passage repeats the last `overlap_tokens` tokens of
+    the passage before.
+
+    Tokens are whitespace separated words, a passage ends at the last paragraph or sentence break of its second half
+    when there is one. The text is read a block at a time and only the current passage is held.
+    """
+
+    def __init__(self, max_tokens: int, overlap_tokens: int):
+        self.max_tokens = max_tokens
+        # Every passage moves at least half a passage past the one before
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+    def iter_passages(self, blocks: Iterable[str]) -> Iterator[str]:
+        tokens: List[str] = []
+        # Tokens at the start of `tokens` that the last passage already holds
+        emitted = 0
+        pending = ""
+        for block in chain(blocks, [None]):
+            if block is None:
+                found = [pending] if pending else []
+            else:
+                found = TOKEN_PATTERN.findall(pending + block)
+                # The last token can go on in the next block, with more of its word or of its whitespace
+                pending = found.pop() if found else ""
+            tokens.extend(found)
+            while len(tokens) > self.max_tokens:
+                end = self._find_end(tokens)
+                yield "".join(tokens[:end]).strip()
+                start = end - self.overlap_tokens
+                tokens = tokens[start:]
+                emitted = end - start
+        if len(tokens) > emitted:
+            yield "".join(tokens).strip()
+
+    def _find_end(self, tokens: List[str]) -> int:
+        window = range(self.max_tokens, self.max_tokens // 2, -1)
+        for end in window:
+            if "\n\n" in tokens[end - 1]:
+                return end
+        for end in window:
+            if SENTENCE_END.search(tokens[end - 1]):
+                return end
+        return self.max_tokens
+
+
+def iter_parquet(file: pa.NativeFile, batch_size: int, start_row: int = 0) -> Iterator[pa.RecordBatch]:
+    with pq.ParquetFile(file) as parquet_file:
+        # Row groups before the start are skipped without being read
+        row_groups = []
+        skip = start_row
+        for row_group in range(parquet_file.num_row_groups):
+            num_rows = parquet_file.metadata.row_group(row_group).num_rows
+            if not row_groups and skip >= num_rows:
+                skip -= num_rows
+            else:
+                row_groups.append(row_group)
+        yield from skip_rows(
+            parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=EXTRACTED_COLUMNS),
+            batch_size,
+            skip,
+        )
+
+
+def iter_csv(file: pa.NativeFile, batch_size: int, start_row: int = 0) -> Iterator[pa.RecordBatch]:
+    head = file.read_at(min(CSV_SNIFF_BYTES, file.size()), 0).decode("utf-8", errors="ignore")
+    file.seek(0)
+    reader = pa_csv.open_csv(
+        file,
+        read_options=pa_csv.ReadOptions(block_size=1024 * 1024),
+        parse_options=pa_csv.ParseOptions(delimiter=sniff_csv(head) or ","),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=EXTRACTED_COLUMNS, column_types={name: pa.string() for name in EXTRACTED_COLUMNS}
+        ),
+    )
+    yield from skip_rows(reader, batch_size, start_row)
+
+
+def iter_jsonl(file: pa.NativeFile, batch_size: int, start_row: int = 0) -> Iterator[pa.RecordBatch]:
+    def iter_batches() -> Iterator[pa.RecordBatch]:
+        records: List[Dict] = []
+        for line_number, line in enumerate(io.TextIOWrapper(file, encoding="utf-8"), start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                records.append({name: _to_text(record[name]) for name in EXTRACTED_COLUMNS})
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"Invalid record on line {line_number}: {str(e)}") from e
+            if len(records) == batch_size:
+                yield _to_batch(records)
+                records = []
+        if records:
+            yield _to_batch(records)
+
+    yield from skip_rows(iter_batches(), batch_size, start_row)
+
+
+def iter_text(file: pa.NativeFile, batch_size: int, chunker: Chunker, start_row: int = 0) -> Iterator[pa.RecordBatch]:
+    """A record per passage of the text, the passage is the support and the question and answer are empty."""
+
+    def iter_batches() -> Iterator[pa.RecordBatch]:
+        text = io.TextIOWrapper(file, encoding="utf-8", errors="replace")
+        blocks = iter(lambda: text.read(64 * 1024), "")
+        records: List[Dict] = []
+        for passage in chunker.iter_passages(blocks):
+            records.append({"question": "", "correct_answer": "", "support": passage})
+            if len(records) == batch_size:
+                yield _to_batch(records)
+                records = []
+        if records:
+            yield _to_batch(records)
+
+    yield from skip_rows(iter_batches(), batch_size, start_row)
+
+
+def skip_rows(batches: Iterable[pa.RecordBatch], batch_size: int, start_row: int) -> Iterator[pa.RecordBatch]:
+    """The rows of `batches` from `start_row` on, in batches of at most `batch_size` rows."""
+    skip = start_row
+    for batch in batches:
+        if skip:
+            dropped = min(skip, batch.num_rows)
+            batch = batch.slice(dropped)
+            skip -= dropped
+        for offset in range(0, batch.num_rows, batch_size):
+            yield batch.slice(offset, batch_size)
+
+
+def _to_text(value: Optional[object]) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _to_batch(records: List[Dict]) -> pa.RecordBatch:
+    return pa.RecordBatch.from_pylist(
+        records, schema=pa.schema([pa.field(name, pa.string()) for name in EXTRACTED_COLUMNS])
+    )
@@ -1,56 +1,49 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 import json
 from typing import List
 
-from indexer.schemas import RawData, TransformedData, TransformedDataWithEmbedding
-from indexer.boto3_clients import BEDROCK_CLIENT
-from indexer.settings import Settings
+import numpy as np
+import pyarrow as pa
+from vector_index.bm25 import encode_term_frequencies, tokenize
+
+from indexer.schemas import TRANSFORMED_SCHEMA, with_embeddings
+from indexer.services.embeddings import EMBEDDING_ENGINE
+
+
+# The JSON pydantic produced for these fields: in this order, compact and with non-ASCII characters unescaped. Only the
+# content is embedded, the same passage in two documents has one embedding and one cache entry.
+EMBEDDING_INPUT_FIELDS = ("question", "correct_answer", "support")
 
 
 class Transform:
 
-    def __init__(self, settings: Settings):
-        self._model_id = settings.embedding_model_id.value
-
-    def transform_data(self, records: List[RawData]) -> List[TransformedDataWithEmbedding]:
-        transformed_records = []
-        for record in records:
-            transformed_records.append(
-                TransformedData(
-                    question=record.question,
-                    correct_answer=record.correct_answer,
-                    support=record.support,
-                    document_id=record.document_id,
-                )
-            )
-        transformed_records = self.generate_embeddings(transformed_records)
-        return transformed_records
-
-    def generate_embeddings(self, records: List[TransformedData]) -> List[TransformedDataWithEmbedding]:
-        with ThreadPoolExecutor(max_workers=300) as executor:
-            transformed_records = list(executor.map(self._get_embedding, records))
-        return transformed_records
-
-    def _get_embedding(self, record: TransformedData) -> TransformedDataWithEmbedding:
-        body = {
-            "inputText": record.model_dump_json(),
-        }
-        response = BEDROCK_CLIENT.invoke_model(
-            body=json.dumps(body),
-            contentType="application/json",
-            accept="*/*",
-            modelId=self._model_id,
+    def transform_data(self, records: pa.RecordBatch) -> pa.RecordBatch:
+        """Add the BM25 statistics and the embedding of every row, rows that couldn't be embedded are dropped."""
+        texts = zip(*(records.column(name).to_pylist() for name in ("question", "correct_answer", "support")))
+        term_frequencies = []
+        token_counts = []
+        for text in texts:
+            tokens = tokenize(" ".join(text))
+            term_frequencies.append(encode_term_frequencies(Counter(tokens)))
+            token_counts.append(len(tokens))
+        transformed_records = pa.RecordBatch.from_arrays(
+            records.columns + [pa.array(term_frequencies, pa.string()), pa.array(token_counts, pa.int64())],
+            schema=TRANSFORMED_SCHEMA,
         )
-        response_body = json.loads(response.get('body').read())
-        embedding = response_body['embedding']
-        with_embedding = TransformedDataWithEmbedding(
-            question=record.question,
-            correct_answer=record.correct_answer,
-            support=record.support,
-            embedding=embedding,
-            document_id=record.document_id,
-        )
-        return with_embedding
+
+        embeddings = EMBEDDING_ENGINE.embed(self._get_embedding_inputs(transformed_records))
+        embedded = [embedding is not None for embedding in embeddings]
+        if not all(embedded):
+            transformed_records = transformed_records.filter(pa.array(embedded))
+        vectors = [embedding for embedding in embeddings if embedding is not None]
+        matrix = np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        return with_embeddings(transformed_records, matrix)
+
+    def _get_embedding_inputs(self, records: pa.RecordBatch) -> List[str]:
+        return [
+            json.dumps(dict(zip(EMBEDDING_INPUT_FIELDS, fields)), ensure_ascii=False, separators=(",", ":"))
+            for fields in zip(*(records.column(name).to_pylist() for name in EMBEDDING_INPUT_FIELDS))
+        ]
 
 
-TRANSFORM = Transform(Settings())  # type: ignore - pulled from the environment
+TRANSFORM = Transform()
@@ -0,0 +1,20 @@
+from vector_index import LocalVectorStore, PineconeVectorStore, VectorMatch, VectorStore
+
+from indexer.settings import Settings, VectorStoreBackend
+
+
+__all__ = ["LocalVectorStore", "PineconeVectorStore", "VectorMatch", "VectorStore", "get_vector_store"]
+
+
+def get_vector_store(settings: Settings, connection_pool_maxsize: int = 10) -> VectorStore:
+    if settings.vector_store_backend == VectorStoreBackend.LOCAL:
+        return LocalVectorStore(
+            settings.local_vector_store_path,
+            hnsw_threshold=settings.local_vector_store_hnsw_threshold,
+            ef_search=settings.local_vector_store_ef_search,
+            quantization=settings.local_vector_store_quantization,
+            rescore_factor=settings.local_vector_store_rescore_factor,
+        )
+    return PineconeVectorStore(
+        settings.pinecone_host_name, settings.pinecone_api_key_secret_name, connection_pool_maxsize
+    )
@@ -1,5 +1,8 @@
 from enum import Enum
+from typing import Optional
+
 from pydantic_settings import SettingsConfigDict, BaseSettings as PydanticBaseSettings
+from vector_index import VectorQuantization
 
 
 class ModelId(str, Enum):
@@ -7,6 +10,31 @@ class ModelId(str, Enum):
     AMAZON_TITAN_EMBED_TEXT_V1 = "amazon.titan-embed-text-v1"
 
 
+class ExtractMode(str, Enum):
+
+    MEMORY = "memory"
+    DISK = "disk"
+
+
+class EmbeddingCacheBackend(str, Enum):
+
+    DYNAMODB = "dynamodb"
+    LOCAL = "local"
+    NONE = "none"
+
+
+class VectorStoreBackend(str, Enum):
+
+    PINECONE = "pinecone"
+    LOCAL = "local"
+
+
+class DocumentRegistryBackend(str, Enum):
+
+    DYNAMODB = "dynamodb"
+    LOCAL = "local"
+
+
 class Settings(PydanticBaseSettings):
 
     model_config = SettingsConfigDict(
@@ -16,7 +44,59 @@ class Settings(PydanticBaseSettings):
     )
     log_level: str = "DEBUG"
     embedding_model_id: ModelId = ModelId.AMAZON_TITAN_EMBED_TEXT_V1
+    # Requests in flight adapt between the bounds, cut when Bedrock throttles or responds slower than the target
+    embedding_initial_concurrency: int = 16
+    embedding_min_concurrency: int = 2
+    embedding_max_concurrency: int = 128
+    embedding_latency_target_seconds: float = 2.0
+    embedding_max_attempts: int = 8
+    embedding_backoff_base_seconds: float = 0.1
+    embedding_backoff_max_seconds: float = 10.0
+    # Embeddings are cached by a hash of the model and the exact input, only misses are sent to Bedrock. Without a
+    # table the DynamoDB backend is off.
+    embedding_cache_backend: EmbeddingCacheBackend = EmbeddingCacheBackend.DYNAMODB
+    embedding_cache_table_name: Optional[str] = None
+    embedding_cache_ttl_seconds: int = 30 * 24 * 60 * 60
+    local_embedding_cache_path: str = "/tmp/embedding-cache"
+    # Rows are extracted, embedded and loaded this many at a time, bounding the memory of a run
+    extract_chunk_size: int = 500
+    # Documents are downloaded into memory concurrently while the objects held, parsed or not, fit in the budget, the
+    # disk mode stages them all in /tmp concurrently, for objects that don't fit
+    extract_mode: ExtractMode = ExtractMode.MEMORY
+    extract_memory_budget_bytes: int = 256 * 1024 * 1024
+    extract_concurrency: int = 8
+    # Plain text documents are split into passages of this many words, repeating the overlap of the passage before
+    chunk_max_tokens: int = 300
+    chunk_overlap_tokens: int = 50
+    # Supports of parquet, CSV and JSONL records are cut to this many words, within what the embedding model takes
+    record_max_tokens: int = 2000
+    # Rows whose support passage duplicates an indexed row's are collapsed into that row's vector
+    dedup_enabled: bool = True
+    dedup_similarity_threshold: float = 0.85
+    dedup_min_tokens: int = 8
+    # Vectors of a deleted document are deleted by id, this many batches at a time
+    delete_concurrency: int = 16
+    # Progress is checkpointed every this many rows of a document, a redelivered event resumes from the checkpoint
+    checkpoint_interval_rows: int = 2000
+    # Indexing stops at a checkpoint this long before the Lambda times out, and resumes when SQS redelivers the event
+    indexing_deadline_margin_seconds: int = 60
     s3_bucket_name: str
+    artifact_bucket_name: str
+    documents_table_name: str
+    document_registry_backend: DocumentRegistryBackend = DocumentRegistryBackend.DYNAMODB
+    local_document_registry_path: str = "/tmp/document-registry.json"
     pinecone_api_key_secret_name: str
     # Hardcoding because the pinecone construct doesn't expose the index name *yet*
     pinecone_host_name: str = "https://ragstack-index0-d41d8cd98f00b204e980-c6xn8rd.svc.apw5-4e34-81fa.pinecone.io"
+    vector_store_backend: VectorStoreBackend = VectorStoreBackend.PINECONE
+    local_vector_store_path: str = "/tmp/vector-store"
+    # The local store switches from exact search to an HNSW graph once it holds this many vectors
+    local_vector_store_hnsw_threshold: int = 10_000
+    local_vector_store_ef_search: int = 64
+    # Exact queries scan int8 or binary codes of the vectors, then rescore this many times top_k candidates in float32,
+    # by default 8 for int8 and 32 for binary codes
+    local_vector_store_quantization: VectorQuantization = VectorQuantization.INT8
+    local_vector_store_rescore_factor: Optional[int] = None
+    # Must match the API settings, the sparse vectors hold BM25 weights computed with them
+    bm25_k1: float = 1.2
+    bm25_b: float = 0.75
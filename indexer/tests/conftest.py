@@ -0,0 +1,190 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pytest
+from botocore.exceptions import ClientError
+
+
+# The services are module level singletons configured from the environment, the settings have to be in place before
+# the first indexer module is imported. Every backend that has a local implementation uses it.
+LOCAL_ROOT = tempfile.mkdtemp(prefix="indexer-tests-")
+os.environ.update(
+    S3_BUCKET_NAME="documents",
+    ARTIFACT_BUCKET_NAME="artifacts",
+    DOCUMENTS_TABLE_NAME="documents-table",
+    EMBEDDING_CACHE_TABLE_NAME="embedding-cache-table",
+    PINECONE_API_KEY_SECRET_NAME="pinecone-secret",
+    AWS_DEFAULT_REGION="us-east-1",
+    AWS_ACCESS_KEY_ID="testing",
+    AWS_SECRET_ACCESS_KEY="testing",
+    LOG_LEVEL="WARNING",
+    POWERTOOLS_LOG_LEVEL="WARNING",
+    EMBEDDING_CACHE_BACKEND="none",
+    DOCUMENT_REGISTRY_BACKEND="local",
+    LOCAL_DOCUMENT_REGISTRY_PATH=f"{LOCAL_ROOT}/registry.json",
+    VECTOR_STORE_BACKEND="local",
+    LOCAL_VECTOR_STORE_PATH=f"{LOCAL_ROOT}/vectors",
+    EMBEDDING_BACKOFF_BASE_SECONDS="0",
+)
+
+
+def _etag(body: bytes) -> str:
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+class FakeS3:
+    """The S3 calls the indexer makes, on objects held in memory."""
+
+    def __init__(self):
+        self.objects: Dict[Tuple[str, str], bytes] = {}
+
+    def put_object(self, Bucket: str, Key: str, Body: Any, **kwargs) -> Dict[str, Any]:
+        existing = self.objects.get((Bucket, Key))
+        if ("IfMatch" in kwargs and (existing is None or _etag(existing) != kwargs["IfMatch"])) or (
+            "IfNoneMatch" in kwargs and existing is not None
+        ):
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": Key}}, "PutObject")
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+        return {"ETag": _etag(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        body = self._get(Bucket, Key, "GetObject")
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": _etag(body)}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        body = self._get(Bucket, Key, "HeadObject")
+        return {"ContentLength": len(body), "ETag": _etag(body), "Metadata": {}}
+
+    def download_fileobj(self, Bucket: str, Key: str, Fileobj: Any) -> None:
+        Fileobj.write(self._get(Bucket, Key, "GetObject"))
+
+    def download_file(self, Bucket: str, Key: str, Filename: str) -> None:
+        body = self._get(Bucket, Key, "GetObject")
+        with open(Filename, "wb") as file:
+            file.write(body)
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, **kwargs) -> None:
+        with open(Filename, "rb") as file:
+            self.objects[(Bucket, Key)] = file.read()
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket: str, Delete: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        for item in Delete["Objects"]:
+            self.objects.pop((Bucket, item["Key"]), None)
+        return {}
+
+    def get_paginator(self, operation_name: str) -> "FakeS3":
+        return self
+
+    def paginate(self, Bucket: str, Prefix: str = "", **kwargs) -> List[Dict[str, Any]]:
+        contents = [
+            {"Key": key, "ETag": _etag(body), "Size": len(body)}
+            for (bucket, key), body in sorted(self.objects.items())
+            if bucket == Bucket and key.startswith(Prefix)
+        ]
+        return [{"Contents": contents}]
+
+    def _get(self, bucket: str, key: str, operation_name: str) -> bytes:
+        if (bucket, key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": key}}, operation_name)
+        return self.objects[(bucket, key)]
+
+
+class FakeBedrock:
+    """Titan embeddings that are a deterministic function of the input text."""
+
+    def __init__(self):
+        self.inputs: List[str] = []
+
+    def invoke_model(self, body: str, **kwargs) -> Dict[str, Any]:
+        text = json.loads(body)["inputText"]
+        self.inputs.append(text)
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        embedding = np.random.default_rng(seed).normal(size=16).astype(np.float32)
+        return {"body": io.BytesIO(json.dumps({"embedding": embedding.tolist()}).encode("utf-8"))}
+
+
+import indexer.boto3_clients  # noqa: E402
+
+S3 = FakeS3()
+BEDROCK = FakeBedrock()
+indexer.boto3_clients.S3_CLIENT = S3  # type: ignore
+indexer.boto3_clients.BEDROCK_CLIENT = BEDROCK  # type: ignore
+
+
+class Context:
+    """The parts of the Lambda context the handler uses."""
+
+    function_name = "indexer"
+    memory_limit_in_mb = 2048
+    invoked_function_arn = "arn:aws:lambda:us-east-1:000000000000:function:indexer"
+    aws_request_id = "request"
+
+    def __init__(self, remaining_ms: int = 400_000):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_ms
+
+
+@pytest.fixture(autouse=True)
+def local_backends(tmp_path, monkeypatch):
+    """Fresh S3 objects, registry and vector store for every test."""
+    from indexer.services.documents import DOCUMENT_REGISTRY
+    from indexer.services.embeddings import EMBEDDING_ENGINE
+    from indexer.services.load import LOAD
+    from indexer.services.vector_store import LocalVectorStore
+
+    S3.objects.clear()
+    BEDROCK.inputs.clear()
+    monkeypatch.setattr(DOCUMENT_REGISTRY, "path", tmp_path / "registry.json")
+    monkeypatch.setattr(LOAD, "vector_store", LocalVectorStore(str(tmp_path / "vectors")))
+    monkeypatch.setattr(EMBEDDING_ENGINE, "cache", None)
+    yield
+
+
+@pytest.fixture
+def s3() -> FakeS3:
+    return S3
+
+
+@pytest.fixture
+def bedrock() -> FakeBedrock:
+    return BEDROCK
+
+
+@pytest.fixture
+def context() -> Context:
+    return Context()
+
+
+def sqs_event(*object_events: Tuple[str, str], sequencers: Tuple[str, ...] = ()) -> Dict[str, Any]:
+    """An SQS batch with one message per `(event_name, key)` S3 notification."""
+    records = []
+    for i, (event_name, key) in enumerate(object_events):
+        s3_object: Dict[str, Any] = {"key": key, "size": len(S3.objects.get(("documents", key), b""))}
+        if i < len(sequencers):
+            s3_object["sequencer"] = sequencers[i]
+        body = {"Records": [{"eventName": event_name, "s3": {"object": s3_object}}]}
+        records.append(
+            {
+                "messageId": f"message-{i}",
+                "receiptHandle": "handle",
+                "body": json.dumps(body),
+                "attributes": {},
+                "messageAttributes": {},
+                "md5OfBody": "",
+                "eventSource": "aws:sqs",
+                "eventSourceARN": "arn:aws:sqs:us-east-1:000000000000:queue",
+                "awsRegion": "us-east-1",
+            }
+        )
+    return {"Records": records}
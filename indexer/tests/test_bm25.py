@@ -0,0 +1,53 @@
+from collections import Counter
+
+from indexer.services.bm25 import CORPUS_STATISTICS, DocumentStatistics
+
+
+def statistics(num_vectors: int, total_length: int, **document_frequencies: int) -> DocumentStatistics:
+    return DocumentStatistics(num_vectors, total_length, Counter(document_frequencies))
+
+
+def get_corpus() -> dict:
+    corpus, _ = CORPUS_STATISTICS._get_corpus()
+    return CORPUS_STATISTICS._encode_corpus(corpus)
+
+
+def test_documents_are_merged_into_the_totals_without_listing_the_shards(s3, monkeypatch):
+    paginate = s3.paginate
+    monkeypatch.setattr(s3, "paginate", None)
+    CORPUS_STATISTICS.add_documents({"a": statistics(2, 10, water=2, boil=1), "b": statistics(1, 2, water=1)})
+    # A new version replaces the document's previous contribution
+    CORPUS_STATISTICS.add_documents({"a": statistics(1, 4, boil=1)})
+    CORPUS_STATISTICS.remove_documents(["b"])
+    assert get_corpus() == {
+        "num_vectors": 1,
+        "total_length": 4,
+        "document_frequencies": {"boil": 1},
+        "average_length": 4.0,
+    }
+
+    monkeypatch.setattr(s3, "paginate", paginate)
+    CORPUS_STATISTICS.rebuild()
+    assert get_corpus()["document_frequencies"] == {"boil": 1}
+
+
+def test_concurrent_updates_are_merged_again(s3, monkeypatch):
+    CORPUS_STATISTICS.add_documents({"a": statistics(1, 4, water=1)})
+    get_object = s3.get_object
+
+    def get_object_then_update(Bucket, Key, **kwargs):
+        response = get_object(Bucket=Bucket, Key=Key, **kwargs)
+        if Key == CORPUS_STATISTICS.corpus_key:
+            # Another run merges its documents between this run's read and write
+            monkeypatch.setattr(s3, "get_object", get_object)
+            CORPUS_STATISTICS.add_documents({"b": statistics(1, 6, water=1)})
+        return response
+
+    monkeypatch.setattr(s3, "get_object", get_object_then_update)
+    CORPUS_STATISTICS.add_documents({"c": statistics(2, 2, boil=2)})
+    assert get_corpus() == {
+        "num_vectors": 4,
+        "total_length": 12,
+        "document_frequencies": {"water": 2, "boil": 2},
+        "average_length": 3.0,
+    }
@@ -0,0 +1,93 @@
+import pyarrow as pa
+import pytest
+
+from indexer.schemas import RAW_SCHEMA
+from indexer.services.dedup import DEDUP_INDEX, DedupIndex
+from indexer.settings import Settings
+
+
+SUPPORT = "water boils at one hundred degrees celsius at sea level under normal atmospheric pressure"
+
+
+def make_records(document_id: str, rows: list) -> pa.RecordBatch:
+    return pa.RecordBatch.from_pylist(
+        [
+            dict(question=question, correct_answer=answer, support=support, document_id=document_id, row_index=i)
+            for i, (question, answer, support) in enumerate(rows)
+        ],
+        schema=RAW_SCHEMA,
+    )
+
+
+def index(document_id: str, rows: list) -> pa.RecordBatch:
+    run = DEDUP_INDEX.start_run([document_id])
+    unique_records = run.collapse(make_records(document_id, rows))
+    run.mark_loaded(unique_records)
+    run.save([document_id])
+    return unique_records
+
+
+@pytest.fixture
+def counted_reads(s3, monkeypatch):
+    reads = []
+    get_object = s3.get_object
+
+    def counted_get_object(Bucket, Key, **kwargs):
+        reads.append(Key)
+        return get_object(Bucket=Bucket, Key=Key, **kwargs)
+
+    monkeypatch.setattr(s3, "get_object", counted_get_object)
+    return reads
+
+
+def test_rows_are_duplicates_only_when_their_whole_content_is(counted_reads):
+    unique_records = index(
+        "a",
+        [
+            ("At what temperature does water boil?", "100 degrees", SUPPORT),
+            ("Under which pressure was the boiling point given?", "normal pressure", SUPPORT),
+            ("At what temperature does water boil?", "100 degrees", SUPPORT),
+        ],
+    )
+    # The rows sharing a support passage keep their own question and answer
+    assert unique_records.column("row_index").to_pylist() == [0, 1]
+
+    run = DEDUP_INDEX.start_run(["b"])
+    unique_records = run.collapse(make_records("b", [("At what temperature does water boil?", "100 degrees", SUPPORT)]))
+    assert unique_records.num_rows == 0
+    assert run.get_document_ids() == {("a", 0): ["a", "b"]}
+
+
+def test_runs_only_read_the_shards_that_changed(counted_reads):
+    index("a", [("At what temperature does water boil?", "100 degrees", SUPPORT)])
+    index("b", [("Why is the sky blue?", "scattering", "sunlight is scattered by the molecules of the air " * 2)])
+    # The shards written by this container are known by their ETags
+    assert counted_reads == []
+
+    index("c", [("At what temperature does water boil?", "100 degrees", SUPPORT)])
+    _, dependents = DEDUP_INDEX.remove_document("a")
+    assert dependents == {"c"}
+    assert counted_reads == []
+
+    # A shard another container wrote is read once
+    other_container = DedupIndex(Settings())
+    other_container.put_shard("b", DEDUP_INDEX._shards["c"][1])
+    DEDUP_INDEX.start_run(["d"])
+    DEDUP_INDEX.start_run(["d"])
+    assert counted_reads == ["dedup/documents/b.npz"]
+
+
+def test_canonical_rows_that_fail_to_embed_are_not_collapsed_into(counted_reads):
+    boiling = ("At what temperature does water boil?", "100 degrees", SUPPORT)
+    run = DEDUP_INDEX.start_run(["a"])
+    unique_records = run.collapse(make_records("a", [boiling, boiling]))
+    assert unique_records.column("row_index").to_pylist() == [0]
+    # The canonical row's embedding failed, so neither row has a vector
+    run.drop("a", [0])
+    run.save(["a"])
+    assert run.count_indexed()["a"] == 0
+    assert run.get_document_ids() == {}
+    assert DEDUP_INDEX._shards["a"][1].canonical_rows.tolist() == []
+
+    run = DEDUP_INDEX.start_run(["b"])
+    assert run.collapse(make_records("b", [boiling])).num_rows == 1
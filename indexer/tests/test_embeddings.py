@@ -0,0 +1,112 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+from botocore.exceptions import ClientError
+
+from indexer.services.embedding_cache import get_cache_key
+from indexer.services.embeddings import EMBEDDING_ENGINE, AimdController
+from indexer.services.transform import Transform
+
+
+def throttling_error() -> ClientError:
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeModel")
+
+
+def validation_error() -> ClientError:
+    return ClientError({"Error": {"Code": "ValidationException", "Message": "Too long"}}, "InvokeModel")
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(EMBEDDING_ENGINE, "max_attempts", 3)
+    monkeypatch.setattr(EMBEDDING_ENGINE, "backoff_base", 0.0)
+    monkeypatch.setattr(
+        EMBEDDING_ENGINE, "controller", AimdController(initial=4, minimum=1, maximum=8, latency_target=1.0)
+    )
+    return EMBEDDING_ENGINE
+
+
+def test_aimd_grows_by_about_one_per_window_within_the_latency_target():
+    controller = AimdController(initial=4, minimum=1, maximum=8, latency_target=1.0)
+    successes = 0
+    while controller.limit == 4:
+        controller.on_success(0.1)
+        successes += 1
+    assert controller.limit == 5
+    assert 4 <= successes <= 6
+
+
+def test_aimd_cuts_once_per_round_trip_and_respects_the_bounds():
+    controller = AimdController(initial=8, minimum=2, maximum=8, latency_target=1.0)
+    controller.on_throttle()
+    controller.on_throttle()
+    # The second throttle reports the same congestion as the first
+    assert controller.limit == 4
+    controller._last_decrease = 0.0
+    controller.on_throttle()
+    controller._last_decrease = 0.0
+    controller.on_throttle()
+    assert controller.limit == 2
+    for _ in range(100):
+        controller.on_success(0.1)
+    assert controller.limit == 8
+
+
+def test_aimd_cuts_when_requests_are_slower_than_the_target():
+    controller = AimdController(initial=8, minimum=1, maximum=8, latency_target=1.0)
+    controller.on_success(5.0)
+    assert controller.limit == 4
+
+
+def test_embed_retries_throttled_requests(engine, monkeypatch):
+    attempts = {}
+
+    def get_embedding(text):
+        attempts[text] = attempts.get(text, 0) + 1
+        if attempts[text] < 3:
+            raise throttling_error()
+        return np.full(4, len(text), dtype=np.float32)
+
+    monkeypatch.setattr(engine, "_get_embedding", get_embedding)
+    embeddings = engine.embed(["a", "bb"])
+    assert [embedding.tolist() for embedding in embeddings] == [[1.0] * 4, [2.0] * 4]
+    assert attempts == {"a": 3, "bb": 3}
+    assert engine.controller.limit < 4
+
+
+def test_embed_reports_texts_that_fail_without_failing_the_others(engine, monkeypatch):
+    attempts = {}
+
+    def get_embedding(text):
+        attempts[text] = attempts.get(text, 0) + 1
+        if text == "invalid":
+            raise validation_error()
+        if text == "throttled":
+            raise throttling_error()
+        return np.ones(4, dtype=np.float32)
+
+    monkeypatch.setattr(engine, "_get_embedding", get_embedding)
+    embeddings = engine.embed(["valid", "invalid", "throttled"])
+    assert embeddings[0] is not None and embeddings[1] is None and embeddings[2] is None
+    # Validation errors aren't retried, throttling is retried up to the attempt limit
+    assert attempts == {"valid": 1, "invalid": 1, "throttled": 3}
+
+
+def test_embed_sends_repeated_texts_once(engine, monkeypatch):
+    calls = []
+    monkeypatch.setattr(engine, "_get_embedding", lambda text: calls.append(text) or np.ones(4, dtype=np.float32))
+    embeddings = engine.embed(["same", "same", "other"])
+    assert len(embeddings) == 3 and all(embedding is not None for embedding in embeddings)
+    assert sorted(calls) == ["other", "same"]
+
+
+def test_the_same_passage_in_two_documents_shares_a_cache_key():
+    records = pa.RecordBatch.from_pylist(
+        [
+            {"question": "q", "correct_answer": "a", "support": "s", "document_id": document_id}
+            for document_id in ("a.parquet", "b.parquet")
+        ]
+    )
+    first, second = Transform()._get_embedding_inputs(records)
+    assert get_cache_key("model", first) == get_cache_key("model", second)
+    assert get_cache_key("model", first) != get_cache_key("other-model", first)
@@ -0,0 +1,238 @@
+import io
+import json
+import tempfile
+import threading
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from botocore.exceptions import ClientError
+
+import indexer.index
+from indexer.index import handler
+from indexer.services.documents import DOCUMENT_REGISTRY
+from indexer.services.embeddings import EMBEDDING_ENGINE
+from indexer.services.extract import EXTRACT
+from indexer.services.load import LOAD
+from indexer.settings import ExtractMode
+from tests.conftest import sqs_event
+
+
+def make_parquet(rows: int, prefix: str = "") -> bytes:
+    table = pa.table(
+        {
+            "question": [f"{prefix} question {i}" for i in range(rows)],
+            "distractor1": ["distractor"] * rows,
+            "correct_answer": [f"answer {i}" for i in range(rows)],
+            "support": [
+                f"{prefix} passage {i} " + " ".join(f"word{i * 7 + j}" for j in range(12)) for i in range(rows)
+            ],
+        }
+    )
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    """Record what the handler dispatches instead of indexing, `failed` keys are reported as failed."""
+    calls = {"removed": [], "created": [], "failed": set()}
+
+    def delete_documents(document_ids, context):
+        calls["removed"].extend(document_ids)
+        return calls["failed"] & set(document_ids)
+
+    def put_documents(object_events, context):
+        calls["created"].extend(object_events)
+        return calls["failed"] & set(object_events)
+
+    monkeypatch.setattr(indexer.index, "delete_documents", delete_documents)
+    monkeypatch.setattr(indexer.index, "put_documents", put_documents)
+    return calls
+
+
+def test_handler_runs_the_latest_event_of_every_object(dispatched, context):
+    event = sqs_event(
+        ("ObjectCreated:Put", "a"),
+        ("ObjectRemoved:Delete", "a"),
+        ("ObjectRemoved:Delete", "b"),
+        ("ObjectCreated:Put", "b"),
+        sequencers=("0A", "0B", "0C", "00D"),
+    )
+    assert handler(event, context) == {"batchItemFailures": []}
+    assert dispatched["removed"] == ["a"]
+    assert dispatched["created"] == ["b"]
+
+
+@pytest.mark.parametrize(
+    "event_name",
+    ["ObjectCreated:Put", "ObjectCreated:Post", "ObjectCreated:Copy", "ObjectCreated:CompleteMultipartUpload"],
+)
+def test_handler_indexes_every_kind_of_create(dispatched, context, event_name):
+    handler(sqs_event((event_name, "uploaded+file.parquet")), context)
+    assert list(dispatched["created"]) == ["uploaded file.parquet"]
+
+
+def test_handler_reports_the_messages_of_failed_objects(dispatched, context):
+    dispatched["failed"] = {"b"}
+    event = sqs_event(("ObjectCreated:Put", "a"), ("ObjectCreated:Put", "b"), ("ObjectCreated:Post", "b"))
+    event["Records"].append({**event["Records"][0], "messageId": "unparsable", "body": "{"})
+    result = handler(event, context)
+    assert [failure["itemIdentifier"] for failure in result["batchItemFailures"]] == [
+        "message-1",
+        "message-2",
+        "unparsable",
+    ]
+
+
+def test_handler_ignores_the_test_event(dispatched, context):
+    event = sqs_event(("ObjectCreated:Put", "a"))
+    event["Records"][0]["body"] = json.dumps({"Event": "s3:TestEvent"})
+    assert handler(event, context) == {"batchItemFailures": []}
+    assert dispatched["created"] == []
+
+
+def test_indexing_resumes_after_the_last_checkpoint(s3, bedrock, context, monkeypatch):
+    s3.objects[("documents", "doc")] = make_parquet(30)
+    monkeypatch.setattr(EXTRACT, "chunk_size", 5)
+    monkeypatch.setattr(indexer.index.SETTINGS, "checkpoint_interval_rows", 10)
+    load = LOAD.load
+    loads = []
+
+    def failing_load(records, average_length=None):
+        loads.append(records.num_rows)
+        if len(loads) == 4:
+            raise RuntimeError("upsert failed")
+        load(records, average_length)
+
+    monkeypatch.setattr(LOAD, "load", failing_load)
+    assert handler(sqs_event(("ObjectCreated:Put", "doc")), context) == {
+        "batchItemFailures": [{"itemIdentifier": "message-0"}]
+    }
+    # The three chunks loaded before the failure are checkpointed
+    state = DOCUMENT_REGISTRY._get("doc")
+    assert (state["indexing_status"], state["checkpoint_rows"]) == ("FAILED", 15)
+
+    bedrock.inputs.clear()
+    assert handler(sqs_event(("ObjectCreated:Put", "doc")), context) == {"batchItemFailures": []}
+    assert len(bedrock.inputs) == 15
+    state = DOCUMENT_REGISTRY._get("doc")
+    assert (state["indexing_status"], state["row_count"], state["vector_count"]) == ("COMPLETE", 30, 30)
+    assert LOAD.vector_store.describe()["total_vector_count"] == 30
+
+    # A redelivery of the indexed version is skipped
+    bedrock.inputs.clear()
+    handler(sqs_event(("ObjectCreated:Put", "doc")), context)
+    assert bedrock.inputs == []
+
+
+def test_a_document_that_fails_mid_way_is_failed_not_finished(s3, bedrock, context, monkeypatch):
+    table = pq.read_table(io.BytesIO(make_parquet(12)))
+    supports = table.column("support").to_pylist()
+    supports[7] = None
+    buffer = io.BytesIO()
+    pq.write_table(table.set_column(3, "support", pa.array(supports, pa.string())), buffer)
+    s3.objects[("documents", "doc")] = buffer.getvalue()
+    monkeypatch.setattr(EXTRACT, "chunk_size", 5)
+
+    assert handler(sqs_event(("ObjectCreated:Put", "doc")), context) == {
+        "batchItemFailures": [{"itemIdentifier": "message-0"}]
+    }
+    state = DOCUMENT_REGISTRY._get("doc")
+    assert (state["indexing_status"], state["checkpoint_rows"]) == ("FAILED", 5)
+    assert "missing values" in state["error"]
+
+
+def test_memory_mode_downloads_the_documents_that_fit_the_budget(s3, monkeypatch):
+    for key in "abcd":
+        s3.objects[("documents", key)] = make_parquet(3, key)
+    downloading = []
+    download = EXTRACT._download_to_memory
+    # Small documents are downloaded together, none of them completes before they all started
+    started = threading.Barrier(4, timeout=5)
+
+    def tracked_download(s3_key):
+        downloading.append(s3_key)
+        started.wait()
+        return download(s3_key)
+
+    monkeypatch.setattr(EXTRACT, "_download_to_memory", tracked_download)
+    for _, chunks in EXTRACT.iter_documents(list("abcd")):
+        assert sum(chunk.num_rows for chunk in chunks) == 3
+    assert sorted(downloading) == list("abcd")
+
+    # Two documents fit, the one being parsed and the download of the next
+    downloading.clear()
+    started = threading.Barrier(1)
+    monkeypatch.setattr(EXTRACT, "memory_budget_bytes", 2 * max(len(s3.objects[("documents", key)]) for key in "abcd"))
+    for i, (_, chunks) in enumerate(EXTRACT.iter_documents(list("abcd"))):
+        assert len(downloading) <= i + 2
+        assert sum(chunk.num_rows for chunk in chunks) == 3
+    assert sorted(downloading) == list("abcd")
+
+
+def test_disk_mode_removes_the_staged_files_of_failed_and_unparsed_documents(s3, monkeypatch, tmp_path):
+    s3.objects[("documents", "broken.parquet")] = b"not parquet"
+    for key in ("a.parquet", "b.parquet", "c.parquet"):
+        s3.objects[("documents", key)] = make_parquet(3)
+    monkeypatch.setattr(EXTRACT, "mode", ExtractMode.DISK)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    failed = []
+    for s3_key, chunks in EXTRACT.iter_documents(["broken.parquet", "missing.parquet", "a.parquet"]):
+        try:
+            list(chunks)
+        except Exception:
+            failed.append(s3_key)
+    assert sorted(failed) == ["broken.parquet", "missing.parquet"]
+    assert list(tmp_path.iterdir()) == []
+
+    # A run that stops early leaves the documents it didn't get to
+    documents = EXTRACT.iter_documents(["a.parquet", "b.parquet", "c.parquet"])
+    _, chunks = next(documents)
+    list(chunks)
+    documents.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_a_failed_document_doesnt_fail_the_others(s3, bedrock, context):
+    s3.objects[("documents", "good")] = make_parquet(5, "good")
+    s3.objects[("documents", "broken.parquet")] = b"not parquet"
+    result = handler(sqs_event(("ObjectCreated:Put", "good"), ("ObjectCreated:Put", "broken.parquet")), context)
+    assert result == {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+    assert DOCUMENT_REGISTRY._get("good")["indexing_status"] == "COMPLETE"
+    assert DOCUMENT_REGISTRY._get("broken.parquet")["indexing_status"] == "FAILED"
+    assert LOAD.vector_store.describe()["total_vector_count"] == 5
+
+
+def test_rows_that_cant_be_embedded_lose_the_previous_versions_vectors(s3, bedrock, context, monkeypatch):
+    s3.objects[("documents", "doc")] = make_parquet(10, "v1")
+    handler(sqs_event(("ObjectCreated:Put", "doc")), context)
+    assert LOAD.vector_store.describe()["total_vector_count"] == 10
+
+    get_embedding = EMBEDDING_ENGINE._get_embedding
+
+    def failing_get_embedding(text):
+        if "v2 question 3" in text:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "Invalid"}}, "InvokeModel")
+        return get_embedding(text)
+
+    monkeypatch.setattr(EMBEDDING_ENGINE, "_get_embedding", failing_get_embedding)
+    s3.objects[("documents", "doc")] = make_parquet(10, "v2")
+    handler(sqs_event(("ObjectCreated:Put", "doc")), context)
+    state = DOCUMENT_REGISTRY._get("doc")
+    assert (state["indexing_status"], state["error"]) == ("FAILED", "Indexed 9 of 10 rows")
+    assert LOAD.vector_store.describe()["total_vector_count"] == 9
+
+
+def test_deletes_are_checked_by_fetching_the_manifest_ids(s3, bedrock, context, monkeypatch):
+    s3.objects[("documents", "doc")] = make_parquet(10)
+    handler(sqs_event(("ObjectCreated:Put", "doc")), context)
+
+    def list_ids(prefix):
+        raise AssertionError("The index is listed")
+
+    monkeypatch.setattr(LOAD.vector_store, "list_ids", list_ids)
+    del s3.objects[("documents", "doc")]
+    assert handler(sqs_event(("ObjectRemoved:Delete", "doc")), context) == {"batchItemFailures": []}
+    assert LOAD.vector_store.describe()["total_vector_count"] == 0
@@ -0,0 +1,36 @@
+import pyarrow as pa
+import pytest
+
+from indexer.services.readers import DocumentFormat, detect_format, iter_csv
+
+
+PROSE = (
+    "Water boils at 100 degrees, at sea level.\n"
+    "Under lower pressure, on a mountain, it boils at a lower temperature.\n"
+    "Salt raises the boiling point slightly.\n"
+)
+
+
+@pytest.mark.parametrize(
+    "head, document_format",
+    [
+        ("question,correct_answer,support\nq,a,s\n", DocumentFormat.CSV),
+        ("id,title,body\n1,Water,Boils at 100 degrees\n2,Ice,Melts at 0 degrees\n", DocumentFormat.CSV),
+        ("question;correct_answer;support\nq;a;s\nq2;a2;s2\n", DocumentFormat.CSV),
+        ("1\tWater\t100\n2\tIce\t0\n3\tSteam\t120", DocumentFormat.CSV),
+        (PROSE, DocumentFormat.TEXT),
+        ("A single line, with a comma.\n", DocumentFormat.TEXT),
+        ('{"question": "q"}\n', DocumentFormat.JSONL),
+    ],
+)
+def test_documents_without_an_extension_are_sniffed(head, document_format):
+    assert detect_format("4f1c9a", head.encode("utf-8")) == document_format
+
+
+def test_csv_documents_are_read_with_the_sniffed_delimiter():
+    text = 'question;correct_answer;support\nWhat boils?;water;"Water boils; at 100 degrees"\nq2;a2;s2\n'
+    batches = list(iter_csv(pa.BufferReader(text.encode("utf-8")), batch_size=10))
+    assert pa.Table.from_batches(batches).to_pylist() == [
+        {"question": "What boils?", "correct_answer": "water", "support": "Water boils; at 100 degrees"},
+        {"question": "q2", "correct_answer": "a2", "support": "s2"},
+    ]
@@ -0,0 +1,113 @@
+"""
+Measure the write, refresh and query latency of the local vector store.
+
+Upserts synthetic embeddings in batches like the indexer does, timing every batch, then times how long a second store
+on the same directory takes to catch up with one more batch, and the query latency below and above the HNSW threshold.
+
+Usage:
+    python benchmarks/local_store.py [--vectors 13000] [--dimension 1536] [--batch-size 100] [--queries 200]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PACKAGE_ROOT))
+
+from vector_index import LocalVectorStore  # noqa: E402
+
+
+def make_vectors(count: int, dimension: int, rng: np.random.Generator, topics: int = 50) -> np.ndarray:
+    # Unit vectors around topic centroids, like Titan embeddings of related passages
+    centroids = rng.standard_normal((topics, dimension)).astype(np.float32)
+    vectors = centroids[rng.integers(topics, size=count)] + 1.5 * rng.standard_normal((count, dimension))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_batch(vectors: np.ndarray, start: int, rng: np.random.Generator) -> list:
+    return [
+        {
+            "id": f"document_{start + i}",
+            "values": vector,
+            "sparse_values": {"indices": sorted(rng.choice(50_000, 20, replace=False).tolist()), "values": [1.0] * 20},
+            "metadata": {"document_id": "document", "row_index": start + i},
+        }
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def time_queries(store: LocalVectorStore, queries: np.ndarray, top_k: int) -> float:
+    store.query(queries[0], top_k)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        store.query(query, top_k, sparse_vector={"indices": [1, 2, 3], "values": [0.1, 0.1, 0.1]})
+        latencies.append(time.perf_counter() - start)
+    return round(1000 * statistics.median(latencies), 3)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=13_000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--hnsw-threshold", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = make_vectors(args.vectors + args.batch_size, args.dimension, rng)
+    queries = make_vectors(args.queries, args.dimension, rng)
+    with tempfile.TemporaryDirectory() as directory:
+        writer = LocalVectorStore(directory, hnsw_threshold=args.hnsw_threshold)
+        reader = LocalVectorStore(directory, hnsw_threshold=args.hnsw_threshold)
+        batch_latencies = []
+        exact_query_ms = None
+        start = time.perf_counter()
+        for offset in range(0, args.vectors, args.batch_size):
+            batch = make_batch(vectors[offset : offset + args.batch_size], offset, rng)
+            batch_start = time.perf_counter()
+            writer.upsert(batch)
+            batch_latencies.append(time.perf_counter() - batch_start)
+            if exact_query_ms is None and offset + args.batch_size >= args.hnsw_threshold // 2:
+                exact_query_ms = time_queries(reader, queries, args.top_k)
+        total_seconds = time.perf_counter() - start
+
+        # The reader catches up with everything written above on its first query, then with a single batch
+        reader.describe()
+        writer.upsert(make_batch(vectors[args.vectors :], args.vectors, rng))
+        refresh_start = time.perf_counter()
+        reader.describe()
+        refresh_ms = 1000 * (time.perf_counter() - refresh_start)
+        cold_start = time.perf_counter()
+        LocalVectorStore(directory, hnsw_threshold=args.hnsw_threshold).describe()
+        cold_ms = 1000 * (time.perf_counter() - cold_start)
+        summary = {
+            "vectors": args.vectors,
+            "dimension": args.dimension,
+            "batch_size": args.batch_size,
+            "upsert_total_seconds": round(total_seconds, 3),
+            "upsert_median_batch_ms": round(1000 * statistics.median(batch_latencies), 3),
+            "upsert_max_batch_ms": round(1000 * max(batch_latencies), 3),
+            "refresh_one_batch_ms": round(refresh_ms, 3),
+            "cold_open_ms": round(cold_ms, 3),
+            "exact_query_median_ms": exact_query_ms,
+            "hnsw_query_median_ms": time_queries(reader, queries, args.top_k),
+            "hnsw": reader.describe()["hnsw"],
+        }
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
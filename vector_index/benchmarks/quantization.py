@@ -0,0 +1,124 @@
+"""
+Measure the recall and memory of the local vector store's quantized scans.
+
+Builds a local store of synthetic embeddings (unit vectors around topic centroids, like Titan embeddings of related
+passages) and queries it with noisy copies of stored vectors. Every quantization and rescore factor is compared with
+the exact float32 scan, reporting recall@k, the bytes held in memory for the scan and the query latency.
+
+Usage:
+    python benchmarks/quantization.py [--vectors 10000] [--dimension 1536] [--queries 200] [--top-k 10]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PACKAGE_ROOT))
+
+from vector_index import LocalVectorStore, VectorQuantization  # noqa: E402
+
+
+def make_vectors(count: int, dimension: int, topics: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = rng.standard_normal((topics, dimension)).astype(np.float32)
+    vectors = centroids[rng.integers(topics, size=count)] + 1.5 * rng.standard_normal((count, dimension))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors: np.ndarray, count: int, rng: np.random.Generator) -> np.ndarray:
+    queries = vectors[rng.integers(len(vectors), size=count)] + 0.05 * rng.standard_normal((count, vectors.shape[1]))
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def run(store: LocalVectorStore, queries: np.ndarray, top_k: int) -> tuple:
+    # The first query builds the codes
+    store.query(queries[0], top_k)
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        matches = store.query(query, top_k)
+        latencies.append(time.perf_counter() - start)
+        results.append({match.id for match in matches})
+    return results, latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=10_000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rescore-factors", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = make_vectors(args.vectors, args.dimension, args.topics, rng)
+    queries = make_queries(vectors, args.queries, rng)
+    with tempfile.TemporaryDirectory() as directory:
+        writer = LocalVectorStore(directory, hnsw_threshold=args.vectors + 1)
+        for start in range(0, len(vectors), writer.max_upsert_batch_size):
+            writer.upsert(
+                [
+                    {"id": f"vector#{row}", "values": vectors[row]}
+                    for row in range(start, min(start + writer.max_upsert_batch_size, len(vectors)))
+                ]
+            )
+
+        def measure(quantization: VectorQuantization, rescore_factor: int = 1) -> tuple:
+            store = LocalVectorStore(
+                directory,
+                hnsw_threshold=args.vectors + 1,
+                quantization=quantization,
+                rescore_factor=rescore_factor,
+            )
+            results, latencies = run(store, queries, args.top_k)
+            index_bytes = store.describe()["quantized_bytes"] or vectors.nbytes
+            return results, latencies, index_bytes
+
+        exact, latencies, float_bytes = measure(VectorQuantization.NONE)
+        rows = [
+            {
+                "quantization": VectorQuantization.NONE.value,
+                "rescore_factor": None,
+                "recall": 1.0,
+                "index_bytes": float_bytes,
+                "compression": 1.0,
+                "median_query_ms": round(1000 * statistics.median(latencies), 3),
+            }
+        ]
+        for quantization in (VectorQuantization.INT8, VectorQuantization.BINARY):
+            for rescore_factor in args.rescore_factors:
+                results, latencies, index_bytes = measure(quantization, rescore_factor)
+                recall = np.mean([len(found & expected) / len(expected) for found, expected in zip(results, exact)])
+                rows.append(
+                    {
+                        "quantization": quantization.value,
+                        "rescore_factor": rescore_factor,
+                        "recall": round(float(recall), 4),
+                        "index_bytes": index_bytes,
+                        "compression": round(float_bytes / index_bytes, 1),
+                        "median_query_ms": round(1000 * statistics.median(latencies), 3),
+                    }
+                )
+    summary = {
+        "vectors": args.vectors,
+        "dimension": args.dimension,
+        "queries": args.queries,
+        "top_k": args.top_k,
+        "results": rows,
+    }
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+from vector_index.bm25 import decode_term_frequencies, encode_term_frequencies, term_index, tokenize
+
+
+def test_term_frequencies_round_trip_through_the_metadata_encoding():
+    term_frequencies = {"water": 2, "boils": 1, "100": 1}
+    assert tokenize("Water boils at 100°C, water!") == ["water", "boils", "at", "100", "c", "water"]
+    assert decode_term_frequencies(encode_term_frequencies(term_frequencies)) == term_frequencies
+
+
+def test_term_indexes_are_stable_across_processes():
+    # The API encodes queries against the sparse vectors the indexer wrote, possibly in another Python version
+    assert term_index("water") == 4214428890
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from vector_index import LocalVectorStore, VectorQuantization
+from vector_index.quantization import BLOCK_ROWS, BinaryQuantizer, ScalarQuantizer, get_quantizer
+
+
+def unit_vectors(count: int, dimension: int = 64, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_scalar_scores_are_the_dot_products_within_a_quantization_step():
+    matrix, queries = unit_vectors(BLOCK_ROWS + 100), unit_vectors(5, seed=1)
+    quantizer = ScalarQuantizer(matrix)
+    assert quantizer.codes.dtype == np.int8 and quantizer.codes.shape == matrix.shape
+    for query in queries:
+        # Every dimension is off by at most half a step
+        bound = float(np.abs(query) @ quantizer.step) / 2 + 1e-5
+        assert np.abs(quantizer.score(query) - matrix @ query).max() <= bound
+
+
+def test_binary_scores_rank_by_hamming_distance_whatever_the_query_norm():
+    matrix, query = unit_vectors(200), unit_vectors(1, seed=1)[0]
+    quantizer = BinaryQuantizer(matrix)
+    assert quantizer.codes.shape == (200, 8)
+    bits = np.unpackbits(quantizer.codes, axis=1).astype(bool)
+    distances = (bits != (query * quantizer.norm > quantizer.mean)).sum(axis=1)
+    assert np.array_equal(quantizer.score(query), -distances.astype(np.float32))
+    assert np.array_equal(quantizer.score(3 * query), quantizer.score(query))
+    # The closest row by its codes is the query itself
+    assert int(np.argmax(BinaryQuantizer(np.vstack([matrix, query])).score(query))) == 200
+
+
+@pytest.mark.parametrize("quantization", [VectorQuantization.INT8, VectorQuantization.BINARY])
+def test_extended_codes_match_the_codes_of_a_fit_over_the_same_parameters(quantization):
+    matrix = unit_vectors(300)
+    quantizer = get_quantizer(quantization, matrix[:100])
+    quantizer.extend(matrix[100:])
+    assert len(quantizer.codes) == 300
+    assert np.array_equal(quantizer.codes[100:], quantizer.encode(matrix[100:]))
+
+
+def test_no_quantization_has_no_quantizer():
+    assert get_quantizer(VectorQuantization.NONE, unit_vectors(10)) is None
+
+
+@pytest.mark.parametrize("quantization, rescore_factor", [(VectorQuantization.INT8, 8), (VectorQuantization.BINARY, 32)])
+def test_scans_keep_the_quantizers_rescore_factor_unless_one_is_set(tmp_path, quantization, rescore_factor):
+    vectors = unit_vectors(500)
+    store = LocalVectorStore(str(tmp_path), quantization=quantization)
+    store.upsert([{"id": f"doc_{i}", "values": vector, "metadata": {}} for i, vector in enumerate(vectors)])
+    store.query(vectors[0], top_k=2)
+    assert len(store._scan_quantized(vectors[0], top_k=2)) == 2 * rescore_factor
+    store.rescore_factor = 3
+    assert len(store._scan_quantized(vectors[0], top_k=2)) == 6
@@ -0,0 +1,144 @@
+import threading
+
+import numpy as np
+import pytest
+
+from vector_index import LocalVectorStore, PineconeVectorStore, VectorQuantization
+from vector_index.vector_store import InvertedIndex
+
+
+def unit_vectors(count: int, dimension: int = 16, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def upsert(store: LocalVectorStore, vectors: np.ndarray, start: int = 0) -> None:
+    store.upsert(
+        [
+            {
+                "id": f"doc_{start + i}",
+                "values": vector,
+                "sparse_values": {"indices": [start + i, 1_000_000], "values": [1.0, 0.5]},
+                "metadata": {"row_index": start + i},
+            }
+            for i, vector in enumerate(vectors)
+        ]
+    )
+
+
+def test_readers_replay_the_writes_of_another_store(tmp_path):
+    vectors = unit_vectors(20)
+    writer, reader = LocalVectorStore(str(tmp_path)), LocalVectorStore(str(tmp_path))
+    upsert(writer, vectors[:10])
+    assert [match.id for match in reader.query(vectors[3], top_k=1)] == ["doc_3"]
+
+    manifest = (tmp_path / "manifest.json").stat()
+    upsert(writer, vectors[10:], start=10)
+    writer.delete(["doc_3", "missing"])
+    writer.update_metadata({"doc_4": {"document_ids": ["a", "b"]}})
+    # Plain writes only append to the log and the matrix
+    assert (tmp_path / "manifest.json").stat().st_mtime_ns == manifest.st_mtime_ns
+    assert reader.query(vectors[3], top_k=1)[0].id != "doc_3"
+    assert reader.query(vectors[15], top_k=1)[0].id == "doc_15"
+    assert reader.fetch_metadata(["doc_4"]) == {"doc_4": {"row_index": 4, "document_ids": ["a", "b"]}}
+    assert reader.describe()["total_vector_count"] == 19
+
+
+def test_sparse_scores_are_added_to_the_dense_scores(tmp_path):
+    vectors = unit_vectors(10)
+    store = LocalVectorStore(str(tmp_path))
+    upsert(store, vectors)
+    match = store.query(np.zeros(16, dtype=np.float32), top_k=1, sparse_vector={"indices": [7], "values": [2.0]})[0]
+    assert (match.id, match.score) == ("doc_7", pytest.approx(2.0))
+    match = store.query(vectors[2], top_k=1, sparse_vector={"indices": [1_000_000], "values": [1.0]})[0]
+    assert (match.id, match.score) == ("doc_2", pytest.approx(1.5))
+
+
+def test_inverted_index_merges_segments_and_scores_every_posting():
+    index = InvertedIndex()
+    dense = np.zeros((64, 8), dtype=np.float32)
+    rng = np.random.default_rng(0)
+    for start in range(0, 64, 4):
+        batch = []
+        for row in range(start, start + 4):
+            terms = sorted(rng.choice(8, 3, replace=False).tolist())
+            values = rng.random(3).tolist()
+            dense[row, terms] = values
+            batch.append({"indices": terms, "values": values})
+        index.add(start, batch)
+    assert len(index.segments) <= 5
+    query = {"indices": [1, 5, 7], "values": [0.5, 1.0, 2.0]}
+    expected = dense[:, [1, 5, 7]] @ np.array([0.5, 1.0, 2.0], dtype=np.float32)
+    np.testing.assert_allclose(index.score(query, 64), expected, rtol=1e-6)
+
+
+def test_compaction_keeps_the_live_vectors(tmp_path):
+    vectors = unit_vectors(20)
+    store = LocalVectorStore(str(tmp_path))
+    upsert(store, vectors)
+    store.delete([f"doc_{i}" for i in range(10)])
+    assert store.describe()["rows"] == 10
+    assert (tmp_path / "vectors-1.f32").exists()
+    reader = LocalVectorStore(str(tmp_path))
+    assert [match.id for match in reader.query(vectors[12], top_k=1)] == ["doc_12"]
+    assert sorted(id_ for ids in reader.list_ids("doc_1") for id_ in ids) == [f"doc_1{i}" for i in range(10)]
+
+
+def test_replaced_files_are_kept_for_the_retention_period(tmp_path, monkeypatch):
+    vectors = unit_vectors(20)
+    store = LocalVectorStore(str(tmp_path))
+    upsert(store, vectors)
+    reader = LocalVectorStore(str(tmp_path))
+    reader.describe()
+    store.delete([f"doc_{i}" for i in range(10)])
+    # A reader that read the old manifest can still open its files
+    assert (tmp_path / "vectors-0.f32").exists() and (tmp_path / "log-0.jsonl").exists()
+
+    monkeypatch.setattr(LocalVectorStore, "file_retention_seconds", -1)
+    store.delete([f"doc_{i}" for i in range(10, 16)])
+    assert not (tmp_path / "vectors-0.f32").exists()
+    assert reader.describe()["total_vector_count"] == 4
+
+
+def test_graph_snapshots_are_loaded_and_extended_by_readers(tmp_path):
+    vectors = unit_vectors(300, dimension=32)
+    writer = LocalVectorStore(str(tmp_path), hnsw_threshold=200)
+    upsert(writer, vectors[:250])
+    assert writer.describe()["hnsw"]
+    snapshots = sorted(path.name for path in tmp_path.glob("hnsw-*.bin"))
+    assert snapshots == ["hnsw-0-250.bin"]
+
+    reader = LocalVectorStore(str(tmp_path), hnsw_threshold=200)
+    assert reader.query(vectors[42], top_k=1)[0].id == "doc_42"
+    upsert(writer, vectors[250:260], start=250)
+    writer.delete(["doc_42"])
+    assert reader.query(vectors[255], top_k=1)[0].id == "doc_255"
+    assert all(match.id != "doc_42" for match in reader.query(vectors[42], top_k=5))
+
+
+@pytest.mark.parametrize("quantization", [VectorQuantization.INT8, VectorQuantization.BINARY])
+def test_quantized_scans_cover_rows_written_after_the_codes(tmp_path, quantization):
+    vectors = unit_vectors(40)
+    store = LocalVectorStore(str(tmp_path), quantization=quantization, rescore_factor=4)
+    upsert(store, vectors[:30])
+    assert store.query(vectors[5], top_k=1)[0].id == "doc_5"
+    upsert(store, vectors[30:], start=30)
+    assert store.query(vectors[35], top_k=1)[0].id == "doc_35"
+    assert len(store._quantizer.codes) == 40
+
+
+def test_pinecone_metadata_updates_are_sent_concurrently():
+    class Index:
+        def __init__(self):
+            self.barrier = threading.Barrier(4, timeout=5)
+            self.updates = {}
+
+        def update(self, id, set_metadata):
+            # Every update waits for three others, serial updates would time out
+            self.barrier.wait()
+            self.updates[id] = set_metadata
+
+    store = PineconeVectorStore("host", "secret", connection_pool_maxsize=4)
+    store.__dict__["index"] = Index()
+    store.update_metadata({f"doc_{i}": {"document_ids": [str(i)]} for i in range(8)})
+    assert store.index.updates == {f"doc_{i}": {"document_ids": [str(i)]} for i in range(8)}
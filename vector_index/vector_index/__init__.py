@@ -0,0 +1,6 @@
+__version__ = "0.1.0"
+
+from vector_index.quantization import VectorQuantization
+from vector_index.vector_store import LocalVectorStore, PineconeVectorStore, VectorMatch, VectorStore
+
+__all__ = ["LocalVectorStore", "PineconeVectorStore", "VectorMatch", "VectorQuantization", "VectorStore"]
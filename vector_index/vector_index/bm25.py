@@ -0,0 +1,29 @@
+import re
+import zlib
+from typing import Dict, List
+
+
+# The indexer builds the corpus statistics and sparse vectors with these, the API encodes and scores queries with them
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def encode_term_frequencies(term_frequencies: Dict[str, int]) -> str:
+    """Encode term frequencies as `term:count` pairs, Pinecone metadata only supports flat values."""
+    return " ".join(f"{term}:{count}" for term, count in term_frequencies.items())
+
+
+def decode_term_frequencies(encoded: str) -> Dict[str, int]:
+    term_frequencies = {}
+    for pair in encoded.split():
+        term, _, count = pair.rpartition(":")
+        term_frequencies[term] = int(count)
+    return term_frequencies
+
+
+def term_index(term: str) -> int:
+    """Sparse vector dimension of a term, a stable 32 bit hash so the API can encode queries without a vocabulary."""
+    return zlib.crc32(term.encode("utf-8"))
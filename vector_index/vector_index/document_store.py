@@ -0,0 +1,3 @@
+# Columns of the document store parts, written by the indexer and read by the API to hydrate query results. The vector
+# metadata only keeps the ids and filterable fields.
+STORED_COLUMNS = ("question", "correct_answer", "support", "term_frequencies", "token_count")
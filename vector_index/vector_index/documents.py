@@ -0,0 +1,48 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from enum import Enum
+from pathlib import Path
+from typing import Any, Dict, Iterator
+
+
+# The API registers documents and reads these states, the indexer moves documents through them
+class IndexingStatus(str, Enum):
+
+    PENDING = "PENDING"
+    INDEXING = "INDEXING"
+    COMPLETE = "COMPLETE"
+    FAILED = "FAILED"
+    DELETING = "DELETING"
+
+
+class DocumentStateError(Exception):
+    """The document is missing or its status doesn't allow the change."""
+
+
+class LocalDocumentFile:
+    """
+    The documents of the local registry in a JSON file, for running without DynamoDB.
+
+    The file is locked so the API and the indexer can share it.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _documents(self, write: bool = True) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """Yield the documents under an exclusive lock, written back if `write` is set and the block completes."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.path.with_suffix(".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            documents = json.loads(self.path.read_text()) if self.path.exists() else {}
+            yield documents
+            if not write:
+                return
+            temporary = self.path.with_suffix(".tmp")
+            temporary.write_text(json.dumps(documents))
+            os.replace(temporary, self.path)
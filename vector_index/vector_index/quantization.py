@@ -0,0 +1,143 @@
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+
+
+class VectorQuantization(str, Enum):
+
+    NONE = "none"
+    INT8 = "int8"
+    BINARY = "binary"
+
+# Rows are encoded and scored this many at a time, bounding the float32 copies of a scan
+BLOCK_ROWS = 1024
+
+# Set bits of every byte value, for Hamming distances between packed bit codes
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+
+class Quantizer(ABC):
+    """
+    Compact codes of the rows of a float32 matrix, scanned to pick the candidates of a query.
+
+    Scores from the codes only rank the rows approximately, the candidates are rescored with their float32 rows.
+    Rows appended after the fit are encoded with the fitted parameters, see `extend`.
+    """
+
+    codes: np.ndarray
+    # Candidates kept per result of a query, for the true top results to be among them
+    rescore_factor: int
+
+    @abstractmethod
+    def score(self, query: np.ndarray) -> np.ndarray:
+        """Approximate scores of every row for `query`, higher is closer."""
+
+    @abstractmethod
+    def encode(self, block: np.ndarray) -> np.ndarray: ...
+
+    def extend(self, matrix: np.ndarray) -> None:
+        """Append the codes of the rows of `matrix` after the ones already encoded."""
+        blocks = [self.codes]
+        for start in range(0, len(matrix), BLOCK_ROWS):
+            blocks.append(self.encode(np.asarray(matrix[start : start + BLOCK_ROWS], dtype=np.float32)))
+        self.codes = np.concatenate(blocks)
+
+    @property
+    @abstractmethod
+    def nbytes(self) -> int: ...
+
+
+class ScalarQuantizer(Quantizer):
+    """
+    One byte per dimension, every dimension scaled over its range in the matrix, a quarter of the float32 size.
+
+    The dot product of a query with a row is computed from the codes without decoding them: the query is scaled by the
+    dimensions' steps and the offset is added back once per query.
+    """
+
+    rescore_factor = 8
+
+    def __init__(self, matrix: np.ndarray):
+        rows, dimension = matrix.shape
+        lower = np.full(dimension, np.inf, dtype=np.float32)
+        upper = np.full(dimension, -np.inf, dtype=np.float32)
+        for start in range(0, rows, BLOCK_ROWS):
+            block = np.asarray(matrix[start : start + BLOCK_ROWS], dtype=np.float32)
+            np.minimum(lower, block.min(axis=0), out=lower)
+            np.maximum(upper, block.max(axis=0), out=upper)
+        self.offset = np.where(np.isfinite(lower), lower, 0).astype(np.float32)
+        step = (upper - lower) / 255
+        self.step = np.where(np.isfinite(step) & (step > 0), step, 1).astype(np.float32)
+        self.codes = np.empty((rows, dimension), dtype=np.int8)
+        for start in range(0, rows, BLOCK_ROWS):
+            self.codes[start : start + BLOCK_ROWS] = self.encode(np.asarray(matrix[start : start + BLOCK_ROWS]))
+
+    def encode(self, block: np.ndarray) -> np.ndarray:
+        levels = np.clip(np.rint((np.asarray(block, dtype=np.float32) - self.offset) / self.step), 0, 255)
+        # Centered on zero to fit a signed byte, the 128 is added back when scoring
+        return (levels - 128).astype(np.int8)
+
+    def score(self, query: np.ndarray) -> np.ndarray:
+        weights = np.asarray(query, dtype=np.float32) * self.step
+        bias = float(np.dot(query, self.offset) + 128 * weights.sum())
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), BLOCK_ROWS):
+            scores[start : start + BLOCK_ROWS] = self.codes[start : start + BLOCK_ROWS].astype(np.float32) @ weights
+        return scores + bias
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.offset.nbytes + self.step.nbytes
+
+
+class BinaryQuantizer(Quantizer):
+    """
+    One bit per dimension, whether the row is above the dimension's mean, a 32nd of the float32 size.
+
+    Rows are ranked by the Hamming distance of their bits to the query's. The query is brought to the rows' average norm
+    before it's compared with the means, so the scale of the query doesn't change its bits.
+    """
+
+    # Recall@10 of 1536 dimension embeddings is 0.88 at 8 and 0.998 at 32, see benchmarks/quantization.py
+    rescore_factor = 32
+
+    def __init__(self, matrix: np.ndarray):
+        rows, dimension = matrix.shape
+        total = np.zeros(dimension, dtype=np.float64)
+        norms = 0.0
+        for start in range(0, rows, BLOCK_ROWS):
+            block = np.asarray(matrix[start : start + BLOCK_ROWS], dtype=np.float32)
+            total += block.sum(axis=0)
+            norms += float(np.linalg.norm(block, axis=1).sum())
+        self.mean = (total / max(rows, 1)).astype(np.float32)
+        self.norm = norms / max(rows, 1)
+        self.codes = np.empty((rows, (dimension + 7) // 8), dtype=np.uint8)
+        for start in range(0, rows, BLOCK_ROWS):
+            self.codes[start : start + BLOCK_ROWS] = self.encode(np.asarray(matrix[start : start + BLOCK_ROWS]))
+
+    def encode(self, block: np.ndarray) -> np.ndarray:
+        return np.packbits(np.asarray(block, dtype=np.float32) > self.mean, axis=1)
+
+    def score(self, query: np.ndarray) -> np.ndarray:
+        query = np.asarray(query, dtype=np.float32)
+        norm = float(np.linalg.norm(query))
+        bits = np.packbits(query * (self.norm / norm if norm else 1) > self.mean)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), BLOCK_ROWS):
+            distances = POPCOUNT[np.bitwise_xor(self.codes[start : start + BLOCK_ROWS], bits)].sum(axis=1)
+            scores[start : start + BLOCK_ROWS] = -distances.astype(np.float32)
+        return scores
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.mean.nbytes
+
+
+def get_quantizer(quantization: VectorQuantization, matrix: np.ndarray) -> Optional[Quantizer]:
+    if quantization == VectorQuantization.INT8:
+        return ScalarQuantizer(matrix)
+    if quantization == VectorQuantization.BINARY:
+        return BinaryQuantizer(matrix)
+    return None
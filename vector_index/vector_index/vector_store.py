@@ -0,0 +1,599 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import cached_property
+from itertools import chain
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools.utilities.parameters import get_secret
+
+from vector_index.quantization import Quantizer, VectorQuantization, get_quantizer
+
+if TYPE_CHECKING:
+    import hnswlib
+    import pinecone
+
+
+logger = Logger()
+
+
+@dataclass
+class VectorMatch:
+
+    id: str
+    score: float
+    metadata: Dict[str, Any]
+
+
+class VectorStore(ABC):
+    """
+    The vector index operations shared by the indexer and the API.
+
+    Vectors are dicts with an `id`, dense `values` (a list or a float32 array), optional `sparse_values`
+    (`{"indices", "values"}`) and `metadata`.
+    Scores are dot products of the dense and sparse parts, the same as a Pinecone `dotproduct` index.
+    """
+
+    max_upsert_batch_size: int
+    max_delete_batch_size: int
+    max_fetch_batch_size: int
+
+    @abstractmethod
+    def upsert(self, vectors: List[Dict[str, Any]]) -> None: ...
+
+    @abstractmethod
+    def query(
+        self, vector: np.ndarray, top_k: int, sparse_vector: Optional[Dict[str, List]] = None
+    ) -> List[VectorMatch]: ...
+
+    @abstractmethod
+    def delete(self, ids: Sequence[str]) -> None:
+        """Delete the vectors by id, ids that don't exist are skipped."""
+
+    @abstractmethod
+    def list_ids(self, prefix: str) -> Iterator[List[str]]:
+        """The ids that start with `prefix`, a page at a time."""
+
+    @abstractmethod
+    def fetch_metadata(self, ids: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        """The metadata of the vectors by id, ids that don't exist are left out."""
+
+    @abstractmethod
+    def update_metadata(self, metadata: Dict[str, Dict[str, Any]]) -> None:
+        """Merge the metadata into the vectors' metadata by id, vectors that don't exist are skipped."""
+
+    @abstractmethod
+    def describe(self) -> Dict[str, Any]: ...
+
+
+class PineconeVectorStore(VectorStore):
+
+    max_upsert_batch_size = 100
+    max_delete_batch_size = 1000
+    # Fetched ids go in the query string
+    max_fetch_batch_size = 200
+
+    def __init__(self, host: str, api_key_secret_name: str, connection_pool_maxsize: int = 10):
+        self.host = host
+        self._api_key_secret_name = api_key_secret_name
+        self._connection_pool_maxsize = connection_pool_maxsize
+
+    @cached_property
+    def index(self) -> "pinecone.Index":
+        # The client is created on first use, importing pinecone and fetching the secret dominate the cold start
+        import pinecone
+
+        return pinecone.Index(
+            api_key=get_secret(self._api_key_secret_name),
+            host=self.host,
+            connection_pool_maxsize=self._connection_pool_maxsize,
+        )
+
+    def upsert(self, vectors: List[Dict[str, Any]]) -> None:
+        # The client serializes lists only
+        self.index.upsert(vectors=[{**vector, "values": np.asarray(vector["values"]).tolist()} for vector in vectors])
+
+    def query(
+        self, vector: np.ndarray, top_k: int, sparse_vector: Optional[Dict[str, List]] = None
+    ) -> List[VectorMatch]:
+        query: Dict[str, Any] = {"vector": np.asarray(vector, dtype=np.float32).tolist()}
+        # Pinecone rejects empty sparse vectors
+        if sparse_vector and sparse_vector["indices"]:
+            query["sparse_vector"] = sparse_vector
+        results = self.index.query(**query, top_k=top_k, include_metadata=True)
+        return [VectorMatch(id=match.id, score=match.score, metadata=match.metadata or {}) for match in results.matches]
+
+    def delete(self, ids: Sequence[str]) -> None:
+        self.index.delete(ids=list(ids))
+
+    def list_ids(self, prefix: str) -> Iterator[List[str]]:
+        yield from self.index.list(prefix=prefix, limit=100)
+
+    def fetch_metadata(self, ids: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        vectors = self.index.fetch(ids=list(ids)).vectors
+        return {id_: vector.metadata or {} for id_, vector in vectors.items()}
+
+    def update_metadata(self, metadata: Dict[str, Dict[str, Any]]) -> None:
+        # A vector is updated per request, the requests share the connection pool
+        index = self.index
+        with ThreadPoolExecutor(max_workers=self._connection_pool_maxsize) as executor:
+            futures = [executor.submit(index.update, id=id_, set_metadata=values) for id_, values in metadata.items()]
+            for future in futures:
+                future.result()
+
+    def describe(self) -> Dict[str, Any]:
+        return self.index.describe_index_stats().to_dict()
+
+
+class InvertedIndex:
+    """
+    Sparse vectors of the rows of a matrix, as sorted segments of `(term index, row, value)` postings.
+
+    Every batch of rows becomes a segment and segments of similar sizes are merged, like a log-structured merge tree,
+    so adding rows costs amortized O(log n) numpy work per posting and a query looks up its terms in O(log n) segments.
+    """
+
+    def __init__(self):
+        # Per segment: the sorted distinct term indices, the offsets of their postings, and the postings' rows and values
+        self.segments: List[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = []
+
+    def add(self, first_row: int, sparse_vectors: List[Dict[str, List]]) -> None:
+        counts = [len(sparse["indices"]) for sparse in sparse_vectors]
+        total = sum(counts)
+        if total == 0:
+            return
+        indices = np.fromiter(chain.from_iterable(sparse["indices"] for sparse in sparse_vectors), np.int64, total)
+        values = np.fromiter(chain.from_iterable(sparse["values"] for sparse in sparse_vectors), np.float32, total)
+        rows = np.repeat(np.arange(first_row, first_row + len(sparse_vectors), dtype=np.int64), counts)
+        self.segments.append(self._build(indices, rows, values))
+        while len(self.segments) > 1 and len(self.segments[-2][2]) <= 2 * len(self.segments[-1][2]):
+            newer, older = self.segments.pop(), self.segments.pop()
+            self.segments.append(
+                self._build(
+                    np.concatenate([self._expand(older), self._expand(newer)]),
+                    np.concatenate([older[2], newer[2]]),
+                    np.concatenate([older[3], newer[3]]),
+                )
+            )
+
+    def score(self, sparse_vector: Dict[str, List], rows: int) -> np.ndarray:
+        scores = np.zeros(rows, dtype=np.float32)
+        indices = np.asarray(sparse_vector["indices"], dtype=np.int64)
+        weights = np.asarray(sparse_vector["values"], dtype=np.float32)
+        for keys, offsets, posting_rows, values in self.segments:
+            positions = np.minimum(np.searchsorted(keys, indices), len(keys) - 1)
+            found = keys[positions] == indices
+            for position, weight in zip(positions[found].tolist(), weights[found].tolist()):
+                start, end = offsets[position], offsets[position + 1]
+                scores[posting_rows[start:end]] += weight * values[start:end]
+        return scores
+
+    @staticmethod
+    def _build(
+        indices: np.ndarray, rows: np.ndarray, values: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        order = np.argsort(indices, kind="stable")
+        keys, starts = np.unique(indices[order], return_index=True)
+        return keys, np.append(starts, len(order)), rows[order], values[order]
+
+    @staticmethod
+    def _expand(segment: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]) -> np.ndarray:
+        keys, offsets, _, _ = segment
+        return np.repeat(keys, np.diff(offsets))
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-container vector index stored in a directory, for running and testing without Pinecone.
+
+    Writes only append: dense vectors to a float32 matrix file that is memory mapped for reads, and every upsert,
+    delete and metadata update as a line of a log. Readers replay the log from where they stopped, so catching up
+    with another process costs as much as the writes it missed, the inverted index and the quantized codes are
+    extended the same way. The manifest only changes when the files are compacted or a graph snapshot is written.
+
+    Below `hnsw_threshold` live vectors the dense candidates come from a scan of every vector, over int8 or binary
+    codes held in memory when `quantization` is set, above it from an hnswlib graph. A scan keeps `rescore_factor`
+    times `top_k` candidates, by default the quantizer's own factor. Sparse scores come from the inverted index and
+    the best sparse matches are always candidates too, the candidates are rescored exactly with their float32 rows so
+    only those pages of the matrix are read.
+    Updated and deleted rows are tombstoned and the files are compacted once a quarter of the rows are dead.
+    """
+
+    max_upsert_batch_size = 10_000
+    max_delete_batch_size = 10_000
+    max_fetch_batch_size = 10_000
+    # Replaced files are kept this long, a reader that read the previous manifest can still open them
+    file_retention_seconds = 300
+    hnsw_m = 16
+    hnsw_ef_construction = 64
+
+    def __init__(
+        self,
+        path: str,
+        hnsw_threshold: int = 10_000,
+        ef_search: int = 64,
+        quantization: VectorQuantization = VectorQuantization.NONE,
+        rescore_factor: Optional[int] = None,
+    ):
+        self.path = Path(path)
+        self.hnsw_threshold = hnsw_threshold
+        self.ef_search = ef_search
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self._lock = threading.RLock()
+        self._manifest_stat: Optional[Tuple[int, int]] = None
+        self._reset(generation=0, snapshot=None, snapshot_rows=0)
+
+    def upsert(self, vectors: List[Dict[str, Any]]) -> None:
+        if not vectors:
+            return
+        matrix = np.asarray([vector["values"] for vector in vectors], dtype=np.float32)
+        with self._write_lock():
+            dimension = self._dimension or matrix.shape[1]
+            if matrix.shape[1] != dimension:
+                raise ValueError(f"Expected vectors of dimension {dimension}, got {matrix.shape[1]}")
+            entries = [
+                [
+                    vector["id"],
+                    vector.get("metadata") or {},
+                    vector.get("sparse_values") or {"indices": [], "values": []},
+                ]
+                for vector in vectors
+            ]
+            # The rows are written before the log line that refers to them
+            with open(self.path / self._vectors_file, "ab") as file:
+                file.write(matrix.tobytes())
+            self._append({"op": "upsert", "dimension": dimension, "vectors": entries})
+
+    def query(
+        self, vector: np.ndarray, top_k: int, sparse_vector: Optional[Dict[str, List]] = None
+    ) -> List[VectorMatch]:
+        with self._lock:
+            self._refresh()
+            if not self._rows:
+                return []
+            live = self._live_mask
+            query = np.asarray(vector, dtype=np.float32)
+            sparse_scores = self._score_sparse(sparse_vector)
+            if sparse_scores is not None:
+                sparse_scores[~live] = 0
+            if self._snapshot is None and self.quantization == VectorQuantization.NONE:
+                scores = self._matrix @ query
+                if sparse_scores is not None:
+                    scores += sparse_scores
+                rows = np.arange(len(self._ids))
+            else:
+                if self._snapshot is None:
+                    candidates = self._scan_quantized(query, top_k)
+                else:
+                    candidates = self._search_graph(query, max(self.ef_search, top_k))
+                if sparse_scores is not None:
+                    count = min(max(self.ef_search, top_k), len(sparse_scores))
+                    candidates.extend(np.argpartition(-sparse_scores, count - 1)[:count].tolist())
+                rows = np.unique(np.asarray(candidates, dtype=np.int64))
+                scores = np.asarray(self._matrix[rows], dtype=np.float32) @ query
+                if sparse_scores is not None:
+                    scores += sparse_scores[rows]
+            scores[~live[rows]] = -np.inf
+            k = min(top_k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [
+                VectorMatch(id=self._ids[rows[i]], score=float(scores[i]), metadata=self._metadata[self._ids[rows[i]]])
+                for i in top
+                if np.isfinite(scores[i])
+            ]
+
+    def delete(self, ids: Sequence[str]) -> None:
+        with self._write_lock():
+            deleted = [id_ for id_ in ids if id_ in self._rows]
+            if deleted:
+                self._append({"op": "delete", "ids": deleted})
+
+    def list_ids(self, prefix: str) -> Iterator[List[str]]:
+        with self._lock:
+            self._refresh()
+            ids = sorted(id_ for id_ in self._rows if id_.startswith(prefix))
+        for start in range(0, len(ids), 100):
+            yield ids[start : start + 100]
+
+    def fetch_metadata(self, ids: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            self._refresh()
+            return {id_: self._metadata[id_] for id_ in ids if id_ in self._metadata}
+
+    def update_metadata(self, metadata: Dict[str, Dict[str, Any]]) -> None:
+        with self._write_lock():
+            updated = {id_: values for id_, values in metadata.items() if id_ in self._metadata}
+            if updated:
+                self._append({"op": "update", "metadata": updated})
+
+    def describe(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refresh()
+            return {
+                "dimension": self._dimension,
+                "total_vector_count": len(self._rows),
+                "rows": len(self._ids),
+                "hnsw": self._snapshot is not None,
+                "quantization": self.quantization.value,
+                "quantized_bytes": self._quantizer.nbytes if self._quantizer is not None else None,
+            }
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        """Serialize writers across threads and processes, the log and the matrix have to grow in step."""
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / "lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._refresh()
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        if self._manifest_stat is None:
+            self._write_manifest()
+        with open(self.path / self._log_file, "ab") as file:
+            file.write(json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n")
+        self._read_log()
+        if len(self._ids) - len(self._rows) > len(self._ids) // 4:
+            self._compact()
+        elif self._snapshot is None and len(self._rows) >= self.hnsw_threshold:
+            self._save_snapshot()
+        elif self._snapshot is not None and len(self._ids) - self._snapshot_rows > self._snapshot_rows // 4:
+            # Readers that start later add the rows after the snapshot to their graph themselves
+            self._save_snapshot()
+
+    def _scan_quantized(self, query: np.ndarray, top_k: int) -> List[int]:
+        # The codes are built on the first query and extended with the rows appended since, the indexer never builds
+        # them. They are refit once the store doubled, the ranges of the first rows may not fit the later ones.
+        if self._quantizer is None or len(self._ids) > 2 * self._quantizer_fit_rows:
+            self._quantizer = get_quantizer(self.quantization, self._matrix)
+            self._quantizer_fit_rows = len(self._ids)
+        elif len(self._quantizer.codes) < len(self._ids):
+            self._quantizer.extend(self._matrix[len(self._quantizer.codes) :])
+        assert self._quantizer is not None
+        scores = self._quantizer.score(query)
+        scores[~self._live_mask] = -np.inf
+        # Coarser codes rank the rows less faithfully and need more candidates for the same recall
+        count = min(top_k * (self.rescore_factor or self._quantizer.rescore_factor), len(scores))
+        return np.argpartition(-scores, count - 1)[:count].tolist()
+
+    def _search_graph(self, query: np.ndarray, ef: int) -> List[int]:
+        graph = self._sync_graph()
+        graph.set_ef(ef)
+        labels, _ = graph.knn_query(query, k=min(ef, len(self._rows)))
+        return labels[0].astype(np.int64).tolist()
+
+    def _sync_graph(self) -> "hnswlib.Index":
+        """Load the snapshot if the graph isn't in memory yet and add the rows appended after it."""
+        import hnswlib
+
+        if self._graph is None:
+            graph = hnswlib.Index(space="ip", dim=self._dimension)
+            assert self._snapshot is not None
+            graph.load_index(str(self.path / self._snapshot), max_elements=max(2 * len(self._ids), 1024))
+            self._graph, self._graph_rows = graph, self._snapshot_rows
+            for row in range(self._snapshot_rows):
+                if self._ids[row] is None:
+                    self._mark_deleted(row)
+        rows = len(self._ids)
+        if self._graph_rows < rows:
+            if self._graph.get_max_elements() < rows:
+                self._graph.resize_index(2 * rows)
+            self._graph.add_items(np.asarray(self._matrix[self._graph_rows :]), np.arange(self._graph_rows, rows))
+            added, self._graph_rows = self._graph_rows, rows
+            for row in range(added, rows):
+                if self._ids[row] is None:
+                    self._mark_deleted(row)
+        return self._graph
+
+    def _mark_deleted(self, row: int) -> None:
+        try:
+            self._graph.mark_deleted(row)  # type: ignore - only called with a graph
+        except RuntimeError:
+            # Already deleted when the snapshot was written
+            pass
+
+    def _score_sparse(self, sparse_vector: Optional[Dict[str, List]]) -> Optional[np.ndarray]:
+        if not sparse_vector or not sparse_vector["indices"]:
+            return None
+        return self._inverted_index.score(sparse_vector, len(self._ids))
+
+    @property
+    def _live_mask(self) -> np.ndarray:
+        return np.frombuffer(self._live, dtype=bool) if self._live else np.zeros(0, dtype=bool)
+
+    @property
+    def _vectors_file(self) -> str:
+        return f"vectors-{self._generation}.f32"
+
+    @property
+    def _log_file(self) -> str:
+        return f"log-{self._generation}.jsonl"
+
+    def _reset(self, generation: int, snapshot: Optional[str], snapshot_rows: int) -> None:
+        self._generation = generation
+        self._snapshot = snapshot
+        self._snapshot_rows = snapshot_rows
+        self._log_offset = 0
+        self._dimension: Optional[int] = None
+        self._ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._live = bytearray()
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        self._sparse: Dict[str, Dict[str, List]] = {}
+        self._inverted_index = InvertedIndex()
+        self._graph: Optional["hnswlib.Index"] = None
+        self._graph_rows = 0
+        self._quantizer: Optional[Quantizer] = None
+        self._quantizer_fit_rows = 0
+        self._open_matrix()
+
+    def _open_matrix(self) -> None:
+        rows = len(self._ids)
+        if rows == 0 or self._dimension is None:
+            self._matrix = np.zeros((0, self._dimension or 0), dtype=np.float32)
+        else:
+            self._matrix = np.memmap(
+                self.path / self._vectors_file, dtype=np.float32, mode="r", shape=(rows, self._dimension)
+            )
+
+    def _refresh(self) -> None:
+        # Another process (the indexer or the API) may have written the store since it was last read
+        for attempt in range(3):
+            try:
+                self._read_manifest()
+                self._read_log()
+                return
+            except FileNotFoundError:
+                # Compacted between reading the manifest and opening its files, older files are kept for a while so
+                # this only happens to a reader that was paused longer than that
+                if attempt == 2:
+                    raise
+                self._manifest_stat = None
+
+    def _read_manifest(self) -> None:
+        manifest = self.path / "manifest.json"
+        try:
+            stat = manifest.stat()
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns) == self._manifest_stat:
+            return
+        state = json.loads(manifest.read_text())
+        if state["generation"] != self._generation or self._manifest_stat is None:
+            self._reset(state["generation"], state["snapshot"], state["snapshot_rows"])
+        elif state["snapshot"] != self._snapshot:
+            # A newer snapshot of the same rows, a graph already in memory is as good
+            if self._graph is None:
+                self._graph_rows = 0
+            self._snapshot, self._snapshot_rows = state["snapshot"], state["snapshot_rows"]
+        self._manifest_stat = (stat.st_ino, stat.st_mtime_ns)
+
+    def _read_log(self) -> None:
+        try:
+            if os.stat(self.path / self._log_file).st_size == self._log_offset:
+                return
+            with open(self.path / self._log_file, "rb") as file:
+                file.seek(self._log_offset)
+                data = file.read()
+        except FileNotFoundError:
+            if self._manifest_stat is None:
+                return
+            raise
+        # A line that is still being written is read on the next refresh
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return
+        for line in data[:end].splitlines():
+            self._apply(json.loads(line))
+        self._log_offset += end
+        self._open_matrix()
+
+    def _apply(self, entry: Dict[str, Any]) -> None:
+        if entry["op"] == "upsert":
+            self._dimension = entry["dimension"]
+            self._inverted_index.add(len(self._ids), [sparse for _, _, sparse in entry["vectors"]])
+            for id_, metadata, sparse in entry["vectors"]:
+                if (previous := self._rows.get(id_)) is not None:
+                    self._tombstone(previous)
+                self._rows[id_] = len(self._ids)
+                self._ids.append(id_)
+                self._live.append(1)
+                self._metadata[id_] = metadata
+                self._sparse[id_] = sparse
+        elif entry["op"] == "delete":
+            for id_ in entry["ids"]:
+                if (row := self._rows.pop(id_, None)) is not None:
+                    self._tombstone(row)
+                    self._metadata.pop(id_, None)
+                    self._sparse.pop(id_, None)
+        elif entry["op"] == "update":
+            for id_, values in entry["metadata"].items():
+                if id_ in self._metadata:
+                    self._metadata[id_] = {**self._metadata[id_], **values}
+
+    def _tombstone(self, row: int) -> None:
+        self._ids[row] = None
+        self._live[row] = 0
+        if self._graph is not None and row < self._graph_rows:
+            self._mark_deleted(row)
+
+    def _write_manifest(self) -> None:
+        state = {"generation": self._generation, "snapshot": self._snapshot, "snapshot_rows": self._snapshot_rows}
+        # Written last and atomically, readers only see files that are complete
+        temporary = self.path / "manifest.json.tmp"
+        temporary.write_text(json.dumps(state))
+        os.replace(temporary, self.path / "manifest.json")
+        stat = (self.path / "manifest.json").stat()
+        self._manifest_stat = (stat.st_ino, stat.st_mtime_ns)
+        self._remove_stale_files()
+
+    def _save_snapshot(self) -> None:
+        if self._snapshot is None:
+            logger.info(f"Building HNSW graph over {len(self._rows)} vectors")
+            self._build_graph()
+        graph = self._sync_graph()
+        snapshot = f"hnsw-{self._generation}-{len(self._ids)}.bin"
+        graph.save_index(str(self.path / f"{snapshot}.tmp"))
+        os.replace(self.path / f"{snapshot}.tmp", self.path / snapshot)
+        self._snapshot, self._snapshot_rows = snapshot, len(self._ids)
+        self._write_manifest()
+
+    def _build_graph(self) -> None:
+        import hnswlib
+
+        self._graph = hnswlib.Index(space="ip", dim=self._dimension)
+        self._graph.init_index(
+            max_elements=max(2 * len(self._ids), 1024),
+            ef_construction=self.hnsw_ef_construction,
+            M=self.hnsw_m,
+            random_seed=42,
+        )
+        self._graph_rows = 0
+
+    def _compact(self) -> None:
+        live_rows = [row for row, id_ in enumerate(self._ids) if id_ is not None]
+        entries = [[self._ids[row], self._metadata[self._ids[row]], self._sparse[self._ids[row]]] for row in live_rows]
+        dimension, had_graph = self._dimension, self._snapshot is not None
+        matrix = self._matrix
+        generation = self._generation + 1
+        with open(self.path / f"vectors-{generation}.f32", "wb") as file:
+            for start in range(0, len(live_rows), 1024):
+                file.write(np.asarray(matrix[live_rows[start : start + 1024]], dtype=np.float32).tobytes())
+        with open(self.path / f"log-{generation}.jsonl", "wb") as file:
+            if entries:
+                entry = {"op": "upsert", "dimension": dimension, "vectors": entries}
+                file.write(json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n")
+        self._reset(generation, snapshot=None, snapshot_rows=0)
+        self._read_log()
+        logger.info(f"Compacted local vector store to {len(self._ids)} rows")
+        if had_graph or len(self._rows) >= self.hnsw_threshold:
+            self._save_snapshot()
+        else:
+            self._write_manifest()
+
+    def _remove_stale_files(self) -> None:
+        current = {self._vectors_file, self._log_file, self._snapshot}
+        expired = time.time() - self.file_retention_seconds
+        for file in self.path.iterdir():
+            if not file.name.startswith(("vectors-", "log-", "hnsw-")) or file.name in current:
+                continue
+            try:
+                if file.stat().st_mtime < expired:
+                    file.unlink()
+            except FileNotFoundError:
+                pass